@@ -0,0 +1,541 @@
+"""
+Long-lived acquisition service shared by all running Experiments.
+
+One service process owns every connected Multi-Tube-OD-Reader. It keeps one open
+LabJack connection per serial number (see connections.py) and reads all registered experiments from a single
+schedule, so parallel experiments no longer compete for the same hardware.
+Each timepoint reads a device once, for the union of ports requested by every
+experiment due at that moment with the same acquisition profile, then splits the readings into each experiment's output file.
+A port shared by several experiments (a reference or blank tube, see Port.reference_ports) is
+read once per tick: experiments started at different times come due at different moments, so
+the latest reading of the shared port is kept and given to the other experiments sharing it
+that come due before the shortest of their intervals has passed. Experiments with different
+acquisition profiles don't share readings.
+
+The service learns about experiments from the config file (see Experiment.add_to_pickle).
+It adopts experiments carrying its token, drops experiments that are removed
+from the config file, and exits after a period without any experiments.
+The token is given by the app that starts the service and written to the PID file with the
+service's PID. It identifies the service even when the process started by the app
+is a launcher (a venv or py.exe shim) and not the python process running this file.
+
+Usage:
+    python acquisition.py <path to config file> <token>
+
+Modules imported:
+- timecourse: Provides functions for reading devices in parallel and reading file headers.
+- connections.ConnectionPool: Keeps one open connection per device.
+- scheduler: Provides the deadlines of each experiment's timepoints.
+- output_writer.OutputWriter: Keeps each output file open while its run is active.
+- archive.archive_run: Compresses the output file of a run when it ends.
+- events.EventLog: Records errors and terminations of each run, see events.py.
+- config_store: Holds the config file lock while the service exits.
+- dill: Provides serialization and deserialization functions.
+- psutil: Provides functions for process management.
+- time, os, sys, json, threading, uuid, logging: Standard library helpers.
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from timecourse import read_devices, read_times_row, collect_header
+from timecourse import lists_to_dictlist, get_config_path, collect_profile, collect_policy
+from scheduler import Schedule, event_row
+from output_writer import OutputWriter
+from archive import archive_run
+from events import EventLog
+from pathlib import Path
+import statistics
+import json
+import dill as pickle
+import psutil
+import threading
+import uuid
+import time
+import sys
+import os
+from connections import ConnectionPool
+import config_store
+import logging
+logger = logging.getLogger(__name__)
+
+pid_file = "acquisition.pid"
+
+def get_pid_path(pickle_path = None):
+    """
+    Returns the path of the file holding the PID and token of the acquisition service.
+
+    The file sits next to the config file.
+    """
+    return Path(pickle_path or get_config_path()).with_name(pid_file)
+
+def write_pid_file(pid, token, pickle_path = None):
+    get_pid_path(pickle_path).write_text(f"{pid}\n{token}")
+
+def read_pid_file(pickle_path = None):
+    """
+    Returns (PID, token) from the PID file, (None, None) if there is none.
+    """
+    try:
+        pid, _, token = get_pid_path(pickle_path).read_text().partition("\n")
+        return int(pid), token.strip() or None
+    except (OSError, ValueError):
+        return None, None
+
+def running_service(pickle_path = None):
+    """
+    Returns (PID, token) of the running acquisition service, (None, None) if it isn't running.
+    """
+    pid, token = read_pid_file(pickle_path)
+    try:
+        cmdline = psutil.Process(pid).cmdline()
+    except Exception:
+        return None, None
+
+    #PIDs are recycled by the OS, make sure this one is still the service
+    if any(Path(part).name == "acquisition.py" for part in cmdline):
+        return pid, token
+    return None, None
+
+def service_pid(pickle_path = None):
+    """
+    Returns the PID of the running acquisition service, or None if it isn't running.
+    """
+    return running_service(pickle_path)[0]
+
+
+class ScheduledRun:
+    """
+    Acquisition state of a single experiment within the acquisition service.
+
+    Attributes:
+        name (str): The name of the experiment.
+        path (Path): The path to the output file.
+        interval (float): Seconds between timepoints.
+        test (dict): Ports to read, as {device serial number: [port positions]}.
+        schedule (Schedule): Deadlines of the timepoints, starting when the service adopted the experiment.
+        failures (int): Number of consecutive failed timepoints.
+        profile (dict): Arguments for measure_voltage. See timecourse.ACQUISITION_PROFILES.
+        writer (OutputWriter): Writer of the output file.
+        events (EventLog): Log of the errors of the run.
+    """
+    def __init__(self, name, path, interval, test, starttime, profile = None, policy = "skip"):
+        self.name = name
+        self.path = Path(path)
+        self.writer = OutputWriter(self.path, sidecar = True)
+        self.events = EventLog(self.path)
+        self.interval = interval
+        self.test = test
+        self.schedule = Schedule(starttime, interval, policy = policy)
+        self.failures = 0
+        self.profile = profile or {}
+
+    @property
+    def starttime(self):
+        """
+        time.monotonic() when the service adopted the experiment.
+        """
+        return self.schedule.starttime
+
+    @property
+    def next_time(self):
+        """
+        time.monotonic() of the next timepoint.
+        """
+        return self.schedule.next_time
+
+    @classmethod
+    def from_header(cls, path, starttime):
+        """
+        Creates a ScheduledRun from the header of an output file. See Experiment.write_outfile_header()
+        """
+        name, interval, device_ids, ports, usages = collect_header(path)
+        return cls(name, path, interval, lists_to_dictlist(device_ids, ports), starttime,
+                   collect_profile(path), collect_policy(path))
+
+
+class AcquisitionService:
+    """
+    Multiplexes measurements of every running experiment over the connected hardware.
+
+    Attributes:
+        pickle_path (Path): The path to the config file listing running experiments.
+        token (str): Identifies the service, see Experiment.service.
+        runs (dict): ScheduledRun objects keyed by experiment name.
+        pool (ConnectionPool): Open connections to the hardware.
+        idle_timeout (float): Seconds without experiments before the service exits.
+        sync_period (float): Longest time (seconds) between checks of the config file.
+        hold_time (float): Connections are closed while waiting longer than this (seconds),
+                           so the app can blink, rename or discover devices in between.
+    """
+    def __init__(self, pickle_path, idle_timeout = 60, sync_period = 1, hold_time = 30, pool = None, token = None):
+        self.pickle_path = Path(pickle_path)
+        self.token = token or uuid.uuid4().hex
+        self.runs = {}
+        self.pool = pool or ConnectionPool()
+        self.finished = set() #names of runs stopped by the service itself
+        self.shared = {} #latest readings of shared ports, see run_due()
+        self.idle_timeout = idle_timeout
+        self.sync_period = sync_period
+        self.hold_time = hold_time
+        self._config_mtime = None
+
+    def sync_runs(self):
+        """
+        Updates the schedule from the config file, if the file changed since the last check.
+
+        Returns:
+            bool: False if the config file no longer exists, otherwise True.
+        """
+        if not self.pickle_path.exists():
+            for run in self.runs.values():
+                message = f"Self terminating. {self.pickle_path.name} does not exist at {self.pickle_path}."
+                try:
+                    run.writer.write_row([f"#{message}", f"#You must have deleted {self.pickle_path.name}."])
+                    run.events.record("terminated", message = message)
+                except Exception as e:
+                    logger.warning("Could not write to %s: %s", run.path, e)
+                self.close(run)
+            self.runs = {}
+            return False
+
+        mtime = self.pickle_path.stat().st_mtime_ns
+        if mtime == self._config_mtime:
+            return True
+
+        #a config file caught mid-write is retried on the next check
+        #instead of stopping the runs
+        try:
+            with self.pickle_path.open('rb') as f:
+                experiments = pickle.load(f)["Experiments"]
+        except Exception as e:
+            logger.warning("Could not load %s: %s", self.pickle_path, e)
+            return True
+        self._config_mtime = mtime
+
+        active = {e.name: e for e in experiments if self.measures(e)}
+
+        #drop experiments stopped by the user
+        for name in list(self.runs):
+            if name not in active:
+                run = self.runs.pop(name)
+                if run.path.exists():
+                    run.writer.write_row(run.schedule.summary_row())
+                self.close(run)
+
+        #adopt experiments started since the last check
+        now = time.monotonic()
+        for name, e in active.items():
+            if name in self.runs or name in self.finished or not Path(e.path).exists():
+                continue
+            try:
+                run = ScheduledRun.from_header(e.path, now)
+            except Exception as error:
+                #e.g. a malformed header, the experiment is left out instead of stopping the others
+                logger.warning("Could not start acquisition for %s: %s", name, error)
+                self.finished.add(name)
+                continue
+            self.runs[name] = run
+            run.writer.write_row([f"#Start Time:\t{time.asctime()}"])
+            try:
+                run.writer.flush()
+            except Exception as error:
+                #the row stays buffered and is written with the next timepoint
+                logger.warning("Could not write to %s: %s", run.path, error)
+            logger.info("Started acquisition for %s", name)
+        return True
+
+    def measures(self, experiment):
+        """
+        Returns True if the experiment was handed to this service.
+        """
+        service = getattr(experiment, "service", None)
+        if service is not None:
+            return service == self.token
+        #config files written before tokens only have the PID
+        return experiment.PID == os.getpid()
+
+    def read_devices(self, requested, profile = None):
+        """
+        Reads each requested device once. Devices are read at the same time (see timecourse.read_devices).
+
+        Args:
+            requested (dict): {device serial number: collection of port positions}
+            profile (dict): Arguments for measure_voltage. See timecourse.ACQUISITION_PROFILES.
+
+        Returns:
+            dict: {device serial number: (time.monotonic(), temperature, {port position: voltage})}.
+                  The value is the exception instead if the device could not be read.
+        """
+        requested = {serialNumber: sorted(ports, key = int) for serialNumber, ports in requested.items()}
+        #the pool reopens connections that raise exceptions
+        readings = read_devices(requested, pool = self.pool, profile = profile)
+        for serialNumber, reading in readings.items():
+            if not isinstance(reading, Exception):
+                timepoint, temp, voltages = reading
+                readings[serialNumber] = (timepoint, temp, dict(zip(requested[serialNumber], voltages)))
+        return readings
+
+    def shared_ports(self):
+        """
+        Returns {(device serial number, port position): [runs]} of the ports read by more than one run.
+        """
+        subscribers = {}
+        for run in self.runs.values():
+            for serialNumber, ports in run.test.items():
+                for p in ports:
+                    subscribers.setdefault((serialNumber, p), []).append(run)
+        return {port: runs for port, runs in subscribers.items() if len(runs) > 1}
+
+    def run_due(self):
+        """
+        Takes a timepoint for every experiment that is due.
+
+        Due experiments sharing an acquisition profile are read together.
+        A shared port is read once per tick, see read_shared().
+        """
+        now = time.monotonic()
+        due = [run for run in self.runs.values() if run.next_time <= now]
+
+        groups = {}
+        for run in due:
+            groups.setdefault(json.dumps(run.profile, sort_keys = True), []).append(run)
+
+        shared = self.shared_ports()
+        self.shared = {key: value for key, value in self.shared.items() if key[1:] in shared}
+        for profile, runs in groups.items():
+            #union of ports needed by all due runs, per device
+            requested = {}
+            for run in runs:
+                for serialNumber, ports in run.test.items():
+                    requested.setdefault(serialNumber, set()).update(ports)
+
+            started = time.monotonic()
+            readings = self.read_shared(requested, runs, profile, shared, started)
+            for run in runs:
+                try:
+                    self.record(run, readings, started)
+                except Exception as e:
+                    #only this run stops, the others keep being measured
+                    logger.exception("Stopping acquisition for %s", run.name)
+                    self.stop(run)
+
+    def read_shared(self, requested, runs, profile, shared, started):
+        """
+        Reads the requested ports, reusing the latest reading of shared ports within their tick.
+
+        The reading of a shared port is kept with the names of the runs that read it. Until they
+        come due again, and at most for the shortest interval of the runs sharing the port, other
+        runs sharing it get the kept reading instead of reading the port again.
+        A device is only read if some of its ports are not covered by kept readings.
+
+        Args:
+            requested (dict): {device serial number: set of port positions}, changed in place.
+            runs (list): The due runs asking for the ports.
+            profile (str): Key of the runs' acquisition profile (json).
+            shared (dict): See shared_ports().
+            started (float): time.monotonic() when the timepoint started.
+
+        Returns:
+            dict: See read_devices(). Kept readings carry the time and temperature of the read that made them.
+        """
+        names = {run.name for run in runs}
+        kept = {}
+        for serialNumber, ports in requested.items():
+            for p in list(ports):
+                latest = self.shared.get((profile, serialNumber, p))
+                if latest is None or names & latest[0]:
+                    continue
+                if started - latest[1] < min(run.interval for run in shared[(serialNumber, p)]):
+                    kept[(serialNumber, p)] = latest
+                    ports.discard(p)
+
+        requested = {serialNumber: ports for serialNumber, ports in requested.items() if ports}
+        readings = self.read_devices(requested, runs[0].profile) if requested else {}
+        for (serialNumber, p), (readers, timepoint, temp, voltage) in kept.items():
+            reading = readings.setdefault(serialNumber, (timepoint, temp, {}))
+            if not isinstance(reading, Exception):
+                reading[2][p] = voltage
+
+        for serialNumber, ports in requested.items():
+            reading = readings.get(serialNumber)
+            if reading is None or isinstance(reading, Exception):
+                continue
+            timepoint, temp, voltages = reading
+            for p in ports:
+                if (serialNumber, p) in shared:
+                    self.shared[(profile, serialNumber, p)] = (names, timepoint, temp, voltages[p])
+        return readings
+
+    def record(self, run, readings, started):
+        """
+        Writes one experiment's share of the readings to its output file.
+
+        The timepoint is the average time at which the experiment's devices were read. If there
+        are several devices, the time of each is written to a comment line, see timecourse.read_times_row().
+
+        Mirrors timecourse.per_iteration(): the run stops if its output file is gone, exceptions, late
+        and missed timepoints are saved as commented out lines and the run stops after 4 consecutive failures.
+        Exceptions are also recorded in the run's event log, see events.py.
+        Errors writing the output file or the event log (e.g. while another program locks the file)
+        count as failed timepoints too.
+
+        Args:
+            started (float): time.monotonic() when reading the devices started.
+        """
+        #output file renamed/moved/deleted, see timecourse.kill_switch()
+        if not run.path.exists():
+            self.stop(run)
+            return
+
+        taken = False
+        try:
+            run.events.attempted(run.test)
+            timepoints = []
+            temperatures = []
+            row = []
+            for serialNumber, ports in run.test.items():
+                reading = readings[serialNumber]
+                if isinstance(reading, Exception):
+                    raise reading
+                timepoint, temp, voltages = reading
+                timepoints.append(timepoint)
+                temperatures.append(temp)
+                row = row + [voltages[p] for p in ports]
+            row.insert(0, statistics.mean(temperatures))
+            row.insert(0, (statistics.mean(timepoints) - run.starttime)/60)
+            run.writer.write_data(row)
+            taken = True
+            if len(run.test) > 1:
+                run.writer.write_row(read_times_row(run.test, readings, run.starttime))
+            run.writer.write_rows([event_row(event) for event in run.schedule.taken_at(started)])
+            run.writer.flush()
+
+            run.failures = 0
+
+        except Exception as e:
+            run.failures += 1
+            if not run.path.exists():
+                #output file renamed/moved/deleted
+                self.stop(run)
+                return
+            stopping = run.failures >= 4
+            #retry without shifting the deadlines of later timepoints.
+            #A timepoint that was taken stays buffered in the writer if only writing it failed
+            retries = [] if stopping or taken else run.schedule.failed_at(time.monotonic(), 2.3)
+            try:
+                run.events.record_failure(e, {s: readings.get(s) for s in run.test},
+                                          retry = run.failures, latency = time.monotonic() - started)
+                run.writer.write_row([f"#{e}"])
+                if stopping:
+                    run.events.record("stopped", message = "Stopping timecourse due to failures", retry = run.failures)
+                    run.writer.write_row(["#Stopping timecourse due to failures"])
+                    run.writer.write_row(run.schedule.summary_row())
+                run.writer.write_rows([event_row(event) for event in retries])
+                run.writer.flush()
+            except Exception as error:
+                logger.warning("Could not record the failure of %s: %s", run.name, error)
+            if stopping:
+                self.stop(run)
+
+    def stop(self, run):
+        """
+        Stops a run without waiting for the user to remove it from the config file.
+        """
+        self.runs.pop(run.name, None)
+        self.finished.add(run.name)
+        self.close(run)
+
+    def close(self, run):
+        """
+        Closes the output file and event log of a run that ended, and archives the output file.
+        Errors are logged, so they don't stop the other runs.
+        """
+        for f in (run.writer, run.events):
+            try:
+                f.close()
+            except Exception as e:
+                logger.warning("Could not close %s of %s: %s", type(f).__name__, run.name, e)
+        self.archive(run)
+
+    def archive(self, run):
+        """
+        Compresses the output file of a run that ended (see archive.py), without holding up other runs.
+        """
+        def archive():
+            try:
+                archive_run(run.path)
+            except Exception as e:
+                logger.warning("Could not archive %s: %s", run.path, e)
+
+        if run.path.exists():
+            #not a daemon, so the service finishes archiving before it exits
+            threading.Thread(target = archive, name = f"archive {run.name}").start()
+
+    def wait(self):
+        """
+        Sleeps until the next timepoint is due or the config file should be checked again.
+        """
+        now = time.monotonic()
+        next_time = min([run.next_time for run in self.runs.values()], default = now)
+        if next_time - now > self.hold_time:
+            self.pool.close_all()
+        for run in self.runs.values():
+            try:
+                run.writer.idle(run.next_time - now)
+            except Exception as e:
+                #buffered rows are kept and written with the next timepoint
+                logger.warning("Could not write to %s: %s", run.path, e)
+        wake = min(next_time, now + self.sync_period) if self.runs else now + self.sync_period
+        time.sleep(max(0, wake - now))
+
+    def retire(self):
+        """
+        Removes the PID file before the service exits for lack of experiments.
+
+        The app finds the service and hands it an experiment while holding the config file lock
+        (see Experiment.start_experiment), so with the lock held here every experiment is either
+        already in the config file, and adopted, or will be handed to a new service.
+
+        Returns:
+            bool: True if the service can exit, False if it adopted an experiment in the meantime.
+        """
+        with config_store.locked(self.pickle_path):
+            self.sync_runs()
+            if self.runs:
+                return False
+            if read_pid_file(self.pickle_path)[1] == self.token:
+                get_pid_path(self.pickle_path).unlink()
+            return True
+
+    def serve_forever(self):
+        """
+        Runs the service until the config file is deleted or no experiments are left.
+        """
+        idle_since = time.monotonic()
+        try:
+            while self.sync_runs():
+                now = time.monotonic()
+                if self.runs:
+                    idle_since = now
+                elif now - idle_since > self.idle_timeout and self.retire():
+                    break
+                self.run_due()
+                self.wait()
+        finally:
+            self.pool.close_all()
+            for run in self.runs.values():
+                run.writer.close()
+                run.events.close()
+
+
+################################# MAIN ######################################################
+if __name__ == "__main__":
+    pickle_path = Path(sys.argv[1]) if len(sys.argv) > 1 else get_config_path()
+    service = AcquisitionService(pickle_path, token = sys.argv[2] if len(sys.argv) > 2 else None)
+    #replaces the PID of the launcher written by the app, if any
+    write_pid_file(os.getpid(), service.token, pickle_path)
+    try:
+        service.serve_forever()
+    finally:
+        #leave the PID file alone if a newer service replaced it
+        if read_pid_file(pickle_path)[1] == service.token:
+            get_pid_path(pickle_path).unlink(missing_ok = True)
@@ -8,6 +8,7 @@ Structure:
 The app has a three tier structure (starting from the core)
 1. `timecourse.py` is the minimal script that interprets header info from 
   a `.csv` file into instructions to collect data from the physical device.
+  `acquisition.py` runs these instructions for all experiments in one shared process.
 2. Helper classes `Experiment`, `Device`, `Port` mirroring their physical counterparts.
 3. Other modules for the Shiny app. These pass info between the user and helper classes.
 
@@ -18,6 +19,8 @@ Modules imported:
 - setup_run: Shiny "module" for setting up new runs UI and server logic.
 - display_runs: Shiny "module" for displaying and managing ongoing runs.
 - experiment.Experiment: Class for managing experiments.
+- events: Reads the error logs of the runs, see events.py.
+- device_watcher.watcher: Finds connected devices in the background, see device_watcher.py.
 - Path from pathlib: A class for working with filesystem paths.
 
 Constants:
@@ -30,13 +33,19 @@ from shiny import App, Inputs, Outputs, Session, reactive, render, ui, req
 from shiny_modules.configure_hardware import configure_ui, configure_server
 from shiny_modules.setup_run import setup_ui, setup_server
 from shiny_modules.display_runs import accordion_plot_ui, accordion_plot_server
-from timecourse import get_config_path
+from timecourse import get_config_path, get_output_path
+from events import read_events, failure_rates
+from device_watcher import watcher
 from classes.experiment import Experiment
 from pathlib import Path
 
 #need to add an option within the app to update/reload a dead pickle
 
-Experiment.reconcile_pickle()
+#devices are found in the background, sessions never wait for the hardware
+#devices of running experiments are held by the acquisition service, the watcher leaves them alone
+watcher.in_use = lambda: {p.device.sn: p.device.name for e in Experiment.all for p in e.all_ports}
+watcher.start()
+Experiment.reconcile_pickle(discover = True)
 
 CALIBRATION_PATH = get_config_path().parents[0] / "Calibration.tsv"  
 
@@ -80,8 +89,20 @@ def server(input: Inputs, output: Outputs, session: Session):
     """
     #reconcile on on start up & everytime we 
     #add_to_pickle/remove_from_pickle, see Experiment module
+    #only applies changes of the config file, doesn't touch the hardware
     Experiment.reconcile_pickle()
 
+    @reactive.poll(lambda: watcher.version, interval_secs = 2)
+    def connected_devices():
+        """
+        Returns {serial number: name} of connected devices, whenever the device watcher finds a change.
+
+        Devices plugged in are added to Device.all, unplugged ones are dropped unless in use.
+        Doesn't touch the hardware, see device_watcher.py
+        """
+        Experiment.reconcile_pickle(discover = True)
+        return watcher.snapshot()
+
     @reactive.file_reader(get_config_path())
     def config_file():
         """
@@ -90,10 +111,10 @@ def server(input: Inputs, output: Outputs, session: Session):
         return Experiment.all
     
     #from configure_hardware.py module
-    configure_server("config")
+    configure_server("config", connected_devices)
 
     #from setup_run.py module
-    setup_complete = setup_server("setup", input.front_page_navs)        
+    setup_complete = setup_server("setup", input.front_page_navs, connected_devices)        
 
    # return_home = analysis_server("analysis")
 
@@ -170,10 +191,10 @@ def server(input: Inputs, output: Outputs, session: Session):
             ui.markdown(
                 """
                 ### What usually goes wrong:
-                Trying to read two experiments on the same device at the same time
-                will lead to problems where one or both experiments will quit. To
-                avoid this, set intervals of parallel experiments to at least 1 minute 
-                when running simultaneous experiments.\n\n
+                All experiments are measured by one background acquisition process.
+                Experiments sharing a device are read together, so parallel experiments
+                no longer need to be spaced apart. If a device is unplugged, its
+                experiments record errors and stop after 4 failed timepoints.\n\n
 
                 ### Other troubleshooting tips:
                 ##### Restart or reset the app
@@ -194,7 +215,43 @@ def server(input: Inputs, output: Outputs, session: Session):
                 https://www.linkedin.com/in/shebdon
                 """
             ),
+            ui.markdown("### Device errors:\nFailed timepoints of all runs in the output folder, per device and computer."),
+            ui.input_action_button("refresh_events", "Refresh"),
+            ui.output_data_frame("error_rates"),
+            ui.markdown("##### Latest errors:"),
+            ui.output_data_frame("latest_errors"),
         )
+
+    @reactive.calc
+    @reactive.event(input.refresh_events, input.front_page_navs, ignore_none = False)
+    def events():
+        """
+        Reads the event logs of all runs (see events.py) when the user opens a tab or clicks "Refresh".
+        """
+        return read_events(folder = get_output_path())
+
+    @output
+    @render.data_frame
+    def error_rates():
+        """
+        Table of failed timepoints per device and computer. See events.failure_rates()
+
+        Rendered by:
+            ui.output_data_frame("error_rates")
+        """
+        return render.DataGrid(failure_rates(events()).round({"failure rate": 4}))
+
+    @output
+    @render.data_frame
+    def latest_errors():
+        """
+        Table of the 100 latest errors and terminations.
+
+        Rendered by:
+            ui.output_data_frame("latest_errors")
+        """
+        latest = events()[events()["kind"] != "summary"].sort_values("time", ascending = False).head(100)
+        return render.DataGrid(latest.drop(columns = ["attempts"]))
     
 
     ####################### Navigation #######################################
@@ -0,0 +1,188 @@
+"""
+Compressed archives of completed runs, readable without decompressing them first.
+
+When a run ends, the acquisition service writes `run.tsv.gz` next to `run.tsv`. The archive
+is a series of gzip members ("blocks") of BLOCK_ROWS lines each, which together are a normal
+gzip file: any gzip tool (or pandas) reads it as the whole tsv. The index `run.tsv.gz.idx`
+(JSON) holds the byte offset and the time range of the data rows of every block, so
+read_archive() only decompresses the blocks of the requested time range.
+
+The tsv is kept: it is the file the user named, opens in a spreadsheet and may still be
+appended to (is_archived() then turns False). Readers go through read_output_file(), which
+prefers an up to date archive, much smaller to fetch from a network drive, and falls back to
+the archive or the binary log (run.mtod, see binary_log.py) when the tsv is gone.
+
+Usage:
+    archive_run("run.tsv")
+    data = read_archive("run.tsv.gz", start = 60, end = 120)
+
+Modules imported:
+- metadata.HEADER_LINES: The number of header lines of an output file.
+- integrity.read_verified: Reads output files without their damaged rows.
+- binary_log: Reads binary logs.
+- pandas: Archives are read into DataFrames, like pandas.read_csv on the tsv.
+- Path from pathlib: A class for working with filesystem paths.
+- gzip, io, json, os, logging: Standard library helpers.
+"""
+
+from metadata import HEADER_LINES
+from integrity import read_verified
+from binary_log import log_lines, SUFFIX as LOG_SUFFIX
+from pathlib import Path
+import pandas
+import gzip
+import json
+import io
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".gz"
+INDEX_SUFFIX = ".idx"
+BLOCK_ROWS = 1000
+
+def get_archive_path(path):
+    """
+    Returns the path of the archive of an output file (tsv).
+    """
+    path = Path(path)
+    return path.with_name(path.name + SUFFIX)
+
+def get_index_path(archive_path):
+    archive_path = Path(archive_path)
+    return archive_path.with_name(archive_path.name + INDEX_SUFFIX)
+
+def row_time(line:str):
+    """
+    Returns the time (first field) of a data row, or None for header and comment lines.
+    """
+    if line.startswith("#") or not line.strip():
+        return None
+    try:
+        return float(line.split("\t", 1)[0])
+    except ValueError:
+        return None
+
+def archive_run(path, block_rows = BLOCK_ROWS):
+    """
+    Writes the compressed archive and its index for an output file.
+
+    Both are written to temporary files first, so an archive is never half written.
+
+    Returns:
+        Path: The path to the archive.
+    """
+    path = Path(path)
+    archive_path = get_archive_path(path)
+    index_path = get_index_path(archive_path)
+    blocks = []
+
+    temp = archive_path.with_name(archive_path.name + ".tmp")
+    with open(path, "rb") as source, open(temp, "wb") as target:
+        lines = []
+        #header in a block of its own, so reading it decompresses nothing else
+        for x in range(HEADER_LINES):
+            lines.append(source.readline())
+        blocks.append(write_block(target, lines))
+        lines = []
+        for line in source:
+            if len(lines) >= block_rows:
+                blocks.append(write_block(target, lines))
+                lines = []
+            lines.append(line)
+        if lines:
+            blocks.append(write_block(target, lines))
+
+    index = {"source size": path.stat().st_size, "blocks": blocks}
+    temp_index = index_path.with_name(index_path.name + ".tmp")
+    temp_index.write_text(json.dumps(index))
+    os.replace(temp, archive_path)
+    os.replace(temp_index, index_path)
+    logger.info("Archived %s to %s", path, archive_path)
+    return archive_path
+
+def write_block(target, lines):
+    """
+    Appends lines as one gzip member.
+
+    Returns:
+        dict: "offset" and "length" (bytes) of the member, "rows" (data rows) and
+              "start"/"end" (lowest and highest time of its data rows, None without data rows).
+    """
+    times = [t for t in (row_time(line.decode()) for line in lines) if t is not None]
+    offset = target.tell()
+    target.write(gzip.compress(b"".join(lines)))
+    return {"offset": offset, "length": target.tell() - offset, "rows": len(times),
+            "start": min(times, default = None), "end": max(times, default = None)}
+
+def is_archived(path):
+    """
+    Returns True if an output file (tsv) has an up to date archive.
+    """
+    archive_path = get_archive_path(path)
+    try:
+        index = json.loads(get_index_path(archive_path).read_text())
+        return archive_path.is_file() and index["source size"] == Path(path).stat().st_size
+    except (OSError, ValueError, KeyError):
+        return False
+
+def read_blocks(archive_path, blocks):
+    """
+    Decompresses some blocks of an archive and returns their text.
+    """
+    text = []
+    with open(archive_path, "rb") as f:
+        for block in blocks:
+            f.seek(block["offset"])
+            text.append(gzip.decompress(f.read(block["length"])).decode())
+    return "".join(text)
+
+def read_archive(archive_path, start = None, end = None):
+    """
+    Reads the data rows of an archive, decompressing only the blocks within a time range.
+
+    Args:
+        archive_path: The path to the archive (.tsv.gz).
+        start, end (float): Only rows with start <= Time (min) <= end. Default: all.
+
+    Returns:
+        pandas.DataFrame: Columns 0 (Time), 1 (Temperature), 2... (voltages),
+                          like pandas.read_csv(path, comment = "#", header = None).
+    """
+    blocks = json.loads(get_index_path(archive_path).read_text())["blocks"]
+    blocks = [b for b in blocks if b["rows"]
+              and (start is None or b["end"] >= start)
+              and (end is None or b["start"] <= end)]
+    if not blocks:
+        return pandas.DataFrame()
+
+    data = pandas.read_csv(io.StringIO(read_blocks(archive_path, blocks)), delimiter = "\t", comment = "#", header = None)
+    if start is not None:
+        data = data[data[0] >= start]
+    if end is not None:
+        data = data[data[0] <= end]
+    return data.reset_index(drop = True)
+
+def read_output_file(path, **kwargs):
+    """
+    Reads an output file with pandas.read_csv, without its damaged rows and torn last line (see integrity.py).
+
+    A tsv is read from its archive if it has an up to date one. If the tsv is gone, its archive
+    or else its binary log is read.
+
+    Args:
+        path: The path to the output file: the tsv, the archive (.tsv.gz) or the binary log (.mtod).
+        kwargs: Passed to pandas.read_csv.
+    """
+    path = Path(path)
+    if path.suffix not in (SUFFIX, LOG_SUFFIX):
+        if is_archived(path) or not path.exists() and get_archive_path(path).is_file():
+            path = get_archive_path(path)
+        elif not path.exists() and path.with_suffix(LOG_SUFFIX).is_file():
+            path = path.with_suffix(LOG_SUFFIX)
+
+    if path.suffix == LOG_SUFFIX:
+        #damaged rows were left out when converting
+        text = "".join(line + "\n" for line in log_lines(path))
+        return pandas.read_csv(io.StringIO(text), delimiter = "\t", **kwargs)
+    return read_verified(path, compression = "gzip" if path.suffix == SUFFIX else None, delimiter = "\t", **kwargs)
@@ -0,0 +1,35 @@
+"""
+Selects the module used to talk to Multi-Tube-OD-Readers.
+
+Every module that touches the hardware imports `u3` from here instead of importing
+LabJackPython's `u3` directly, so the app, the acquisition service and the tests
+can run without physical LabJacks.
+
+Backends, chosen by the MTOD_BACKEND environment variable:
+- "labjack" (default): LabJackPython's u3 module and the connected hardware.
+- "simulated": simulated_u3, see that module for its settings.
+
+The variable is read once, at import. Child processes (the acquisition service)
+inherit it from the app.
+
+Modules imported:
+- os: Reads the environment variable.
+- logging: Provides logging functionality.
+"""
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+BACKENDS = ["labjack", "simulated"]
+
+name = os.environ.get("MTOD_BACKEND", "labjack").lower()
+
+if name == "simulated":
+    import simulated_u3 as u3
+elif name == "labjack":
+    import u3
+else:
+    raise ValueError(f"Unknown MTOD_BACKEND {name!r}, expected one of {BACKENDS}")
+
+logger.info("Using the %s backend", name)
@@ -0,0 +1,58 @@
+"""
+Benchmarks the acquisition profiles against a simulated U3.
+
+Reports, per profile, the time to read one device (latency) and the standard deviation
+of repeated readings of a constant voltage (noise). No hardware is needed.
+
+Usage:
+    python benchmark_profiles.py [number of ports] [number of timepoints]
+
+The simulated U3 (see simulated_u3.py) is a rough model of a U3-LV, not a calibration of one:
+    - each feedback packet costs a USB round trip plus a conversion time per AIN command
+    - LongSettling adds settling time per AIN command
+    - QuickSample shortens the conversion but adds noise
+The growth curves are frozen, so the noise is the spread of readings of a constant voltage.
+
+Modules imported:
+- timecourse: Provides measure_voltage and the acquisition profiles.
+- connections.ConnectionPool: Hands the simulated U3 to measure_voltage.
+- simulated_u3: Provides the simulated U3.
+- numpy: Provides statistics.
+- time, sys: Standard library helpers.
+"""
+
+from timecourse import measure_voltage, ACQUISITION_PROFILES
+from connections import ConnectionPool
+import simulated_u3
+import numpy as np
+import time
+import sys
+
+def benchmark(profile, ports, timepoints):
+    """
+    Reads a simulated device `timepoints` times with one profile.
+
+    Returns:
+        tuple: (mean seconds per reading, std of the readings in volts)
+    """
+    pool = ConnectionPool(opener = lambda serialNumber: simulated_u3.U3(serial = serialNumber))
+    serialNumber = next(iter(simulated_u3.devices()))
+    latencies = []
+    readings = []
+    for x in range(timepoints):
+        start = time.perf_counter()
+        readings.append(measure_voltage(serialNumber, ports = ports, pool = pool, **profile))
+        latencies.append(time.perf_counter() - start)
+    return np.mean(latencies), np.std(readings, axis = 0).mean()
+
+if __name__ == "__main__":
+    n_ports = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    timepoints = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    ports = list(range(1, n_ports + 1))
+    simulated_u3.configure(time_scale = 0) #constant ODs
+
+    print(f"{n_ports} ports, {timepoints} timepoints per profile")
+    print(f"{'profile':<12}{'latency (s)':>14}{'noise (uV)':>14}")
+    for name, profile in ACQUISITION_PROFILES.items():
+        latency, noise = benchmark(profile, ports, timepoints)
+        print(f"{name:<12}{latency:>14.3f}{noise*1e6:>14.1f}")
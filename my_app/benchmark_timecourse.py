@@ -0,0 +1,156 @@
+"""
+Benchmarks the hot paths of a timepoint against simulated devices.
+
+For every combination of total ports (1, 4, 16, 64) and devices (1, 2, 4, 8) that fits on
+the hardware (16 ports per device), times each stage of a timepoint:
+- measure_voltage: reading one device
+- get_measurement_row: reading all devices of the experiment
+- append_list_to_tsv: writing one row, opening and closing the file
+- OutputWriter: writing one row to the file held open for the run, and to its sidecar
+- kill_switch: checking whether the experiment was stopped
+- per_iteration: a whole timepoint (all of the above) of an experiment measured by its own process
+- AcquisitionService.record: splitting readings into one run's output file, as the shared service does
+- AcquisitionService.run_due: a whole timepoint of the shared acquisition service, which measures
+  every running experiment (see acquisition.py), with a single run due
+
+Each stage reports the mean wall time per call (latency), its standard deviation (jitter),
+the 95th percentile and the mean CPU time of this process per call.
+No hardware is needed, see simulated_u3.py for the latency model of the devices.
+
+Usage:
+    python benchmark_timecourse.py [--profile Standard] [--timepoints 10] [--ports 1 4 16 64] [--devices 1 2 4 8]
+
+Modules imported:
+- timecourse: Provides the functions being benchmarked.
+- scheduler.Schedule: Times the timepoints of per_iteration.
+- output_writer.OutputWriter: Writes the output file of per_iteration.
+- acquisition: Provides the shared acquisition service being benchmarked.
+- simulated_u3: Provides the simulated devices.
+- numpy: Provides statistics.
+- dill: Writes the config file read by kill_switch.
+- sidecar.get_sidecar_path: Finds the sidecar of the benchmark's output file.
+- argparse, shutil, tempfile, time, os: Standard library helpers.
+"""
+
+import os
+os.environ["MTOD_BACKEND"] = "simulated" #must be set before importing backend.py
+
+from timecourse import measure_voltage, get_measurement_row, append_list_to_tsv, kill_switch, per_iteration
+from timecourse import lists_to_dictlist, connection_pool, write_status, ACQUISITION_PROFILES
+from scheduler import Schedule
+from output_writer import OutputWriter
+from acquisition import AcquisitionService, ScheduledRun
+from sidecar import get_sidecar_path
+from pathlib import Path
+import simulated_u3
+import numpy as np
+import dill as pickle
+import argparse
+import shutil
+import tempfile
+import time
+
+PORTS_PER_DEVICE = 16
+
+def timed(func, timepoints):
+    """
+    Calls func() `timepoints` times.
+
+    Returns:
+        dict: latency, jitter and p95 (seconds of wall time) and cpu (seconds of CPU time) per call.
+    """
+    wall = []
+    cpu = []
+    for x in range(timepoints):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        func()
+        cpu.append(time.process_time() - start_cpu)
+        wall.append(time.perf_counter() - start_wall)
+    return {"latency": np.mean(wall), "jitter": np.std(wall), "p95": np.percentile(wall, 95), "cpu": np.mean(cpu)}
+
+def layout(n_ports, n_devices):
+    """
+    Spreads n_ports over n_devices simulated devices.
+
+    Returns:
+        dict: {device serial number: [port positions]}, as read from an output file header.
+    """
+    simulated_u3.configure(n_devices = n_devices)
+    serials = list(simulated_u3.devices())
+    device_ids = [serials[i % n_devices] for i in range(n_ports)]
+    ports = [str(i // n_devices + 1) for i in range(n_ports)]
+    return lists_to_dictlist(device_ids, ports)
+
+def benchmark(n_ports, n_devices, profile, timepoints, folder):
+    """
+    Times every stage of a timepoint for one layout of ports over devices.
+
+    Returns:
+        dict: {stage name: see timed()}
+    """
+    test = layout(n_ports, n_devices)
+    serialNumber, ports = next(iter(test.items()))
+
+    file = Path(folder) / "benchmark.tsv"
+    file.write_text("")
+    shutil.rmtree(get_sidecar_path(file), ignore_errors = True) #left by the previous layout
+    pickle_path = Path(folder) / "config.pkl"
+    with pickle_path.open("wb") as f:
+        pickle.dump({"Experiments": [], "Experiment_names": [file.stem]}, f)
+    write_status([file.stem], pickle_path)
+
+    service_file = Path(folder) / "service.tsv"
+    service_file.write_text("")
+    shutil.rmtree(get_sidecar_path(service_file), ignore_errors = True)
+    service = AcquisitionService(pickle_path)
+    #tiny interval and catching up, so the run is always due
+    run = service.runs[service_file.stem] = ScheduledRun(service_file.stem, service_file, 0.000001, test, time.monotonic(),
+                                                         profile, policy = "catch up")
+    readings = service.read_devices(test, profile)
+
+    row = [0.0, 30.0] + [1.5] * n_ports
+    starttime = time.monotonic()
+    writer = OutputWriter(file, sidecar = True)
+    def write_row():
+        writer.write_data(row)
+        writer.flush()
+
+    results = {
+        "measure_voltage": timed(lambda: measure_voltage(serialNumber, ports = ports, **profile), timepoints),
+        "get_measurement_row": timed(lambda: get_measurement_row(test, starttime, profile), timepoints),
+        "append_list_to_tsv": timed(lambda: append_list_to_tsv(row, file), timepoints),
+        "OutputWriter": timed(write_row, timepoints),
+        "kill_switch": timed(lambda: kill_switch(pickle_path, file), timepoints),
+        #a tiny interval and catching up, so per_iteration doesn't wait for the next timepoint
+        "per_iteration": timed(lambda: per_iteration(writer, pickle_path, test, Schedule(time.monotonic(), 0.001, policy = "catch up"),
+                                                     0, profile), timepoints),
+        "AcquisitionService.record": timed(lambda: service.record(run, readings, time.monotonic()), timepoints),
+        "AcquisitionService.run_due": timed(service.run_due, timepoints),
+    }
+    writer.close()
+    run.writer.close()
+    service.pool.close_all()
+    connection_pool.close_all()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the stages of a timepoint against simulated devices.")
+    parser.add_argument("--profile", default = "Standard", choices = list(ACQUISITION_PROFILES))
+    parser.add_argument("--timepoints", type = int, default = 10)
+    parser.add_argument("--ports", type = int, nargs = "+", default = [1, 4, 16, 64])
+    parser.add_argument("--devices", type = int, nargs = "+", default = [1, 2, 4, 8])
+    args = parser.parse_args()
+    profile = ACQUISITION_PROFILES[args.profile]
+
+    print(f"profile: {args.profile}, {args.timepoints} timepoints per stage. Times in ms.")
+    print(f"{'ports':>5}{'devices':>8}  {'stage':<28}{'latency':>10}{'jitter':>10}{'p95':>10}{'cpu':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for n_ports in args.ports:
+            for n_devices in args.devices:
+                #every device holds at least one and at most 16 ports
+                if n_devices > n_ports or n_ports > n_devices * PORTS_PER_DEVICE:
+                    continue
+                results = benchmark(n_ports, n_devices, profile, args.timepoints, folder)
+                for stage, r in results.items():
+                    print(f"{n_ports:>5}{n_devices:>8}  {stage:<28}" + "".join(f"{r[k]*1000:>10.2f}" for k in ["latency", "jitter", "p95", "cpu"]))
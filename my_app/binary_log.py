@@ -0,0 +1,171 @@
+"""
+Fixed-record binary copy of an output file, with random access by timepoint.
+
+A binary log is a single file:
+- 8 bytes: b"MTODLOG1"
+- 8 bytes: length of the header block (uint64, little-endian)
+- 8 bytes: number of columns per record (uint64, little-endian)
+- header block: JSON, padded with spaces to a multiple of 8 bytes
+    "header": the header lines of the tsv (see Experiment.write_outfile_header), split on tabs
+    "comments": [[number of records before the line, the line split on tabs], ...] for the
+                other commented out lines (start times, events, exceptions), without check lines
+    "first sequence": sequence number of the first data row (see integrity.py), None for
+                      files written before rows had sequence numbers
+- records: one per data row (time, temperature, voltages...), float64, little-endian
+
+The records can be mapped directly (numpy.memmap), so any timepoint is read without
+reading the ones before it. The tsv values are float64, so converting a tsv to a binary
+log and back gives the same rows and comments. Damaged data rows are left out, and the
+tsv written back has a check line for every row.
+
+The app reads binary logs like output files (see archive.read_output_file): the analysis tab
+accepts them, and they are read in place of a tsv that is gone.
+
+Usage:
+    python binary_log.py run.tsv       -> writes run.mtod
+    python binary_log.py run.mtod      -> writes run.tsv
+
+Modules imported:
+- metadata.HEADER_LINES: The number of header lines of an output file.
+- integrity: Checks and writes the sequence numbers and checksums of data rows.
+- numpy: Provides the records and memory mapping.
+- json: Encodes the header block.
+- Path from pathlib: A class for working with filesystem paths.
+- struct, sys: Standard library helpers.
+"""
+
+from metadata import HEADER_LINES
+from integrity import RowChecker, CHECK, format_row, check_line
+from pathlib import Path
+import numpy as np
+import struct
+import json
+import sys
+
+MAGIC = b"MTODLOG1"
+SUFFIX = ".mtod"
+PREFIX = struct.Struct("<8sQQ")
+RECORD_DTYPE = np.dtype("<f8")
+
+def split_tsv(path):
+    """
+    Splits an output file into its header lines, other comment lines and data rows.
+
+    Returns a tuple:
+        header (list): The first HEADER_LINES lines, as lists of fields.
+        comments (list): [number of data rows before the line, fields of the line]
+        rows (list): Data rows, as lists of floats. Damaged rows are left out.
+        first_sequence (int): Sequence number of the first data row, or None.
+    """
+    header = []
+    comments = []
+    rows = []
+    first_sequence = None
+    checker = RowChecker()
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if len(header) < HEADER_LINES and not rows and not comments:
+                header.append(line.split("\t"))
+                continue
+            if line.startswith("#") and not line.startswith(CHECK):
+                #rows of the block being read come before the line
+                comments.append([len(rows) + len(checker.block[3] if checker.block else []), line.split("\t")])
+            done = checker.feed(None, line)
+            if done and done[0][2] and not rows and checker.previous is not None:
+                first_sequence = checker.previous - len(done) + 1
+            rows += [[float(x) for x in row.split("\t")] for number, row, ok in done if ok]
+    return header, comments, rows, first_sequence
+
+def write_log(path, header, comments, rows, first_sequence = None):
+    """
+    Writes a binary log. See the module docstring for the layout.
+    """
+    rows = np.asarray(rows, dtype = RECORD_DTYPE)
+    n_columns = rows.shape[1] if rows.size else len(header[3]) + 1 #"#Ports:" plus time and temperature
+    block = json.dumps({"header": header, "comments": comments, "first sequence": first_sequence}).encode()
+    block += b" " * (-len(block) % 8)
+    with open(path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, len(block), n_columns))
+        f.write(block)
+        rows.reshape(-1, n_columns).tofile(f)
+
+def open_log(path):
+    """
+    Maps the records of a binary log.
+
+    Returns a tuple:
+        First element: dict with "header" and "comments", see the module docstring.
+        Second element: numpy array (or memmap) of shape (records, columns).
+                        A partly written last record is ignored.
+    """
+    with open(path, "rb") as f:
+        magic, block_length, n_columns = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary log")
+        meta = json.loads(f.read(block_length))
+
+    offset = PREFIX.size + block_length
+    n_records = (Path(path).stat().st_size - offset) // (RECORD_DTYPE.itemsize * n_columns)
+    if n_records == 0:
+        return meta, np.empty((0, n_columns), dtype = RECORD_DTYPE)
+    return meta, np.memmap(path, dtype = RECORD_DTYPE, mode = "r", offset = offset, shape = (n_records, n_columns))
+
+def read_timepoint(path, index):
+    """
+    Returns one record (time, temperature, voltages...) of a binary log as a list.
+    """
+    meta, records = open_log(path)
+    return records[index].tolist()
+
+def tsv_to_log(tsv_path, log_path = None):
+    """
+    Converts an output file to a binary log (by default next to it, ending in .mtod).
+
+    Returns:
+        Path: The path to the binary log.
+    """
+    log_path = Path(log_path or Path(tsv_path).with_suffix(SUFFIX))
+    write_log(log_path, *split_tsv(tsv_path))
+    return log_path
+
+def log_lines(log_path):
+    """
+    Returns the lines (without newlines) of the output file a binary log was converted from.
+    """
+    meta, records = open_log(log_path)
+    comments = iter(meta["comments"] + [[None, None]])
+    next_comment = next(comments)
+
+    first_sequence = meta.get("first sequence")
+    lines = ["\t".join(fields) for fields in meta["header"]]
+    for i, record in enumerate(records.tolist() + [None]):
+        while next_comment[0] == i:
+            lines.append("\t".join(next_comment[1]))
+            next_comment = next(comments)
+        if record is None:
+            continue
+        if first_sequence is not None:
+            lines.append(check_line([format_row(record)], first_sequence + i))
+        lines.append(format_row(record))
+    return lines
+
+def log_to_tsv(log_path, tsv_path = None):
+    """
+    Converts a binary log back to an output file (by default next to it, ending in .tsv).
+
+    Returns:
+        Path: The path to the output file.
+    """
+    tsv_path = Path(tsv_path or Path(log_path).with_suffix(".tsv"))
+    lines = log_lines(log_path)
+    with open(tsv_path, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    return tsv_path
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        if Path(path).suffix == SUFFIX:
+            print(log_to_tsv(path))
+        else:
+            print(tsv_to_log(path))
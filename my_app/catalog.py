@@ -0,0 +1,222 @@
+"""
+Searchable catalog of the output files in the "Output Data" folder.
+
+The catalog is a sqlite database (catalog.sqlite, next to the config file) with one row
+per output file (table `runs`) and one row per measured port (table `ports`). update()
+only reindexes files whose size or mtime changed, and forgets deleted files.
+
+Usage:
+    catalog = Catalog()
+    catalog.update()
+    runs = catalog.runs(name = "%strain A%", end_state = "completed")
+    data = catalog.load_series(runs["path"], device_id = "320000001", port = "3")
+
+    python catalog.py [folder]      -> updates the catalog and lists the runs
+
+Modules imported:
+- timecourse: Provides the location of the config file and of the output folder.
+- metadata: Reads the header and the comment lines of output files.
+- sidecar, archive: Read data rows without parsing the whole tsv, when possible.
+- pandas: Query results are DataFrames.
+- sqlite3, sys: Standard library helpers.
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from timecourse import get_config_path, get_output_path
+from metadata import read_header, comment_index
+from sidecar import has_sidecar, read_sidecar, get_sidecar_path, TIME, DTYPES
+from archive import read_output_file
+from pathlib import Path
+import pandas
+import sqlite3
+import sys
+
+catalog_file = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    interval REAL,
+    profile TEXT,
+    policy TEXT,
+    start_time TEXT,
+    rows INTEGER,
+    end_state TEXT,
+    size INTEGER,
+    mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS ports (
+    path TEXT REFERENCES runs(path) ON DELETE CASCADE,
+    position INTEGER,
+    device_id TEXT,
+    device_name TEXT,
+    port TEXT,
+    PRIMARY KEY (path, position)
+);
+CREATE INDEX IF NOT EXISTS ports_by_port ON ports (device_id, port);
+"""
+
+def get_catalog_path(pickle_path = None):
+    """
+    Returns the path of the catalog database. It sits next to the config file.
+    """
+    return Path(pickle_path or get_config_path()).with_name(catalog_file)
+
+def count_rows(path):
+    """
+    Returns the number of data rows of an output file, from the size of its sidecar if it has one.
+    """
+    if has_sidecar(path):
+        return (get_sidecar_path(path) / TIME).stat().st_size // DTYPES["f8"].itemsize
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip() and not line.startswith(b"#"))
+
+def end_state(comments):
+    """
+    Returns how the last run in an output file ended, from its comment lines (see metadata.comment_index()):
+    "failed", "terminated", "completed" (stopped by the user), or "running" (no end yet).
+    """
+    kinds = [entry["kind"] for entry in comments]
+    if "start" in kinds:
+        kinds = kinds[len(kinds) - kinds[::-1].index("start"):]
+    for kind, state in [("stopped", "failed"), ("terminated", "terminated"), ("schedule", "completed")]:
+        if kind in kinds:
+            return state
+    return "running"
+
+class Catalog:
+    """
+    Index of output files in a sqlite database.
+
+    Attributes:
+        db_path (Path): The path to the database.
+        folder (Path): The folder of output files indexed by update().
+    """
+    def __init__(self, db_path = None, folder = None):
+        self.db_path = Path(db_path or get_catalog_path())
+        self.folder = Path(folder or get_output_path())
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self):
+        """
+        Reindexes new and changed output files and forgets deleted ones.
+
+        Returns:
+            int: The number of files (re)indexed.
+        """
+        known = dict(((path, (size, mtime)) for path, size, mtime in
+                      self.connection.execute("SELECT path, size, mtime FROM runs")))
+        found = set()
+        indexed = 0
+        with self.connection:
+            for path in sorted(self.folder.glob("*.tsv")):
+                stat = path.stat()
+                found.add(str(path))
+                if known.get(str(path)) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                try:
+                    self.index(path, stat)
+                    indexed += 1
+                except Exception:
+                    continue #not an output file, or its header is incomplete
+
+            for path in set(known) - found:
+                self.connection.execute("DELETE FROM runs WHERE path = ?", (path,))
+        return indexed
+
+    def index(self, path, stat):
+        """
+        Writes the catalog rows of one output file.
+        """
+        header = read_header(path)
+        info, device_names, device_ids, ports, usages = [line[1:] for line in header]
+        comments = comment_index(path)
+        start_times = [entry["fields"][1] for entry in comments if entry["kind"] == "start"]
+        profile = info[2] if len(info) > 2 else None
+        policy = info[3] if len(info) > 3 else None
+
+        self.connection.execute("DELETE FROM runs WHERE path = ?", (str(path),))
+        self.connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (str(path), info[0], float(info[1]), profile, policy,
+                                 start_times[0] if start_times else None, count_rows(path),
+                                 end_state(comments), stat.st_size, stat.st_mtime_ns))
+        self.connection.executemany("INSERT INTO ports VALUES (?, ?, ?, ?, ?)",
+                                    [(str(path), i, device_id, name, port) for i, (device_id, name, port)
+                                     in enumerate(zip(device_ids, device_names, ports))])
+
+    def runs(self, name = None, device_id = None, port = None, end_state = None):
+        """
+        Finds runs. Every argument is optional and narrows the search.
+
+        Args:
+            name (str): Experiment name, as an SQL LIKE pattern ("%" matches anything).
+            device_id (str): Serial number of a device the run measured.
+            port (str): Port position the run measured (on `device_id`, if given).
+            end_state (str): See end_state().
+
+        Returns:
+            pandas.DataFrame: One row per run, with the columns of the `runs` table.
+        """
+        query = "SELECT * FROM runs WHERE 1"
+        args = []
+        if name is not None:
+            query += " AND name LIKE ?"
+            args.append(name)
+        if end_state is not None:
+            query += " AND end_state = ?"
+            args.append(end_state)
+        if device_id is not None or port is not None:
+            query += " AND path IN (SELECT path FROM ports WHERE (? IS NULL OR device_id = ?) AND (? IS NULL OR port = ?))"
+            args += [device_id, device_id, port, port]
+        return pandas.read_sql_query(query + " ORDER BY start_time", self.connection, params = args)
+
+    def load_series(self, paths, device_id = None, port = None, start = None, end = None):
+        """
+        Loads the voltages of the matching ports of many runs into one long DataFrame.
+
+        Args:
+            paths (list): Output files, e.g. the "path" column of runs().
+            device_id, port (str): Only ports of this device and/or position. Default: all.
+            start, end (float): Only rows with start <= Time (min) <= end. Default: all.
+
+        Returns:
+            pandas.DataFrame: Columns path, name, device_id, port, Time (min), temperature, voltage.
+        """
+        frames = []
+        for path in paths:
+            columns = pandas.read_sql_query(
+                "SELECT ports.position, ports.device_id, ports.port, runs.name FROM ports JOIN runs USING (path)"
+                " WHERE path = ? AND (? IS NULL OR device_id = ?) AND (? IS NULL OR port = ?) ORDER BY position",
+                self.connection, params = [str(path), device_id, device_id, port, port])
+            if columns.empty:
+                continue
+
+            positions = list(columns["position"])
+            if has_sidecar(path):
+                data = read_sidecar(path, ports = positions, start = start, end = end)
+            else:
+                data = read_output_file(path, comment = "#", header = None)
+                data = data[(data[0] >= (start if start is not None else -float("inf")))
+                            & (data[0] <= (end if end is not None else float("inf")))]
+
+            for x, column in columns.iterrows():
+                frames.append(pandas.DataFrame({"path": str(path), "name": column["name"],
+                                                "device_id": column["device_id"], "port": column["port"],
+                                                "Time (min)": data[0].to_numpy(), "temperature": data[1].to_numpy(),
+                                                "voltage": data[2 + column["position"]].to_numpy()}))
+        if not frames:
+            return pandas.DataFrame(columns = ["path", "name", "device_id", "port", "Time (min)", "temperature", "voltage"])
+        return pandas.concat(frames, ignore_index = True)
+
+if __name__ == "__main__":
+    catalog = Catalog(folder = sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"{catalog.update()} files indexed")
+    with pandas.option_context("display.width", 200, "display.max_columns", None):
+        print(catalog.runs().drop(columns = ["profile", "size", "mtime"]))
+    catalog.close()
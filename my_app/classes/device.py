@@ -9,23 +9,25 @@ Hardware refers to the physical objects.
 Python objects and hardware objects have a one-to-one relationship.
 
 Modules imported:
-- LabJackPython: Provides functionality for closing connections to LabJack devices.
+- connections: Provides the shared pool of open LabJack connections.
 - classes.port: Contains the Port class for managing ports on a Multi-Tube-OD-Reader device.
-- timecourse: Contains functions for measuring voltage and retrying operations.
-- u3: Provides the LabJack U3 device interface.
+- timecourse: Contains functions for measuring voltage.
+- device_watcher: Finds connected hardware in the background, see device_watcher.py.
+- backend.u3: Provides the LabJack U3 device interface (or a simulated one, see backend.py).
 - time: Provides time-related functions.
 - logging: Provides logging functionality.
 """
 
 #LabJack connections are 1 per device.
-# must open/close connection at each timepoint
-# to allow other experiments to access the
-# same Hardware between our readings
-from LabJackPython import Close
+# must close our connection after each interaction
+# to allow the acquisition service to access the
+# same Hardware between our interactions
+from connections import pool as connection_pool
 
 from classes.port import Port
-from timecourse import measure_voltage, retry
-import u3
+from timecourse import measure_voltage
+from device_watcher import watcher
+from backend import u3
 import time
 import logging
 logger = logging.getLogger(__name__)
@@ -37,11 +39,17 @@ class Device():
 
     Attributes:
         all (list): A class-level list of all Device instances.
+        registry (dict): The same Device instances, keyed by serial number.
         name (str): The name of the hardware.
         sn (str): The serial number of the hardware.
         ports (list): A list of Port instances associated with the hardware.
+
+    Devices aren't stored in the config file, Experiments store the serial number and name instead
+    (see Experiment.__getstate__()).
     """    
+    __slots__ = ("name", "sn", "ports")
     all = []
+    registry = {}
 
     def __init__(self, name, sn):
         """
@@ -58,7 +66,8 @@ class Device():
         self.ports = [Port(self, x) for x in range(1,17)]
 
         #keep list of all known Device objects representing connected hardware.
-        if self not in Device.all:
+        if sn not in Device.registry:
+            Device.registry[sn] = self
             Device.all.append(self)
         
 
@@ -74,50 +83,47 @@ class Device():
         """
         return hash(self.sn)
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled Device, including Devices pickled before Device had __slots__.
+        """
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        for key, value in state.items():
+            setattr(self, key, value)
+
     @staticmethod
-    @retry(3,1)
     def discovery(reset = False):
         """
-        Returns a hash value for the device based on its serial number.
+        Creates Device objects for connected hardware that has none yet.
         
-        Call with Device.discovery() to create Device objects for all Hardware
+        Call with Device.discovery() to create Device objects for all Hardware.
+        Uses the latest result of the background device watcher (see device_watcher.py),
+        so it only touches the hardware if the watcher isn't running.
 
         Returns:
-            int: The hash value of the device.
+            set: The serial numbers of the connected hardware.
         """
 
-        #get SNs of connected devices
-        d = u3.openAllU3()
-        connected_sns = list(d.keys())
-        Close()
+        #get SNs and names of connected devices
+        connected = watcher.snapshot()
+        connected_sns = list(connected.keys())
 
         #How to resolve conflict between pickled Devices (in 'config.dat') and 
         #Devices in Device.all.
         #May be inconsequential in current version.
         if reset:
-            known_devices = []
+            known_devices = {}
         else:
-            known_devices = [d.sn for d in Device.all]
+            known_devices = Device.registry
 
         #Only create objects for new Devices
         new_devices= [sn for sn in connected_sns if sn not in known_devices]
         for sn in new_devices:
-            d = u3.U3(firstFound = False, serial = sn)
-            name = d.getName()
-            Device(name, sn)
-        Close() #close all connections to Hardware. Required to avoid conflicts.
+            Device(connected[sn], sn)
 
         logger.info("Connected devices: %s", [d.name for d in Device.all])
-    
-    def connect(self):
-        """
-        Connects to the hardware using its serial number.
-
-        Returns:
-            u3.U3: The LabJack U3 device interface.
-        """
-        d = u3.U3(firstFound = False, serial = self.sn)
-        return d
+        return set(connected_sns)
     
     def rename(self, new_name):
         """
@@ -126,26 +132,27 @@ class Device():
         Args:
             new_name (str): The new name for the hardware.
         """        
-        d = self.connect()    
-        d.setName(name = new_name)
+        with connection_pool.connection(self.sn) as d:
+            d.setName(name = new_name)
         self.name = new_name
-        Close() #close all connections to Hardware. Required to avoid conflicts.
+        watcher.renamed(self.sn, new_name)
+        connection_pool.close(self.sn) #close connection to this Hardware. Required to avoid conflicts.
 
     def blink(self):
         """
         Blinks the hardware's indicator LED for visual identification.
         """        
-        d = self.connect()
         delay = 0.15 #period between flashes
         c = 0
-        while c < 25:
-            toggle = c % 2 
-            d.getFeedback(u3.LED(State = toggle)) # for built-in LED on LabJack
-            d.setDOState(16, c % 2) # for LED on CIO0, not currently implemented
-            d.getFeedback(u3.DAC8(Dac = 0, Value = d.voltageToDACBits(toggle*2.5, dacNumber= 0))) #for DAC0
-            time.sleep(delay)
-            c += 1
-        Close() #close all connections to Hardware. Required to avoid conflicts.
+        with connection_pool.connection(self.sn) as d:
+            while c < 25:
+                toggle = c % 2 
+                d.getFeedback(u3.LED(State = toggle)) # for built-in LED on LabJack
+                d.setDOState(16, c % 2) # for LED on CIO0, not currently implemented
+                d.getFeedback(u3.DAC8(Dac = 0, Value = d.voltageToDACBits(toggle*2.5, dacNumber= 0))) #for DAC0
+                time.sleep(delay)
+                c += 1
+        connection_pool.close(self.sn) #close connection to this Hardware. Required to avoid conflicts.
 
     
     
@@ -7,22 +7,32 @@ Modules imported:
 - classes.port: Contains the Port class for managing ports on a device.
 - classes.device: Contains the Device class for managing Multi-Tube-OD-Reader devices.
 - timecourse: Provides functions for measuring voltage and handling experiment configuration.
+- acquisition: Provides the shared acquisition service that measures all experiments.
+- config_store: Provides locked, atomic reads and writes of the config file.
+- output_writer.OutputWriter: Writes the header of the output file.
 - time: Provides time-related functions.
 - Path from pathlib: A class for working with filesystem paths.
-- dill: Provides serialization and deserialization functions.
+- json: Stores the acquisition profile in the output file header.
 - logging: Provides logging functionality.
 - subprocess: Provides functions for spawning new processes.
+- uuid: Generates the token of a new acquisition service.
 - psutil: Provides functions for process management.
 """
 
 from classes.port import Port
 from classes.device import Device
-from timecourse import measure_voltage, get_config_path, append_list_to_tsv, resource_path
+from timecourse import measure_voltage, get_config_path, resource_path, write_status
+from output_writer import OutputWriter
+from timecourse import ACQUISITION_PROFILES, DEFAULT_PROFILE
+from scheduler import DEFAULT_POLICY
+from acquisition import running_service, write_pid_file
+import config_store
 from time import sleep
 from pathlib import Path
-import dill as pickle
+import json
 import logging
 import subprocess
+import uuid
 logger = logging.getLogger(__name__)
 import psutil
 
@@ -33,15 +43,22 @@ class Experiment:
 
     Attributes:
         all (list): A class-level list of all Experiment instances.
+        registry (dict): The same Experiment instances, keyed by (name, PID).
         name (str): The name of the Experiment object and output file.
         interval (int): The time interval for the experiment.
-        PID (int): The process ID of the running experiment.
+        PID (int): The process ID of the acquisition service measuring the experiment.
+        service (str): The token of that service, which adopts experiments by token (see acquisition.py).
         path (str): The path to the output file.
-        all_ports (list): A list of Port instances involved in the experiment.
+        all_ports (list): A list of Port instances involved in the experiment, reference ports last.
+        reference_ports (list): Ports of all_ports shared with other experiments, e.g. a blank tube.
+        profile (dict): Arguments for measure_voltage. See timecourse.ACQUISITION_PROFILES.
+        policy (str): What to do about timepoints that overrun later ones. See scheduler.POLICIES.
     """
     all = []
+    registry = {}
     
-    def __init__(self, name:str, interval:int, test_ports:list, outfile) -> None:
+    def __init__(self, name:str, interval:int, test_ports:list, outfile, profile:dict = None, policy:str = DEFAULT_POLICY,
+                 reference_ports:list = None) -> None:
         """
         Initializes an Experiment instance.
 
@@ -50,14 +67,23 @@ class Experiment:
             interval (int): The time interval for the experiment.
             test_ports (list): A list of Port instances used in the experiment.
             outfile (str): The path to the output file.
+            profile (dict): Arguments for measure_voltage. Defaults to the "Standard" acquisition profile.
+            policy (str): "skip" or "catch up" missed timepoints.
+            reference_ports (list): Port instances shared with other experiments (see Port.reference_ports()).
+                                    The acquisition service reads a shared port once for all experiments due
+                                    at the same moment with the same profile, otherwise once per experiment.
         """        
         self.name = name
         self.interval = interval
         self.PID = None
+        self.service = None
         self.path = outfile 
+        self.profile = profile or ACQUISITION_PROFILES[DEFAULT_PROFILE]
+        self.policy = policy
         
         #keep a list of all Port objects used in experiment.
-        self.all_ports = test_ports
+        self.reference_ports = list(reference_ports or [])
+        self.all_ports = list(test_ports) + self.reference_ports
 
     def __eq__(self, other):
         """
@@ -71,6 +97,40 @@ class Experiment:
         """
         return hash((self.name, self.PID))
 
+    def __getstate__(self):
+        """
+        Returns the flat form stored in the config file.
+
+        Ports are stored as [device serial number, device name, position] instead of Port
+        objects, which reference their Device and, through it, 15 other Ports.
+        """
+        state = dict(self.__dict__)
+        for key in ["all_ports", "reference_ports"]:
+            state[key] = [[p.device.sn, p.device.name, p.position] for p in state[key]]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores an Experiment from the config file.
+
+        Ports are looked up in the known Devices (Device.registry), so every Experiment shares
+        Port objects with the rest of the app. Unknown Devices are added.
+        Config files written before the flat form hold Port objects instead, these are converted.
+        """
+        state = dict(state)
+        state.setdefault("reference_ports", [])
+        state.setdefault("service", None)
+        for key in ["all_ports", "reference_ports"]:
+            ports = []
+            for port in state[key]:
+                if isinstance(port, Port):
+                    port = [port.device.sn, port.device.name, port.position]
+                sn, name, position = port
+                device = Device.registry.get(sn) or Device(name, sn)
+                ports.append(device.ports[position - 1])
+            state[key] = ports
+        self.__dict__.update(state)
+
     @staticmethod
     def load_pickle():
         """
@@ -81,29 +141,44 @@ class Experiment:
         Returns:
             dict: The loaded pickled dictionary containing experiment data.
         """        
-        local_pickle = {}
-        
         config_file = get_config_path()
 
-        #load file if it exists
-        if config_file.is_file():
-            with config_file.open('rb') as f:
-                local_pickle = pickle.load(f)
-        
         #write a blank file if it doesn't exist
-        else: 
-            local_pickle = {"Experiments":[],"Experiment_names":[]}
-            Experiment.dump_config(local_pickle)
+        if not config_file.is_file():
+            Experiment.update_config(lambda local_pickle: None)
 
-        #return current pickle, whether empty or full
-        return local_pickle
+        #the file is replaced atomically, so reading doesn't need the lock
+        return config_store.load(config_file)
 
     @staticmethod
     def dump_config(to_dump):
+        """
+        Replaces the whole configuration file. Prefer update_config(), which doesn't lose
+        changes made by other sessions between loading and dumping.
+        """
+        Experiment.update_config(lambda local_pickle: local_pickle.update(to_dump))
+
+    @staticmethod
+    def update_config(change):
+        """
+        Changes the configuration file in one locked transaction.
+
+        Loads the file, applies change(local_pickle) and writes it back atomically, while
+        holding the lock so no other session writes in between. See config_store.py
+
+        Args:
+            change (callable): Modifies the loaded dictionary in place.
+        """
         config_file = get_config_path()
-        with config_file.open('wb') as f:
-            pickle.dump(to_dump, f, pickle.HIGHEST_PROTOCOL)
-        
+        with config_store.locked(config_file):
+            local_pickle = config_store.load(config_file)
+            change(local_pickle)
+            config_store.dump(local_pickle, config_file)
+
+            #cheap to poll for running experiments. See timecourse.kill_switch()
+            write_status(local_pickle["Experiment_names"], config_file)
+
+        #devices didn't change, only experiments did
         Experiment.reconcile_pickle()
 
     @staticmethod
@@ -118,10 +193,10 @@ class Experiment:
         Args:
             experiment (Experiment): The experiment to add to the pickle.
         """
-        local_pickle = Experiment.load_pickle()
-        local_pickle["Experiments"].append(experiment)
-        local_pickle["Experiment_names"].append(experiment.name)
-        Experiment.dump_config(local_pickle)
+        def add(local_pickle):
+            local_pickle["Experiments"].append(experiment)
+            local_pickle["Experiment_names"].append(experiment.name)
+        Experiment.update_config(add)
 
     @staticmethod
     def remove_from_pickle(experiment:object = None):
@@ -133,18 +208,27 @@ class Experiment:
         Args:
             experiment (Experiment): The experiment to remove.
         """
-        local_pickle = Experiment.load_pickle()
-        local_pickle["Experiments"].remove(experiment)
-        local_pickle["Experiment_names"].remove(experiment.name)
-        Experiment.dump_config(local_pickle)
+        def remove(local_pickle):
+            #another session may have removed it already
+            if experiment in local_pickle["Experiments"]:
+                local_pickle["Experiments"].remove(experiment)
+            if experiment.name in local_pickle["Experiment_names"]:
+                local_pickle["Experiment_names"].remove(experiment.name)
+        Experiment.update_config(remove)
 
     def record_usage(self):
         """
-        Marks Port objects as occupied when starting a new experiment.
+        Marks Port objects as occupied when starting a new experiment. See Port.claim()
         """        
-        for p in self.all_ports:
-            p.users.append(self.name)
-            p.usage = 1
+        Port.claim(self.test_ports, self.name)
+        Port.claim(self.reference_ports, self.name, Port.REFERENCE)
+
+    @property
+    def test_ports(self):
+        """
+        The ports of all_ports that aren't shared reference ports.
+        """
+        return self.all_ports[:len(self.all_ports) - len(self.reference_ports)]
 
     def write_outfile_header(self):
         """
@@ -152,33 +236,44 @@ class Experiment:
         
         To be passed to timecourse.py
         """        
-        info = ["#Info:", self.name, self.interval]
+        info = ["#Info:", self.name, self.interval, json.dumps(self.profile), self.policy]
         device_names = ["#Device Names:"] + [port.device.name for port in self.all_ports]
         device_ids = ["#Device IDs:"] + [port.device.sn for port in self.all_ports]
         ports = ["#Ports:"] + [port.position for port in self.all_ports]
-        usage = ["#Usage:"] + [port.usage for port in self.all_ports]
+        usage = ["#Usage:"] + [Port.TEST]*len(self.test_ports) + [Port.REFERENCE]*len(self.reference_ports)
         lines = [info, device_names, device_ids, ports, usage]
 
-        #Print Header to File
-        for line in lines:
-            append_list_to_tsv(line, self.path)
+        #Print Header to File, in one write
+        with OutputWriter(self.path) as writer:
+            writer.write_rows(lines)
 
     def start_subproc(self):
         """
-        Starts a subprocess to run the experiment script.
+        Hands the experiment to the shared acquisition service (acquisition.py).
 
-        Also stores PID in the Experiment object, for monitoring activity.
+        Starts the service if it is not already running. Also stores the service PID and token
+        in the Experiment object, for monitoring activity. The service starts measuring
+        once the experiment appears in the config file.
+        Call while holding the config file lock, see start_experiment().
         """
-        path_to_script = resource_path("timecourse.py")
         pickle_path = get_config_path()
-        #to do: this calls python external to the executable. Can we call the frozen interpreter?
-        #sys.executable, while frozen, calls mtodr.exe, not python.exe. that's why 
-        #terminal shows reload of app after starting new run. 
-        #will runpy do this?
-        command = ["python", path_to_script, self.path, pickle_path]
-        pid = subprocess.Popen(command, creationflags = subprocess.CREATE_NO_WINDOW).pid
+        pid, token = running_service(pickle_path)
+        if pid is None:
+            token = uuid.uuid4().hex
+            path_to_script = resource_path("acquisition.py")
+            #to do: this calls python external to the executable. Can we call the frozen interpreter?
+            #sys.executable, while frozen, calls mtodr.exe, not python.exe. that's why 
+            #terminal shows reload of app after starting new run. 
+            #will runpy do this?
+            command = ["python", path_to_script, pickle_path, token]
+            pid = subprocess.Popen(command, creationflags = subprocess.CREATE_NO_WINDOW).pid
+
+            #written here as well as by the service, so a second experiment
+            #started right away finds this service instead of starting another
+            write_pid_file(pid, token, pickle_path)
         print("pid: ", pid)
         self.PID = pid
+        self.service = token
 
     def start_experiment(self):
         """
@@ -186,14 +281,20 @@ class Experiment:
 
         1. Writes header to output file
         2. Records usage of activated Ports
-        3. Starts new timecourse.py process
+        3. Starts the acquisition service, if necessary
         4. Updates config file with new experiment
         5. Reconciles external/internal states of Experiments vs config file
         """        
         self.write_outfile_header()
         self.record_usage()
-        self.start_subproc()
-        Experiment.add_to_pickle(experiment= self)
+
+        #in one transaction, so an idle service can't exit between being found and being
+        #handed the experiment. See AcquisitionService.retire()
+        def start(local_pickle):
+            self.start_subproc()
+            local_pickle["Experiments"].append(self)
+            local_pickle["Experiment_names"].append(self.name)
+        Experiment.update_config(start)
     
     def stop_experiment(self):
         """
@@ -207,6 +308,14 @@ class Experiment:
         Port.remove_user(self.name)
         Experiment.remove_from_pickle(experiment = self)
         
+        #the shared acquisition service drops experiments removed from the config file
+        #it keeps running for other experiments, so it is not terminated here
+        if self.service is not None:
+            if self.service == running_service()[1]:
+                return(f"{self.name} successfully completed.")
+            #never terminate the PID of a service, it may be a launcher or reused by the OS
+            return("Cant find the PID, it must have already stopped")
+
         #PID could die on unplanned power cycle
         #needed to protect from "PID not found" exception
         try:
@@ -219,7 +328,7 @@ class Experiment:
             return("Cant find the PID, it must have already stopped")
     
     @staticmethod   
-    def reconcile_pickle():
+    def reconcile_pickle(discover:bool = False):
         """
         Reconciles multiple sources of truth regarding the app status.
 
@@ -233,55 +342,44 @@ class Experiment:
 
         This reconciliation processes ensures that only one object exists per 
         identity, and important non-identity information is not lost by deleting duplicates. 
+        Experiments read from the config file already use the known Ports, see __setstate__().
+
+        Only the difference between the config file and memory is applied: experiments
+        already in memory are kept as they are, new ones are adopted and stopped ones dropped.
+
+        Args:
+            discover (bool): Also adopt devices plugged in or out, as found by the device watcher
+                             (see device_watcher.py). Only opens the hardware if the watcher isn't running.
         """
-        pickled_experiments = Experiment.load_pickle()["Experiments"]
-        # selectively merge non-duplicate objects.
-        # nested loops work your way down experiments, devices, objects 
-        # preference given to Experiment.all list
-        # list(set( [a] + [b] )) shows no preference
-        # keyword "in" uses any of "==", "is", "__eq__", etc
-        
-        #reset Devices to only include connected
-        # this doesn't delete Devices contained in 
-        # existing Ports in existing Experiments
-        Device.all = []
-        Device.discovery()
+        pickled_experiments = {(e.name, e.PID): e for e in Experiment.load_pickle()["Experiments"]}
+        changed = False
+
+        #remove stopped experiments
+        for key in [key for key in Experiment.registry if key not in pickled_experiments]:
+            del Experiment.registry[key]
+            changed = True
+
+        #collect from pickle any missing experiments. Preference given to objects already in memory
+        adopted = [e for key, e in pickled_experiments.items() if key not in Experiment.registry]
+        for e in adopted:
+            Experiment.registry[(e.name, e.PID)] = e
+        Experiment.all = list(Experiment.registry.values())
+
+        #forget unplugged Devices, unless ports of a running experiment belong to them
+        if discover:
+            connected = Device.discovery()
+            in_use = {p.device.sn for e in Experiment.all for p in e.all_ports}
+            for sn in [sn for sn in Device.registry if sn not in connected and sn not in in_use]:
+                del Device.registry[sn]
+            changed = True
         
-        #collect form pickle any missing, non-equivalent experiments (if any)
-        for e in pickled_experiments:
-            if e not in Experiment.all:
-                Experiment.all.append(e)
-
-        #Iterate through known experiments
-        for e in Experiment.all:
-            #remove stopped experiments
-            if e not in pickled_experiments:
-                Experiment.all.remove(e)
-                continue 
-            
-            #For all Ports in active Experiments
-            for p in e.all_ports:
-                #check for an existing equivalent device object
-                if p.device not in Device.all:
-                    #since this one has no equivalents, save it
-                    Device.all.append(p.device)
-                    continue
-                
-                #hold on to "is" (memory level) identical Device object
-                known_device = [d for d in Device.all if d == p.device].pop(0)
-
-                #All is well if this "is" the right device
-                if known_device is p.device:
-                    continue
-                
-                #if we've made it this far, the Device is "==" without being "is"
-                #transfer existing port to the appropriate position in the Device.ports list
-                known_device.ports[p.position - 1] = p
-
-                #Assign the corrected parent Device to the Port.device variable
-                p.device = known_device
-
-        #clear and repopulate Ports list from reconciled Device list
-        Port.all = []
-        for d in Device.all:
-            Port.all.extend(*[d.ports])
\ No newline at end of file
+        #mark the Ports of newly adopted Experiments as used, e.g. after restarting the app
+        for e in adopted:
+            changed = True
+            Port.claim([p for p in e.test_ports if e.name not in p.users], e.name)
+            Port.claim([p for p in e.reference_ports if e.name not in p.users], e.name, Port.REFERENCE)
+
+        #repopulate Device and Port lists from the reconciled registry
+        if changed or len(Device.all) != len(Device.registry):
+            Device.all = list(Device.registry.values())
+            Port.index(Device.all)
\ No newline at end of file
@@ -2,16 +2,30 @@ class Port:
     """
     Defines Port class representing a position measure growth of a single tube in a Multi-Tube-OD-Reader.
 
+    Free ports are indexed per device, so the setup page doesn't scan every port of every device:
+    setting `usage` updates the index of ports in Port.all (see Port.index()).
+
     Attributes:
         all (list): A class-level list that holds all Port instances, serving as a registry for all ports.
+        registry (dict): The same Port instances, keyed by (device serial number, position).
+        free (dict): {device serial number: bitmask of unused positions}, bit 0 is port 1.
+        n_free (int): Number of unused ports in Port.all.
+        used_by (dict): {experiment name: list of Ports it uses}.
         users (list): A list of experiment names using this port.
         usage (int): Indicates the current usage of the port:
-            0: Unused
-            1: Used as a test port
+            0: Unused (UNUSED)
+            1: Used as a test port (TEST)
+            2: Used as a reference/blank port, shared by its users (REFERENCE). See reference_ports()
         device (Device): The Device instance to which this port belongs.
         position (int): The physical position of the port on the device (1-16 inclusive).
     """
+    __slots__ = ("users", "_usage", "device", "position")
+    UNUSED, TEST, REFERENCE = 0, 1, 2
     all = [] #registrar
+    registry = {}
+    free = {}
+    n_free = 0
+    used_by = {}
 
     def __init__(self, device, position) -> None:
         """
@@ -22,10 +36,34 @@ class Port:
             position (int): The physical position of the port on the device (1-16 inclusive).
         """        
         self.users = []
-        self.usage = 0
+        self._usage = 0
         self.device = device
         self.position = position
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled Port, including Ports pickled before Port had __slots__ and an index,
+        which stored `usage` directly.
+        """
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        for key, value in state.items():
+            setattr(self, "_usage" if key == "usage" else key, value)
+
+    @property
+    def usage(self):
+        return self._usage
+
+    @usage.setter
+    def usage(self, value):
+        was_free = self._usage == 0
+        self._usage = value
+        #only ports in the index, not copies from the config file or ports of forgotten devices
+        if was_free != (value == 0) and Port.registry.get((self.device.sn, self.position)) is self:
+            bit = 1 << (self.position - 1)
+            Port.free[self.device.sn] ^= bit
+            Port.n_free += 1 if value == 0 else -1
+
     def __eq__(self, other):
         """
         Defines Port identity based on parent Device and Port position.
@@ -41,20 +79,81 @@ class Port:
         """        
         return hash((self.device, self.position))
 
+    @classmethod
+    def index(cls, devices):
+        """
+        Rebuilds Port.all and the indexes (registry, free, used_by) from the ports of some devices.
+
+        Args:
+            devices (list): Device instances, e.g. Device.all.
+        """
+        Port.all = [p for d in devices for p in d.ports]
+        Port.registry = {(p.device.sn, p.position): p for p in Port.all}
+        Port.free = {d.sn: 0 for d in devices}
+        Port.used_by = {}
+        for p in Port.all:
+            if p.usage == 0:
+                Port.free[p.device.sn] |= 1 << (p.position - 1)
+            for name in p.users:
+                Port.used_by.setdefault(name, []).append(p)
+        Port.n_free = sum(mask.bit_count() for mask in Port.free.values())
+
+    @classmethod
+    def free_ports(cls, sn, n = None):
+        """
+        Returns the first `n` (default: all) unused ports of one device, by position.
+        """
+        mask = Port.free.get(sn, 0)
+        ports = []
+        while mask and (n is None or len(ports) < n):
+            low = mask & -mask #lowest set bit
+            ports.append(Port.registry[(sn, low.bit_length())])
+            mask ^= low
+        return ports
+
+    @classmethod
+    def count_free_ports(cls, sn):
+        """
+        Returns the number of unused ports of one device.
+        """
+        return Port.free.get(sn, 0).bit_count()
+
+    @classmethod
+    def reference_ports(cls, sn):
+        """
+        Returns the reference ports of one device, which new experiments can share.
+        """
+        ports = (Port.registry.get((sn, position)) for position in range(1, 17))
+        return [p for p in ports if p is not None and p.usage == Port.REFERENCE]
+
     @classmethod
     def report_available_ports(cls):
         """
         returns list of unused ports
         """
-        return [p for p in Port.all if p.usage == 0]
+        return [p for sn in Port.free for p in Port.free_ports(sn)]
     
     @classmethod
     def count_available_ports(cls):
         """
-        Returns a list of ports that are currently unused.
+        Returns the number of ports that are currently unused.
         """
-        return len(Port.report_available_ports())
-    
+        return Port.n_free
+
+    @classmethod
+    def claim(cls, ports, experiment_name, usage = TEST):
+        """
+        Marks ports as used by an experiment.
+
+        Args:
+            ports (list): The Port instances used by the experiment.
+            experiment_name (str): The name of the experiment.
+            usage (int): Port.TEST, or Port.REFERENCE for ports shared with other experiments.
+        """
+        for p in ports:
+            p.users.append(experiment_name)
+            p.usage = usage
+            Port.used_by.setdefault(experiment_name, []).append(p)
     
     @classmethod
     def remove_user(cls, experiment_name):
@@ -64,11 +163,15 @@ class Port:
         Args:
             experiment_name (str): The name of the experiment to be removed from the port's users.
         """
-        for p in Port.all:
+        #users added without Port.claim() aren't in the index
+        ports = Port.used_by.pop(experiment_name, None)
+        if ports is None:
+            ports = [p for p in Port.all if experiment_name in p.users]
+        for p in ports:
             #remove experiment claiming to use the Port
             if experiment_name in p.users:
                 p.users.remove(experiment_name)
             #if no one's using the Port, mark it as unused
-            #not currently implemented, but useful for ports shared by experiments (such as references)
+            #reference ports stay in use until their last experiment stops
             if not p.users:
                 p.usage = 0
@@ -0,0 +1,139 @@
+"""
+Atomic, lock-protected reads and writes of the config file (config.pkl).
+
+Writers (the app, in every browser session) lock a file next to the config file
+while they load it, change a record and write it back, so concurrent changes aren't lost.
+The lock is an OS advisory lock (fcntl.flock, msvcrt.locking on Windows), which the OS
+releases when a writer crashes, so a lock can't be left over.
+Each write goes to a temporary file that then replaces the config file in one step, so
+readers (the acquisition service, timecourse.kill_switch, other sessions) never see half
+of a file. Readers don't take the lock.
+
+Usage:
+    with locked(path):
+        config = load(path)
+        config["Experiment_names"].append(name)
+        dump(config, path)
+
+Modules imported:
+- dill: Provides serialization and deserialization functions.
+- contextlib.contextmanager: Builds the `locked` context manager.
+- Path from pathlib: A class for working with filesystem paths.
+- fcntl (msvcrt on Windows): Locks the lock file.
+- os, time: Standard library helpers.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+import dill as pickle
+import time
+import os
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_TIMEOUT = 10 #seconds to wait for another writer
+REPLACE_RETRIES = 20 #Windows refuses to replace a file while a reader has it open
+
+def empty():
+    """
+    Returns the contents of a config file without experiments. See Experiment.add_to_pickle()
+    """
+    return {"Experiments": [], "Experiment_names": []}
+
+def _try_lock(f):
+    """
+    Locks an open file without waiting. Raises OSError if another writer holds the lock.
+    """
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock(f):
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def locked(path, timeout = LOCK_TIMEOUT):
+    """
+    Holds the lock of a config file. Only one writer holds it at a time.
+
+    Raises:
+        TimeoutError: If another writer held the lock for longer than `timeout` seconds.
+    """
+    path = Path(path)
+    lock = path.with_name(path.name + ".lock")
+    deadline = time.monotonic() + timeout
+    while True:
+        f = open(lock, "a+b")
+        try:
+            _try_lock(f)
+        except OSError:
+            f.close()
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock {path}, another writer held it for more than {timeout} seconds.")
+            time.sleep(0.01)
+            continue
+        #the previous holder may have removed the lock file after it was opened here
+        try:
+            if os.stat(lock).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+
+    try:
+        yield
+    finally:
+        #removed while still locked, so writers waiting on this file retry with a new one.
+        #Windows doesn't remove files other writers have open, there the file stays
+        if os.name != "nt":
+            try:
+                lock.unlink()
+            except FileNotFoundError:
+                pass
+        _unlock(f)
+        f.close()
+
+def atomic_write(path, data:bytes):
+    """
+    Replaces the contents of a file in one step, by writing a temporary file and renaming it.
+    """
+    path = Path(path)
+    temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with temp.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    for attempt in range(REPLACE_RETRIES):
+        try:
+            os.replace(temp, path)
+            return
+        except PermissionError:
+            if attempt == REPLACE_RETRIES - 1:
+                temp.unlink()
+                raise
+            time.sleep(0.05)
+
+def load(path):
+    """
+    Returns the contents of a config file, or of an empty one if the file doesn't exist.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return empty()
+    with path.open("rb") as f:
+        return pickle.load(f)
+
+def dump(config, path):
+    """
+    Writes a config file atomically. Hold locked(path) while loading, changing and dumping.
+    """
+    atomic_write(path, pickle.dumps(config, pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,125 @@
+"""
+Defines the `ConnectionPool` class for sharing open LabJack U3 connections.
+
+Opening a U3 (USB enumeration) is a large part of each measurement. The pool keeps
+one open connection per serial number and hands it out under a per-device lock,
+so several readers in the same process can take turns on the same hardware.
+Connections that raise an exception are closed and reopened on the next request.
+
+`LabJackPython.Close()` closes every connection in the process. Use
+`ConnectionPool.close()` or `ConnectionPool.close_all()` instead.
+
+Modules imported:
+- backend.u3: Provides the LabJack U3 device interface (or a simulated one).
+- threading: Provides locks for sharing connections between threads.
+- contextlib.contextmanager: Builds the `connection` context manager.
+- logging: Provides logging functionality.
+"""
+
+from contextlib import contextmanager
+import threading
+from backend import u3
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Open U3 connections keyed by serial number.
+
+    Usage:
+        with pool.connection(serialNumber) as d:
+            d.getTemperature()
+
+    Attributes:
+        opener (callable): Opens a connection given a serial number.
+        stats (dict): Counters per serial number:
+            opened: connections opened, including reopens
+            reused: requests served by an already open connection
+            reopened: connections opened to replace one that raised an exception
+            errors: exceptions raised while a connection was in use
+    """
+
+    def __init__(self, opener = None):
+        """
+        Initializes an empty ConnectionPool.
+
+        Args:
+            opener (callable): Opens a connection given a serial number.
+                               Defaults to u3.U3(firstFound = False, serial = serialNumber).
+        """
+        self.opener = opener or (lambda serialNumber: u3.U3(firstFound = False, serial = serialNumber))
+        self.stats = {}
+        self._handles = {}
+        self._locks = {}
+        self._failed = set() #serial numbers whose last connection raised an exception
+        self._registry_lock = threading.Lock()
+
+    def _lock(self, serialNumber):
+        """
+        Returns the lock for one device, creating it if necessary.
+        """
+        with self._registry_lock:
+            if serialNumber not in self._locks:
+                self._locks[serialNumber] = threading.RLock()
+                self.stats[serialNumber] = {"opened": 0, "reused": 0, "reopened": 0, "errors": 0}
+            return self._locks[serialNumber]
+
+    @contextmanager
+    def connection(self, serialNumber):
+        """
+        Yields the open connection to a device while holding that device's lock.
+
+        Opens the connection if necessary. If the body raises an exception, the connection
+        is closed so the next request reopens it, and the exception is re-raised.
+        """
+        with self._lock(serialNumber):
+            stats = self.stats[serialNumber]
+            d = self._handles.get(serialNumber)
+            if d is None:
+                d = self.opener(serialNumber)
+                self._handles[serialNumber] = d
+                stats["opened"] += 1
+                if serialNumber in self._failed:
+                    self._failed.discard(serialNumber)
+                    stats["reopened"] += 1
+            else:
+                stats["reused"] += 1
+
+            try:
+                yield d
+            except Exception:
+                stats["errors"] += 1
+                self._failed.add(serialNumber)
+                self.close(serialNumber)
+                raise
+
+    def close(self, serialNumber):
+        """
+        Closes the connection to one device. Other devices stay connected.
+        """
+        with self._lock(serialNumber):
+            d = self._handles.pop(serialNumber, None)
+            if d is None:
+                return
+            try:
+                d.close()
+            except Exception as e:
+                logger.debug("Could not close %s: %s", serialNumber, e)
+
+    def close_all(self):
+        """
+        Closes all connections in the pool, freeing the hardware for other processes.
+        """
+        for serialNumber in list(self._handles):
+            self.close(serialNumber)
+
+    def is_open(self, serialNumber):
+        """
+        Returns True if the pool holds an open connection to the device.
+        """
+        return serialNumber in self._handles
+
+
+#shared by all measurements in this process
+pool = ConnectionPool()
@@ -0,0 +1,178 @@
+"""
+Defines the `DeviceWatcher` class, which finds connected Multi-Tube-OD-Readers in the background.
+
+Device discovery opens connected U3s to read their names. That takes seconds when a
+device is busy (held by the acquisition service) or was just unplugged, and used to run on
+whatever thread asked for it, including Shiny sessions. The watcher polls on its own thread:
+- every `period` seconds it counts the connected U3s, which doesn't open them
+- only when the count changed it lists their serial numbers
+- names are cached per serial number, so only new devices are opened and asked for theirs
+- devices used by running experiments (`in_use`) are never opened, the acquisition service holds them
+Readers get the latest result (`connected`) without touching the hardware. If a poll
+fails, the previous result is kept and the next poll tries again.
+Devices renamed by this app are updated with renamed(), other renames show up after forget().
+
+LabJack drivers don't report hot-plug events to python, so the watcher polls.
+
+Usage:
+    watcher.start()
+    watcher.snapshot()     -> {serial number: name}
+    watcher.version        -> changes whenever the connected devices change
+
+Modules imported:
+- backend.u3: Provides the LabJack U3 device interface (or a simulated one).
+- threading, time: Run and pace the polls.
+- logging: Provides logging functionality.
+"""
+
+from backend import u3
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+U3_DEVICE_TYPE = 3
+
+class DeviceWatcher:
+    """
+    Background discovery of connected hardware.
+
+    Attributes:
+        period (float): Seconds between polls.
+        in_use (callable): Returns {serial number: name} of the devices used by running experiments.
+        connected (dict): {serial number: name} of connected hardware, as of the last successful poll.
+        version (int): Incremented whenever `connected` changes.
+        last_poll (float): time.monotonic() of the last successful poll, None before.
+    """
+    def __init__(self, period = 5, in_use = None):
+        self.period = period
+        self.in_use = in_use or dict
+        self.connected = {}
+        self.version = 0
+        self.last_poll = None
+        self._count = None #number of devices when they were last opened
+        self._names = {} #{serial number: name}
+        self._lock = threading.Lock() #one poll at a time
+        self._polled = threading.Event() #set after the first poll
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts polling on a daemon thread, unless it is already running.
+        """
+        if self.is_running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = "device watcher", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.is_running():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.period)
+
+    def snapshot(self, timeout = 10):
+        """
+        Returns {serial number: name} of the connected hardware.
+
+        Polls right away if the watcher isn't running. Otherwise waits (at most `timeout` seconds)
+        for the first poll only, and returns the latest result without touching the hardware.
+        """
+        if not self.is_running():
+            self.poll(force = True)
+        else:
+            self._polled.wait(timeout)
+        return dict(self.connected)
+
+    def renamed(self, serialNumber, name):
+        """
+        Updates the cached name of a device renamed by this process. See Device.rename()
+        """
+        with self._lock:
+            self._names[serialNumber] = name
+            if serialNumber in self.connected:
+                self.connected = {**self.connected, serialNumber: name}
+                self.version += 1
+
+    def forget(self):
+        """
+        Drops the cached names and the last result, so the next poll opens every device not in use again.
+        """
+        with self._lock:
+            self._names = {}
+            self.connected = {}
+            self.last_poll = None
+            self._count = None
+            self.version += 1
+
+    def poll(self, force = False):
+        """
+        Checks the connected hardware once.
+
+        Args:
+            force (bool): Open the devices even if their count didn't change.
+
+        Returns:
+            bool: True if the connected devices changed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            try:
+                #counting doesn't open the devices
+                count = u3.deviceCount(U3_DEVICE_TYPE)
+                if not force and count == self._count:
+                    self.last_poll = now
+                    return False
+                connected = self._discover()
+                self._count = count
+            except Exception as e:
+                logger.warning("Device discovery failed, keeping the last result: %s", e)
+                return False
+            finally:
+                self._polled.set()
+
+            self.last_poll = now
+            if connected == self.connected:
+                return False
+            self.connected = connected
+            self.version += 1
+            logger.info("Connected devices: %s", list(connected.values()))
+            return True
+
+    def _discover(self):
+        """
+        Lists the connected U3s and returns {serial number: name}, opening only devices with uncached names.
+
+        Devices used by running experiments are never opened. They are listed even if they aren't
+        found, because the acquisition service holds them.
+        """
+        in_use = self.in_use()
+        connected = dict(in_use)
+        for sn in u3.listAll(U3_DEVICE_TYPE):
+            sn = str(sn)
+            if sn in in_use:
+                continue
+            if sn not in self._names:
+                d = u3.U3(firstFound = False, serial = int(sn))
+                try:
+                    self._names[sn] = d.getName()
+                finally:
+                    #close only the connections opened here. Required to avoid conflicts.
+                    try:
+                        d.close()
+                    except Exception as e:
+                        logger.debug("Could not close %s: %s", d, e)
+            connected[sn] = self._names[sn]
+        return connected
+
+#shared by the whole app, see app.py
+watcher = DeviceWatcher()
@@ -0,0 +1,168 @@
+"""
+Structured log of acquisition errors and terminations, one JSON lines file per run.
+
+Errors used to be saved only as "#..." comment lines between the data rows, which can't be
+counted across runs. They are still written there, and every error is also appended to
+`run.events.jsonl` next to the output file, as one JSON object per line:
+    time: local time of the event (ISO 8601)
+    host: name of the computer running the acquisition
+    run: name of the output file, without extension
+    kind: "error" (a timepoint failed), "stopped" (too many failures), "terminated" (kill switch)
+          or "summary" (written when the run ends)
+    serial: serial number of the device that failed, None if the error isn't tied to a device
+    error: class of the exception, e.g. "LabJackException"
+    message: text of the exception or of the comment line
+    retry: number of consecutive failed timepoints, including this one
+    latency: seconds from the start of the timepoint to the failure
+    attempts: "summary" only, the number of timepoints the device was read for
+
+failure_rates() combines the "summary" and "error" events of many runs into failure rates
+per device and per host.
+
+Usage:
+    events = read_events(folder = get_output_path(), kind = "error")
+    rates = failure_rates(read_events(folder = get_output_path()))
+
+Modules imported:
+- pandas: Events are read into DataFrames.
+- datetime, json, socket: Standard library helpers.
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from datetime import datetime
+from pathlib import Path
+import pandas
+import socket
+import json
+
+SUFFIX = ".events.jsonl"
+COLUMNS = ["time", "host", "run", "kind", "serial", "error", "message", "retry", "latency", "attempts"]
+
+def get_events_path(path):
+    """
+    Returns the path of the event log of an output file (tsv).
+    """
+    path = Path(path)
+    return path.with_name(path.stem + SUFFIX)
+
+class EventLog:
+    """
+    Appends the events of one run to its event log.
+
+    Events are rare, so every event opens, appends to and closes the file.
+
+    Attributes:
+        path (Path): The path to the event log.
+        run (str): Name of the output file, without extension.
+        host (str): Name of this computer.
+        attempts (dict): {device serial number: timepoints read}, written as "summary" events by close().
+    """
+    def __init__(self, path):
+        self.path = get_events_path(path)
+        self.run = Path(path).stem
+        self.host = socket.gethostname()
+        self.attempts = {}
+
+    def attempted(self, serials):
+        """
+        Counts a timepoint for each device read.
+        """
+        for serial in serials:
+            self.attempts[serial] = self.attempts.get(serial, 0) + 1
+
+    def record(self, kind, serial = None, error = None, message = None, retry = 0, latency = None, attempts = None):
+        """
+        Appends one event. See the module docstring for the fields.
+
+        Args:
+            error (Exception): The exception, its class and text are recorded.
+        """
+        event = {"time": datetime.now().isoformat(timespec = "seconds"), "host": self.host, "run": self.run,
+                 "kind": kind, "serial": serial,
+                 "error": type(error).__name__ if error is not None else None,
+                 "message": message if message is not None else (str(error) if error is not None else None),
+                 "retry": retry, "latency": round(latency, 3) if latency is not None else None,
+                 "attempts": attempts}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event) + "\n")
+
+    def record_failure(self, error, readings, retry, latency):
+        """
+        Records a failed timepoint: one event per device that could not be read, or one
+        event without a device if all devices were read (e.g. the output file couldn't be written).
+
+        Args:
+            error (Exception): The exception that failed the timepoint.
+            readings (dict): {device serial number: reading, or the exception if it could not be read}.
+                             See timecourse.read_devices().
+        """
+        failed = {serial: e for serial, e in readings.items() if isinstance(e, Exception)} or {None: error}
+        for serial, e in failed.items():
+            self.record("error", serial = serial, error = e, retry = retry, latency = latency)
+
+    def close(self):
+        """
+        Records how many timepoints each device was read for, once per run.
+        """
+        for serial, attempts in self.attempts.items():
+            self.record("summary", serial = serial, attempts = attempts)
+        self.attempts = {}
+
+def read_events(folder = None, paths = None, kind = None, serial = None, since = None):
+    """
+    Reads the event logs of many runs. Every argument is optional and narrows the search.
+
+    Args:
+        folder: Reads every event log in this folder (e.g. timecourse.get_output_path()).
+        paths (list): Output files (tsv) or event logs, read in addition to `folder`.
+        kind (str): Only events of this kind, see the module docstring.
+        serial (str): Only events of this device.
+        since (str): Only events at or after this time (ISO 8601, e.g. "2026-10-01").
+
+    Returns:
+        pandas.DataFrame: One row per event, with the columns COLUMNS.
+    """
+    logs = sorted(Path(folder).glob("*" + SUFFIX)) if folder is not None else []
+    logs += [Path(p) if str(p).endswith(SUFFIX) else get_events_path(p) for p in paths or []]
+
+    events = []
+    for log in logs:
+        try:
+            with open(log, "r") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue #partly written last line
+        except FileNotFoundError:
+            continue
+    events = pandas.DataFrame(events, columns = COLUMNS)
+    if kind is not None:
+        events = events[events["kind"] == kind]
+    if serial is not None:
+        events = events[events["serial"] == serial]
+    if since is not None:
+        events = events[events["time"] >= since]
+    return events.reset_index(drop = True)
+
+def failure_rates(events):
+    """
+    Counts failed timepoints per device and host.
+
+    Runs that crashed have no "summary" event, so their errors count but their attempts don't.
+
+    Args:
+        events (pandas.DataFrame): See read_events().
+
+    Returns:
+        pandas.DataFrame: Columns host, serial, runs, attempts, errors and failure rate (errors/attempts).
+    """
+    devices = events[events["serial"].notna()]
+    grouped = devices.groupby(["host", "serial"])
+    rates = pandas.DataFrame({
+        "runs": grouped["run"].nunique(),
+        "attempts": grouped["attempts"].sum(min_count = 1).fillna(0).astype(int),
+        "errors": grouped["kind"].apply(lambda kinds: int((kinds == "error").sum())),
+    })
+    rates["failure rate"] = rates["errors"] / rates["attempts"].where(rates["attempts"] > 0)
+    return rates.reset_index()
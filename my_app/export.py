@@ -0,0 +1,80 @@
+"""
+Streaming export of processed experiment data to Excel or CSV files.
+
+Rows are written in chunks straight from the DataFrame, without building a copy of the
+whole table (pandas.ExcelWriter builds every cell of the sheet in memory first). Excel
+files are written with openpyxl in write-only mode, which keeps only the current row in memory.
+
+Exports are slow for long runs, so the app runs them in the background (see
+shiny_modules/display_runs.py). The `progress` dict tells it how far the export got.
+
+Modules imported:
+- openpyxl: Writes Excel files.
+- pandas: Provides DataFrames.
+- Path from pathlib: A class for working with filesystem paths.
+- os: Replaces the output file when the export is complete.
+"""
+
+from openpyxl import Workbook
+from pathlib import Path
+import pandas
+import os
+
+FORMATS = {"xlsx": "Excel", "csv": "CSV"}
+CHUNK_ROWS = 5000
+
+def export_frame(frame, path, sheet_name = "Sheet1", extra_sheets = None, progress = None, chunk_rows = CHUNK_ROWS):
+    """
+    Writes a DataFrame to an Excel (.xlsx) or CSV (.csv) file, chosen by the file extension.
+
+    The file is written under a temporary name and renamed when complete, so a partly
+    written export never replaces a previous one.
+
+    Args:
+        frame (pandas.DataFrame): The data, written with its index like DataFrame.to_excel().
+        path: The path to the output file.
+        sheet_name (str): Name of the sheet holding `frame` (Excel only).
+        extra_sheets (dict): {sheet name: DataFrame} written after `frame` (Excel only).
+        progress (dict): Updated with "rows" (written so far) and "total".
+        chunk_rows (int): Rows written between progress updates.
+
+    Returns:
+        Path: The path to the output file.
+    """
+    path = Path(path)
+    fmt = path.suffix[1:]
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {path.suffix!r}, expected one of {list(FORMATS)}")
+    progress = {} if progress is None else progress
+    progress.update(rows = 0, total = len(frame))
+    temp = path.with_name(f".{path.stem}.tmp{path.suffix}")
+
+    if fmt == "csv":
+        frame.iloc[0:0].to_csv(temp)
+        for start in range(0, len(frame), chunk_rows):
+            frame.iloc[start:start + chunk_rows].to_csv(temp, mode = "a", header = False)
+            progress["rows"] = min(start + chunk_rows, len(frame))
+    else:
+        workbook = Workbook(write_only = True)
+        write_sheet(workbook, sheet_name, frame, progress, chunk_rows)
+        for name, extra in (extra_sheets or {}).items():
+            write_sheet(workbook, name, extra)
+        workbook.save(temp)
+
+    os.replace(temp, path)
+    return path
+
+def write_sheet(workbook, name, frame, progress = None, chunk_rows = CHUNK_ROWS):
+    """
+    Appends a DataFrame as a new sheet of a write-only workbook, index first, like DataFrame.to_excel().
+    """
+    sheet = workbook.create_sheet(name)
+    index_names = [n if n is not None else "" for n in frame.index.names]
+    sheet.append(index_names + [str(c) for c in frame.columns])
+    for start in range(0, len(frame), chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows]
+        for index, row in zip(chunk.index, chunk.itertuples(index = False)):
+            index = list(index) if isinstance(index, tuple) else [index]
+            sheet.append(index + [None if pandas.isna(x) else x for x in row])
+        if progress is not None:
+            progress["rows"] = min(start + chunk_rows, len(frame))
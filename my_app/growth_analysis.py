@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import numpy
 import logging
 from copy import deepcopy
+from archive import read_output_file
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -98,7 +99,7 @@ def analysis_ui():
                     "Save", 
                     ]
 
-    tab_ui_elementsa = [ [ui.input_file("data_file", label = "Select a Data File", accept = ".tsv"), 
+    tab_ui_elementsa = [ [ui.input_file("data_file", label = "Select a Data File", accept = [".tsv", ".gz", ".mtod"]), 
                             ],
                         [ui.output_plot("plot", brush = True),
                             ui.output_table("growth_parameter_table")
@@ -141,7 +142,10 @@ def analysis_server(input, output, session):
     @reactive.calc
     def full_data():
         logging.debug("what is happening here")
-        df = pandas.read_csv(input.data_file()[0]["datapath"], delimiter = "\t",header = 4, comment = "#")
+        #archived runs (.tsv.gz) are decompressed on the fly and binary logs (.mtod) converted,
+        #damaged rows are left out. See archive.read_output_file()
+        #uploads keep the extension of the file, see shiny's FileInfo
+        df = read_output_file(input.data_file()[0]["datapath"], header = 4, comment = "#")
         return df
 
     @reactive.calc
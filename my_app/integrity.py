@@ -0,0 +1,221 @@
+"""
+Sequence numbers and checksums of data rows, and recovery of damaged output files.
+
+Every block of data rows written at once (usually the one row of a timepoint) is preceded by
+a check line, e.g. "#Check:\\t26\\t27\\t1a2b3c4d" for the two rows that follow it:
+- the sequence numbers of the first and last row of the block. Sequence numbers count the
+  data rows of the file from 1, so missing rows show up as gaps
+- the checksum (CRC-32, hex) of the block's rows, joined with "\\n" (without line endings),
+  so damaged rows can be recognized
+Comment lines (events, exceptions) may sit between the rows of a block and aren't covered.
+Data rows stay plain tab separated values, and check lines start with "#" like every other
+comment, so readers that skip comments (pandas.read_csv(..., comment = "#")) don't see them.
+
+Rows written before checksums existed have no check line and are accepted as they are, as
+long as no check line came before them. After the first check line, a data row outside the
+rows announced by a check line is damaged, and so is every row of a block that doesn't match its check line.
+
+A power cut while writing can leave a partly written last line (a torn tail).
+repair_tail() cuts it off before appending to the file (see output_writer.OutputWriter),
+and readers skip damaged rows instead of failing on them (see read_verified()).
+
+Modules imported:
+- pandas: read_verified() returns a DataFrame.
+- zlib: Provides CRC-32.
+- gzip, io, os: Standard library helpers.
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from pathlib import Path
+import pandas
+import zlib
+import gzip
+import io
+import os
+
+CHECK = "#Check:"
+TAIL_BYTES = 65536 #read from the end of a file to find the last sequence number
+
+def checksum(rows:list):
+    """
+    Returns the checksum of data rows (lines without line endings), as 8 hex digits.
+    """
+    crc = zlib.crc32("\n".join(rows).encode())
+    return f"{crc:08x}"
+
+def format_row(row:list):
+    """
+    Returns a data row as a line of the output file (without the newline).
+    """
+    return "\t".join(str(x) for x in row)
+
+def check_line(rows:list, first_sequence:int):
+    """
+    Returns the check line of a block of data rows (lines without line endings).
+    """
+    return "\t".join([CHECK, str(first_sequence), str(first_sequence + len(rows) - 1), checksum(rows)])
+
+def parse_check(line:str):
+    """
+    Returns (first sequence, last sequence, checksum) of a check line, None if it is damaged.
+    """
+    try:
+        mark, first, last, crc = line.split("\t")
+        first, last = int(first), int(last)
+    except ValueError:
+        return None
+    if mark != CHECK or last < first:
+        return None
+    return first, last, crc
+
+
+class RowChecker:
+    """
+    Checks the data rows of an output file, fed one line at a time in file order.
+
+    Attributes:
+        checked (bool): A check line was seen. From then on, every data row must belong to a block.
+        previous (int): Last sequence number of the last intact block, None before.
+        gaps (list): [last sequence number before, first after] for missing rows.
+        block (list): [first, last, checksum, [(line number, row), ...]] of the block being read, None between blocks.
+    """
+    def __init__(self, checked = False, previous = None):
+        self.checked = checked
+        self.previous = previous
+        self.gaps = []
+        self.block = None
+
+    def feed(self, number, line:str):
+        """
+        Checks one line (without line ending).
+
+        Returns:
+            list: (line number, row, ok) for each data row whose check is complete, in file order.
+                  Rows of a block are returned once its last row was read.
+        """
+        if line.startswith(CHECK):
+            done = self.finish()
+            self.checked = True
+            check = parse_check(line)
+            self.block = [*check, []] if check else None
+            return done
+        if not line.strip() or line.startswith("#"):
+            return []
+        if self.block is None:
+            return [(number, line, not self.checked)]
+
+        first, last, crc, rows = self.block
+        rows.append((number, line))
+        if len(rows) < last - first + 1:
+            return []
+        self.block = None
+        ok = checksum([row for n, row in rows]) == crc
+        if ok:
+            if self.previous is not None and first != self.previous + 1:
+                self.gaps.append([self.previous, first])
+            self.previous = last
+        return [(n, row, ok) for n, row in rows]
+
+    def finish(self):
+        """
+        Ends the block being read. Its rows are incomplete, so they are returned as damaged.
+        """
+        rows = self.block[3] if self.block else []
+        self.block = None
+        return [(n, row, False) for n, row in rows]
+
+
+def last_sequence(path):
+    """
+    Returns the last sequence number announced by a check line of an output file, 0 if there is none.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return 0
+    with open(path, "rb") as f:
+        f.seek(max(0, path.stat().st_size - TAIL_BYTES))
+        lines = f.read().decode(errors = "replace").splitlines()
+    for line in reversed(lines):
+        if line.startswith(CHECK):
+            check = parse_check(line)
+            if check is not None:
+                return check[1]
+    return 0
+
+def repair_tail(path):
+    """
+    Cuts off a partly written last line. Don't call it while another process writes to the file.
+
+    Returns:
+        int: The number of bytes cut off.
+    """
+    path = Path(path)
+    size = path.stat().st_size if path.is_file() else 0
+    if size == 0:
+        return 0
+    with open(path, "rb") as f:
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+        #the torn line is shorter than TAIL_BYTES, unless the file is damaged beyond that
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+    keep = size - len(tail) + tail.rfind(b"\n") + 1
+    os.truncate(path, keep)
+    return size - keep
+
+def check_lines(lines):
+    """
+    Checks the data rows among lines of an output file (without newlines).
+
+    Returns:
+        dict: "rows" (intact data rows), "bad" (numbers of lines with damaged rows, from 0),
+              "gaps" ([last sequence number before, first after] for missing rows).
+    """
+    report = {"rows": 0, "bad": [], "gaps": []}
+    checker = RowChecker()
+    for number, line in enumerate(lines):
+        for n, row, ok in checker.feed(number, line):
+            if ok:
+                report["rows"] += 1
+            else:
+                report["bad"].append(n)
+    report["bad"] += [n for n, row, ok in checker.finish()]
+    report["gaps"] = checker.gaps
+    return report
+
+def read_lines(path, compression = None):
+    """
+    Returns the complete lines of an output file, and whether it ends with a torn line.
+    """
+    opener = gzip.open if compression == "gzip" else open
+    with opener(path, "rb") as f:
+        data = f.read()
+    torn = bool(data) and not data.endswith(b"\n")
+    lines = data.decode(errors = "replace").splitlines()
+    return (lines[:-1] if torn else lines), torn
+
+def scan(path, compression = None):
+    """
+    Checks a whole output file. See check_lines().
+
+    Returns:
+        dict: The report of check_lines(), plus "torn" (True if the last line is incomplete).
+    """
+    lines, torn = read_lines(path, compression)
+    report = check_lines(lines)
+    report["torn"] = torn
+    return report
+
+def read_verified(path, compression = None, **kwargs):
+    """
+    Reads an output file with pandas.read_csv, without its damaged rows and torn last line.
+
+    Args:
+        compression (str): "gzip" for archives (see archive.py), None for tsv files.
+        kwargs: Passed to pandas.read_csv.
+    """
+    lines, torn = read_lines(path, compression)
+    bad = set(check_lines(lines)["bad"])
+    text = "".join(line + "\n" for number, line in enumerate(lines) if number not in bad)
+    return pandas.read_csv(io.StringIO(text), **kwargs)
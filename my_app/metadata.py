@@ -0,0 +1,100 @@
+"""
+Fast access to the metadata of output files: the header and the commented out lines.
+
+The header (see Experiment.write_outfile_header) is the first HEADER_LINES lines. Only
+those lines are read, and the result is cached until the file's mtime changes.
+
+The comment index lists the commented out lines after the header: start times, schedule
+events and summaries, exceptions and the reason a run stopped, but not the check lines of
+data rows (see integrity.py). Each call only scans the part of the file added since the previous call.
+
+Modules imported:
+- integrity.CHECK: Marks the check lines of data rows.
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from integrity import CHECK
+from pathlib import Path
+
+HEADER_LINES = 5
+
+#{path: (mtime, header)}, see read_header()
+_header_cache = {}
+
+#{path: {"offset": bytes scanned, "line": lines scanned, "entries": [...]}}, see comment_index()
+_comment_cache = {}
+
+def read_header(path):
+    """
+    Returns the header lines of an output file, each as a list of tab separated fields.
+
+    Example: [["#Info:", "name", "10", ...], ["#Device Names:", ...], ...]
+    """
+    path = Path(path)
+    mtime = path.stat().st_mtime_ns
+    cached = _header_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    header = []
+    with open(path, "r") as f:
+        for x in range(HEADER_LINES):
+            line = f.readline()
+            if not line.endswith("\n"):
+                break
+            header.append(line.rstrip("\n").split("\t"))
+
+    #don't cache a header that is still being written
+    if len(header) == HEADER_LINES:
+        _header_cache[path] = (mtime, header)
+    return header
+
+def comment_kind(line:str):
+    """
+    Classifies a commented out line of an output file.
+
+    Returns:
+        str: "start", "event", "schedule", "terminated", "stopped" or "exception".
+    """
+    if line.startswith("#Start Time:"):
+        return "start"
+    if line.startswith("#Event:"):
+        return "event"
+    if line.startswith("#Schedule:"):
+        return "schedule"
+    if line.lower().startswith("#self terminating"):
+        return "terminated"
+    if line.startswith("#Stopping timecourse"):
+        return "stopped"
+    return "exception"
+
+def comment_index(path):
+    """
+    Lists the commented out lines after the header of an output file.
+
+    Returns:
+        list: One dict per line: "line" (number, from 0), "offset" (bytes), "kind" (see comment_kind()),
+              "fields" (the tab separated fields). Don't modify it, it is cached.
+    """
+    path = Path(path)
+    cache = _comment_cache.get(path)
+    if cache is None or path.stat().st_size < cache["offset"]:
+        #new or replaced file
+        cache = _comment_cache[path] = {"offset": 0, "line": 0, "entries": []}
+
+    with open(path, "rb") as f:
+        f.seek(cache["offset"])
+        new = f.read()
+
+    #a partly written last line is scanned next time
+    end = new.rfind(b"\n") + 1
+    offset = cache["offset"]
+    for raw in new[:end].splitlines(keepends = True):
+        if cache["line"] >= HEADER_LINES and raw.startswith(b"#") and not raw.startswith(CHECK.encode()):
+            line = raw.decode().rstrip("\r\n")
+            cache["entries"].append({"line": cache["line"], "offset": offset,
+                                     "kind": comment_kind(line), "fields": line.split("\t")})
+        cache["line"] += 1
+        offset += len(raw)
+    cache["offset"] = offset
+    return cache["entries"]
@@ -0,0 +1,177 @@
+"""
+Defines the `OutputWriter` class for writing the tsv output file of a run.
+
+The writer keeps the file open between timepoints instead of opening and closing it for
+every line. Lines are buffered and written together by flush(), once per timepoint, so a
+data row and its comment/event lines cost a single write.
+
+fsync policy: flush() hands the lines to the OS every time, so the live plot sees each row.
+Forcing them onto the disk (os.fsync) is slow on network shares, so it only happens every
+`fsync_interval` seconds (0 = every flush, None = never, leave it to the OS) and on close().
+
+While a file is open, Windows doesn't let the user rename or delete it, which is how runs
+are stopped by hand (see timecourse.kill_switch). Call idle() before long waits to close it.
+A file this writer already wrote to is never recreated: if it was renamed, moved or deleted,
+flush() raises OutputFileRemoved.
+
+Data rows written with write_data() are numbered, and each flush() writes a check line
+(sequence numbers and checksum, see integrity.py) before the data rows it writes.
+They also go to a columnar sidecar (see sidecar.py), if enabled. A partly written last line,
+left by a crash, is cut off before appending to a file.
+
+Usage:
+    with OutputWriter(path, sidecar = True) as writer:
+        writer.write_data(row)
+        writer.write_row(["#comment"])
+        writer.flush()
+
+Modules imported:
+- sidecar.SidecarWriter: Writes data rows to the columnar sidecar.
+- integrity: Adds sequence numbers and checksums to data rows and repairs torn files.
+- Path from pathlib: A class for working with filesystem paths.
+- os, time: Standard library helpers.
+"""
+
+from sidecar import SidecarWriter
+from integrity import format_row, check_line, last_sequence, repair_tail
+from pathlib import Path
+import time
+import os
+
+DEFAULT_FSYNC_INTERVAL = 60 #seconds
+DEFAULT_HOLD_TIME = 30 #seconds
+
+class OutputFileRemoved(FileNotFoundError):
+    """
+    Raised by OutputWriter.flush() when the output file was renamed, moved or deleted, which stops the run.
+    """
+
+class OutputWriter:
+    """
+    Buffered writer of tab separated lines, appended to one output file.
+
+    Attributes:
+        path (Path): The path to the output file. Created if missing.
+        fsync_interval (float): Seconds between fsyncs, 0 for every flush, None for never.
+        hold_time (float): idle() closes the file for waits longer than this (seconds).
+        sidecar (SidecarWriter): Writer of the columnar sidecar, or None.
+        sequence (int): Sequence number of the last data row, None until the first write_data().
+    """
+    def __init__(self, path, fsync_interval = DEFAULT_FSYNC_INTERVAL, hold_time = DEFAULT_HOLD_TIME, sidecar = False):
+        self.path = Path(path)
+        self.fsync_interval = fsync_interval
+        self.hold_time = hold_time
+        self.sidecar = SidecarWriter(self.path) if sidecar else None
+        self.sequence = None
+        self._written = False #the file was written by this writer, don't recreate it
+        self._file = None
+        self._lines = []
+        self._block = [] #data rows among the buffered lines, see integrity.check_line()
+        self._block_at = 0 #index of the first of them in _lines
+        self._last_sync = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def write_row(self, row:list):
+        """
+        Buffers one line. Nothing is written until flush().
+        """
+        self._lines.append("\t".join(str(x) for x in row) + "\n")
+
+    def write_data(self, row:list):
+        """
+        Buffers one data row (time, temperature, voltages), for the tsv and the sidecar.
+        """
+        #continue the numbering of rows already in the file
+        if self.sequence is None:
+            self.sequence = last_sequence(self.path)
+        self.sequence += 1
+        if not self._block:
+            self._block_at = len(self._lines)
+        self._block.append(format_row(row))
+        self._lines.append(self._block[-1] + "\n")
+        if self.sidecar:
+            self.sidecar.append(row)
+
+    def write_rows(self, rows:list):
+        """
+        Buffers several lines, see write_row().
+        """
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        """
+        Writes the buffered lines, opening the file if needed, and fsyncs according to fsync_interval.
+
+        Raises:
+            OutputFileRemoved: If the file this writer wrote to was renamed, moved or deleted,
+                               whether it is open or was closed by idle(). The buffered lines are dropped.
+        """
+        if not self._lines:
+            return
+        if self._written and not self.path.exists():
+            self._lines = []
+            self._block = []
+            if self.sidecar:
+                self.sidecar.discard()
+            self._close_file()
+            raise OutputFileRemoved(f"{self.path} was renamed, moved or deleted")
+        if self._file is None:
+            repair_tail(self.path)
+            self._file = open(self.path, "a+") # "a+" will append or write file
+
+        if self._block:
+            first = self.sequence - len(self._block) + 1
+            self._lines.insert(self._block_at, check_line(self._block, first) + "\n")
+            self._block = []
+        self._file.write("".join(self._lines))
+        self._lines = []
+        self._file.flush()
+        self._written = True
+
+        now = time.monotonic()
+        if self.fsync_interval is not None and now - self._last_sync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+        #after the tsv, which rebuilds a missing sidecar
+        if self.sidecar:
+            self.sidecar.flush()
+
+    def idle(self, seconds:float):
+        """
+        Closes the file if the next write is more than hold_time away. The next flush() reopens it.
+        """
+        if seconds > self.hold_time:
+            self.close()
+
+    def close(self):
+        """
+        Flushes and fsyncs the buffered lines and closes the file. Lines for a vanished file are dropped.
+        The file is closed even if writing fails, lines that could not be written stay buffered.
+        """
+        try:
+            self.flush()
+            if self._file is not None and self.fsync_interval is not None:
+                os.fsync(self._file.fileno())
+                self._last_sync = time.monotonic()
+        except OutputFileRemoved:
+            pass
+        finally:
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.sidecar:
+            self.sidecar.close()
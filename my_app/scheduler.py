@@ -0,0 +1,150 @@
+"""
+Defines the `Schedule` class for timing the timepoints of an experiment.
+
+Timepoint k is due at starttime + k * interval (its deadline). Deadlines never move,
+so late or failed timepoints don't shift the phase of later timepoints.
+
+A timepoint started more than `tolerance` seconds after its deadline is late.
+A deadline that passes without a timepoint is missed. When a timepoint overruns
+later deadlines, the policy decides what happens to them:
+- "skip": they are recorded as missed. The next timepoint waits for the next deadline.
+- "catch up": they are taken right away, one after another (and recorded as late).
+
+Late and missed timepoints are returned as events, see event_row() for how they are
+saved in the output file.
+
+Modules imported:
+- time: Provides time.monotonic() and time.sleep().
+"""
+
+import time
+
+POLICIES = {"skip": "Skip missed timepoints", "catch up": "Catch up on missed timepoints"}
+DEFAULT_POLICY = "skip"
+
+class Schedule:
+    """
+    Deadlines and punctuality of the timepoints of one experiment.
+
+    Attributes:
+        starttime (float): time.monotonic() of the first deadline.
+        interval (float): Seconds between deadlines.
+        policy (str): What to do about overrun deadlines, one of POLICIES.
+        tolerance (float): Seconds after its deadline a timepoint may start without being late.
+        tick (int): Index of the next timepoint to take.
+        next_time (float): time.monotonic() at which to take the next timepoint.
+                           Later than its deadline while retrying a failed timepoint.
+        taken, late, missed (int): Number of timepoints taken, taken late and missed.
+    """
+    def __init__(self, starttime, interval, policy = DEFAULT_POLICY, tolerance = 1):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {list(POLICIES)}")
+        self.starttime = starttime
+        self.interval = interval
+        self.policy = policy
+        self.tolerance = tolerance
+        self.tick = 0
+        self.next_time = starttime
+        self.taken = 0
+        self.late = 0
+        self.missed = 0
+        self._first_taken = None
+        self._last_taken = None
+
+    def deadline(self, tick = None):
+        """
+        Returns the time.monotonic() at which a timepoint (by default the next one) is due.
+        """
+        tick = self.tick if tick is None else tick
+        return self.starttime + tick * self.interval
+
+    def taken_at(self, started):
+        """
+        Records that the due timepoint was taken and schedules the next one.
+
+        Args:
+            started (float): time.monotonic() when the timepoint started.
+
+        Returns:
+            list: Events (dicts) for a late timepoint and for deadlines missed while taking it.
+        """
+        events = []
+        delay = started - self.deadline()
+        if delay > self.tolerance:
+            self.late += 1
+            events.append({"event": "late", "tick": self.tick, "delay": delay})
+
+        self.taken += 1
+        if self._first_taken is None:
+            self._first_taken = started
+        self._last_taken = started
+        return events + self._advance(time.monotonic())
+
+    def failed_at(self, now, retry_delay):
+        """
+        Schedules a retry of the due timepoint after it failed.
+
+        The timepoint is missed instead if the retry would not happen before the next deadline.
+
+        Args:
+            now (float): time.monotonic() when the timepoint failed.
+            retry_delay (float): Seconds to wait before retrying.
+
+        Returns:
+            list: Events (dicts) for missed deadlines.
+        """
+        retry = now + retry_delay
+        if retry < self.deadline(self.tick + 1):
+            self.next_time = retry
+            return []
+
+        self.missed += 1
+        events = [{"event": "missed", "tick": self.tick, "reason": "failed"}]
+        return events + self._advance(now)
+
+    def _advance(self, now):
+        """
+        Moves on to the next timepoint, skipping past deadlines according to the policy.
+        """
+        self.tick += 1
+        events = []
+        if self.policy == "skip":
+            while self.deadline() < now:
+                self.missed += 1
+                events.append({"event": "missed", "tick": self.tick, "reason": "overrun"})
+                self.tick += 1
+        self.next_time = self.deadline()
+        return events
+
+    def achieved_period(self):
+        """
+        Returns the average seconds between the starts of taken timepoints, or None before the second one.
+        """
+        if self.taken < 2:
+            return None
+        return (self._last_taken - self._first_taken) / (self.taken - 1)
+
+    def wait(self):
+        """
+        Sleeps until the next timepoint should be taken.
+        """
+        time.sleep(max(0, self.next_time - time.monotonic()))
+
+    def summary_row(self):
+        """
+        Returns a commented out line for the output file summarizing the punctuality of the run.
+        """
+        period = self.achieved_period()
+        return ["#Schedule:", f"taken={self.taken}", f"late={self.late}", f"missed={self.missed}",
+                f"interval={round(self.interval, 3)}", f"achieved period={period if period is None else round(period, 3)}"]
+
+def event_row(event):
+    """
+    Returns a commented out line for the output file describing a schedule event.
+
+    The tick is the index of the timepoint, counting from 0 at the start time.
+    Example: ["#Event:", "late", "tick=12", "delay=3.2"]
+    """
+    fields = [f"{key}={round(value, 3) if isinstance(value, float) else value}"
+              for key, value in event.items() if key != "event"]
+    return ["#Event:", event["event"]] + fields
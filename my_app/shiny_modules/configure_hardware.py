@@ -69,12 +69,15 @@ def configure_ui():
     )
 
 @module.server
-def configure_server(input, output, session):
+def configure_server(input, output, session, devices):
     """
     Defines the server logic for configuring hardware.
 
     This function manages interactions with the UI elements, including selecting a device,
     renaming it, and triggering a visual indicator (blinking) on the device.
+
+    Args:
+        devices (reactive): Connected devices, changes when devices are plugged in or out. See app.py
     """    
     @output
     @render.ui
@@ -85,6 +88,8 @@ def configure_server(input, output, session):
         Rendered by:
             ui.output_ui("select_device"): A dropdown menu for selecting a device.
         """        
+        #Recalculate when devices are plugged in or out
+        devices()
         choices = {device.sn:device.name for device in Device.all}
         return ui.input_select("device", "Select a Device to interact with", choices=choices)
 
@@ -107,8 +112,7 @@ def configure_server(input, output, session):
         req(input.new_name() != "")
 
         #find device object with matching serial number (sn)
-        #could create Device.find class function for this.
-        device = next((x for x in Device.all if x.sn == input.device()), None)
+        device = Device.registry.get(input.device())
         
         #print new name to hardware memory and update device object
         device.rename(input.new_name())
@@ -130,5 +134,5 @@ def configure_server(input, output, session):
         with pieces of hardware. 
         """        
         req(input.device())
-        device = next((x for x in Device.all if x.sn == input.device()), None)
+        device = Device.registry.get(input.device())
         device.blink()
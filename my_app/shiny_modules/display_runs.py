@@ -11,16 +11,22 @@ Modules imported:
 - shiny.render: Contains functions for rendering outputs in a Shiny app.
 - shiny.req: A utility function to ensure certain conditions are met before proceeding.
 - timecourse.collect_header: A function for extracting metadata from a header of the output file.
+- tail_reader.TailReader: Reads only the data rows added to the output file since the last update.
+- export.export_frame: Writes the processed data to Excel or CSV files, in chunks.
 - matplotlib.pyplot: Used for creating plots.
 - numpy: Provides mathematical functions including logarithms.
 - pandas: Used for data manipulation and reading/writing data to files.
+- asyncio: Runs exports in a background thread.
 """
 
 from shiny import module, ui, reactive, render, req, Inputs, Outputs, Session
 from timecourse import collect_header
+from tail_reader import TailReader
+from export import export_frame
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas
+import asyncio
 
 
 def v_to_OD(header_path, data, cal_data):
@@ -111,6 +117,7 @@ def accordion_plot_ui(value="value"):
     - a plot of the data (as OD or log10(voltage))
     - a "Stop Run" button
     - an "Export Excel File" button (for ODs. Only raw voltages are automatically stored.)
+    - an "Export CSV File" button (same data as the Excel file, without calibration data)
 
     Args:
         value (str): The value identifier for the accordion panel.
@@ -118,8 +125,9 @@ def accordion_plot_ui(value="value"):
     return ui.accordion_panel(
                         ui.output_text("experiment_name"),
                         ui.output_plot("experimental_plot"),
-                        ui.row(ui.column(6,ui.input_action_button("stop_run", "Stop Run"), align = "center"),
-                               ui.column(6,ui.input_action_button("excel_out", "Export Excel File"), align = "center")),
+                        ui.row(ui.column(4,ui.input_action_button("stop_run", "Stop Run"), align = "center"),
+                               ui.column(4,ui.input_action_button("excel_out", "Export Excel File"), align = "center"),
+                               ui.column(4,ui.input_action_button("csv_out", "Export CSV File"), align = "center")),
                     value= value
                     )
 
@@ -167,17 +175,36 @@ def accordion_plot_server(input, output, session, exp_obj, calibration_path):
         except:
             return None
 
+    #rows processed by v_to_OD so far, only new rows are read and processed
+    reader = TailReader(exp_obj.path)
+    processed = {"output": None, "condition": None, "calibration": None}
+
     @reactive.file_reader(file_path(), interval_secs = 10)
     def data():
         """
-        Reads & processes the Experiment data file. See v_to_OD.
+        Reads & processes the rows added to the Experiment data file. See v_to_OD.
 
         Returns:
             See v_to_OD
         """        
         try:
-            data = pandas.read_csv(file_path(), delimiter="\t", comment="#", header = None)
-            return v_to_OD(file_path(), data, cal_data())
+            calibration = cal_data()
+            if calibration is not processed["calibration"]:
+                #rows processed so far used the previous calibration
+                reader.reset()
+                processed.update(output = None, condition = None, calibration = calibration)
+
+            #the reader only advances once the rows are processed, rows that fail are read again
+            new_rows, restarted = reader.read_new(commit = False)
+            if restarted:
+                processed.update(output = None, condition = None)
+            if not new_rows.empty:
+                new_output, condition = v_to_OD(file_path(), new_rows, calibration)
+                if processed["output"] is not None:
+                    new_output = pandas.concat([processed["output"], new_output], ignore_index = True)
+                processed.update(output = new_output, condition = condition)
+            reader.commit()
+            return processed["output"], processed["condition"]
         except:
             return None, None
         
@@ -232,32 +259,75 @@ def accordion_plot_server(input, output, session, exp_obj, calibration_path):
         return ui.layout_columns(ui.input_action_button("cancel_stop", "Keep Running"),
                                  ui.input_action_button("commit_stop", "Stop Run"))
     
-    @reactive.effect
-    @reactive.event(input.excel_out)
-    def _():
+    #rows written by the running export, see export.export_frame()
+    export_progress = {}
+
+    @reactive.extended_task
+    async def export_task(output, path, sheetname, extra_sheets):
         """
-        Exports the experimental data and calibration data to an Excel file when the 'Export Excel File' button is clicked.
+        Writes the export in a background thread, so the app keeps responding.
+        """
+        return await asyncio.to_thread(export_frame, output, path, sheet_name = sheetname,
+                                       extra_sheets = extra_sheets, progress = export_progress)
+
+    def start_export(extension):
+        """
+        Exports the experimental data (and calibration data, to Excel only) to a file named after the experiment.
+
+        Args:
+            extension (str): ".xlsx" or ".csv", see export.FORMATS
+        """
+        if export_task.status() == "running":
+            ui.notification_show("Still saving the previous export.", type = "warning")
+            return
 
-        The file is named after the experiment and contains the processed data along with calibration data if available.
-        A notification informs user that the file is being saved.
-        """        
-        excel_file_name = "".join((exp_obj.name, ".xlsx"))
-        
         #check if OD or Log10(Voltage)
         output, condition = data()
+        if output is None:
+            ui.notification_show("No data to export yet.", type = "warning")
+            return
         if condition:
             sheetname = "Calibrated ODs"
         else:
             sheetname = "log10(voltage)"
 
-        #save excel file w/interpreted experiment data and calibration data
-        with pandas.ExcelWriter(exp_obj.path.parent / excel_file_name) as writer:
-            output.to_excel(writer, sheet_name = sheetname)
-            if cal_data() is not None:
-                cal_data().to_excel(writer, sheet_name = "Calibration Data")
-        
-        #a temporary notification message in bottom right corner
-        ui.notification_show(f"Saving to {excel_file_name}.", type = "message")
+        #interpreted experiment data and calibration data
+        extra_sheets = {"Calibration Data": cal_data()} if cal_data() is not None else None
+        export_task(output, exp_obj.path.parent / "".join((exp_obj.name, extension)), sheetname, extra_sheets)
+
+    @reactive.effect
+    @reactive.event(input.excel_out)
+    def _():
+        """
+        Exports the experimental data and calibration data to an Excel file when the 'Export Excel File' button is clicked.
+
+        The file contains the processed data along with calibration data if available.
+        """        
+        start_export(".xlsx")
+
+    @reactive.effect
+    @reactive.event(input.csv_out)
+    def _():
+        """
+        Exports the experimental data to a CSV file when the 'Export CSV File' button is clicked.
+        """        
+        start_export(".csv")
+
+    @reactive.effect
+    def _():
+        """
+        Informs the user about the progress of an export, in a notification in the bottom right corner.
+        """
+        status = export_task.status()
+        if status == "running":
+            reactive.invalidate_later(1)
+            rows, total = export_progress.get("rows", 0), export_progress.get("total", 0)
+            ui.notification_show(f"Saving {exp_obj.name}: {rows} of {total} rows.", id = "export",
+                                 type = "message", duration = None)
+        elif status == "success":
+            ui.notification_show(f"Saved {export_task.result().name}.", id = "export", type = "message")
+        elif status == "error":
+            ui.notification_show(f"Could not save {exp_obj.name}.", id = "export", type = "error")
 
             
 
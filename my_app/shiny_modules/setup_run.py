@@ -4,8 +4,11 @@ Shiny "module" for setting up and starting a Multi-Tube-OD-Reacer experiment.
 The module provides input widgets and options for the user to define
 - the experiment name
 - the interval between timepoints
+- the acquisition profile (trading noise for speed of each reading)
+- whether to skip or catch up on timepoints missed while the computer was busy
 - the device to use (in case there are multiple devices connected to the computer)
 - the number of growth tubes to test
+- an optional reference (blank) tube, which later experiments on the same device can share
 
 Controls are enforced to ensure users 
 - can't overwrite existing experiment data files
@@ -16,13 +19,13 @@ Modules imported:
 - classes.device: Contains the Device class for device management.
 - classes.port: Contains the Port class for port management.
 - classes.experiment: Contains the Experiment class for experiment management.
+- timecourse: Provides the acquisition profiles and the output folder.
+- scheduler: Provides the policies for missed timepoints.
 - shiny.module: Provides the ability to define and use Shiny modules.
 - shiny.ui: Contains functions for creating Shiny UI components.
 - shiny.reactive: Provides reactive programming features for Shiny apps.
 - shiny.render: Contains functions for rendering outputs in a Shiny app.
 - shiny.req: A utility function to ensure certain conditions are met before proceeding.
-- Path from pathlib: A class for working with filesystem paths.
-- sys: Provides access to system-specific parameters and functions.
 """
 
 from shiny import module, ui, reactive, render, req
@@ -30,8 +33,8 @@ from shiny_modules.forced_numeric import controlled_numeric_server, controlled_n
 from classes.device import Device
 from classes.port import Port
 from classes.experiment import Experiment
-from pathlib import Path
-import sys
+from timecourse import ACQUISITION_PROFILES, DEFAULT_PROFILE, get_output_path
+from scheduler import POLICIES, DEFAULT_POLICY
 
 def bad_name(st): 
     '''Returns boolean checking if string contains any character other than space, underscore or alphanumeric'''
@@ -117,9 +120,12 @@ def setup_ui():
     #each page can collect a custom list of inputs from the user
     tab_ui_elements = [[ui.input_text("experiment_name", "File Name", placeholder = "--Enter Name Here--", value = None),
                             ui.input_numeric("interval", "Timepoint interval (min)", value = 10),
+                            ui.input_select("profile", "Acquisition profile", choices = list(ACQUISITION_PROFILES), selected = DEFAULT_PROFILE),
+                            ui.input_select("policy", "Missed timepoints", choices = POLICIES, selected = DEFAULT_POLICY),
                        ],
                        [ui.output_ui("choose_device"),
                             controlled_numeric_ui("ports_available"), 
+                            ui.output_ui("choose_reference"),
                        ],
                        [ui.output_text_verbatim("ports_used_text"),
                        ],
@@ -137,7 +143,9 @@ def setup_ui():
                         - Unique file name
                         - No special characters (underscores OK)
                         - Set timepoint interval (in minutes)
+                        - "Fast" profile for short intervals, "Low noise" for dilute cultures
                     2. Choose device and number of tubes
+                        - Optionally a reference (blank) tube, new or shared with running experiments
                     3. Place tubes in assigned ports
                     4. Start the run
                         - Data are deposited into .tsv file
@@ -162,12 +170,13 @@ def setup_ui():
     ),
 
 @module.server
-def setup_server(input, output, session, main_navs):
+def setup_server(input, output, session, main_navs, devices):
     """
     Defines the server logic for setting up and configuring an experiment.
 
     Args:
         main_navs (reactive.Value): Reactive with current active page in main app.
+        devices (reactive): Connected devices, changes when devices are plugged in or out. See app.py
 
     Returns:
         return_home (reactive.Value): Changing this value activates main app to reset main_navigation to "Home"
@@ -192,7 +201,8 @@ def setup_server(input, output, session, main_navs):
             bool: True if on the 'new_experiment' tab, False otherwise.
         """
         if main_navs() == "new_experiment":
-            Experiment.reconcile_pickle()
+            #devices found by the device watcher, doesn't touch the hardware
+            Experiment.reconcile_pickle(discover = True)
             return True
         return False
 
@@ -201,7 +211,7 @@ def setup_server(input, output, session, main_navs):
         """
         Calculates the number of available ports.
 
-        See Port.report_available_ports()
+        See Port.count_available_ports()
 
         Returns:
             int: The number of available ports.
@@ -209,7 +219,7 @@ def setup_server(input, output, session, main_navs):
 
         #Don't recalculate unless user is on this page
         req(nav_on_new_exp() == True)
-        return len(Port.report_available_ports())
+        return Port.count_available_ports()
     
     @reactive.calc
     def devices_available():
@@ -222,9 +232,11 @@ def setup_server(input, output, session, main_navs):
             dict: A dictionary where keys are device serial numbers and values are device names.
         """        
          
-        #Recalculate function as reactive to reset_counter()
+        #Recalculate function as reactive to reset_counter() and to devices plugged in or out
         reset_counter()
-        return {p.device.sn:p.device.name for p in Port.report_available_ports()}
+        devices()
+        #devices with at least one free port, from the index of free ports (see Port.free)
+        return {d.sn:d.name for d in Device.all if Port.count_free_ports(d.sn)}
 
     @reactive.calc
     def max_ports():
@@ -237,8 +249,10 @@ def setup_server(input, output, session, main_navs):
 
         #Recalculate function as reactive to reset_counter()
         reset_counter()
-        ports = [p for p in Port.report_available_ports() if p.device.sn == input.chosen_device()]
-        return len(ports)
+        n = Port.count_free_ports(input.chosen_device())
+
+        #a new reference tube takes one of the free ports
+        return n - 1 if reference_choice() == "new" else n
     
     #returns reactive value, forced to be between 1 and max_ports()
     #max_ports reactive (without parenthesis) is passed to module
@@ -262,6 +276,49 @@ def setup_server(input, output, session, main_navs):
         reset_counter()
         return ui.input_radio_buttons("chosen_device", "Choose a Device", devices_available(), selected = None)
   
+    def reference_choice():
+        """
+        Returns "none", "new", or the position of a shared reference port. See choose_reference()
+        """
+        return input.reference() if "reference" in input else "none"
+
+    @output
+    @render.ui
+    def choose_reference():
+        """
+        Renders radio buttons to choose a reference (blank) tube: none, a new one, or one shared
+        with running experiments on the chosen device. See Port.reference_ports()
+
+        Renderd by:
+            ui.output_ui("choose_reference")
+        """
+
+        #Recalculate function as reactive to reset_counter() and to devices plugged in or out
+        reset_counter()
+        devices()
+        choices = {"none": "None"}
+        #a new reference tube takes a port, and at least one is left for a growth tube
+        if Port.count_free_ports(input.chosen_device()) >= 2:
+            choices["new"] = "New reference tube (later runs can share it)"
+        for p in Port.reference_ports(input.chosen_device()):
+            choices[str(p.position)] = f"Port {p.position}, shared with {', '.join(p.users)}"
+        return ui.input_radio_buttons("reference", "Reference Tube", choices, selected = "none")
+
+    @reactive.calc
+    def assigned_reference_ports():
+        """
+        Returns:
+            list: The reference port (at most one), shared with other experiments.
+        """
+        reset_counter()
+        choice = reference_choice()
+        if choice == "none":
+            return []
+        if choice == "new":
+            #the first free port after the test ports
+            return Port.free_ports(input.chosen_device(), n_ports_requested() + 1)[n_ports_requested():]
+        return [Port.registry[(input.chosen_device(), int(choice))]]
+
     @reactive.calc
     def assigned_test_ports():
         """
@@ -271,9 +328,7 @@ def setup_server(input, output, session, main_navs):
         #Recalculate function as reactive to reset_counter()
         reset_counter()
 
-        all_ports = Port.report_available_ports()
-        ports = [p for p in all_ports if p.device.sn == input.chosen_device()] 
-        return ports[0:n_ports_requested()]
+        return Port.free_ports(input.chosen_device(), n_ports_requested())
     
     @output
     @render.text
@@ -294,6 +349,13 @@ def setup_server(input, output, session, main_navs):
         header = "Place growth tubes in the following ports:"
         lines = [f"Port {port.position} in {port.device.name}" for port in assigned_test_ports()] 
         lines.insert(0, header)
+        if reference_choice() != "none" and not assigned_reference_ports():
+            lines.append("No free port left for the reference tube, choose fewer growth tubes")
+        for port in assigned_reference_ports():
+            if port.users:
+                lines.append(f"Reference: Port {port.position} in {port.device.name}, already in place")
+            else:
+                lines.append(f"Place the reference tube in Port {port.position} in {port.device.name}")
         return "\n".join(lines)
     
     @reactive.calc
@@ -308,14 +370,8 @@ def setup_server(input, output, session, main_navs):
         #Don't recalculate unless user is on this page
         req(nav_on_new_exp() == True)
 
-        #Path changes if frozen by Py
-        if getattr(sys, 'frozen', False):
-            # when running as .exe: .exe and .tsv will be in sibling folders
-            application_path = Path(sys.executable).parents[1]
-        elif __file__:
-            # For non-frozen applications, use __file__ to show source directory
-            application_path = Path(__file__).parents[2]
-        return application_path / "Output Data" / (input.experiment_name()  + ".tsv")
+        #Path changes if frozen by Py, see timecourse.get_output_path()
+        return get_output_path() / (input.experiment_name()  + ".tsv")
     
     @reactive.Effect
     @reactive.event(file_path)
@@ -403,11 +459,25 @@ def setup_server(input, output, session, main_navs):
         See Experiment.start_experiment()
         See Experiment class
         """
+        #the reference tube was chosen, but no port is left for it
+        if reference_choice() != "none" and not assigned_reference_ports():
+            no_reference = ui.modal(
+                "There is no free port left for the reference tube. Choose fewer growth tubes, or no reference tube.",
+                title="No port for the reference tube",
+                easy_close=True,
+                footer=None,
+            )
+            ui.modal_show(no_reference)
+            return
+
         #Initialize the experiment object
         current_run = Experiment(name = input.experiment_name(),
                                  interval = input.interval(),
                                  test_ports = assigned_test_ports(),
-                                 outfile = file_path())
+                                 outfile = file_path(),
+                                 profile = ACQUISITION_PROFILES[input.profile()],
+                                 policy = input.policy(),
+                                 reference_ports = assigned_reference_ports())
         
         #Start the new PID to control the hardware
         current_run.start_experiment()
@@ -434,7 +504,10 @@ def setup_server(input, output, session, main_navs):
         Is activated as part of several cancel or the final commit button.
         """
         ui.update_radio_buttons("chosen_device", selected= None)
+        ui.update_radio_buttons("reference", selected = "none")
         ui.update_text("experiment_name", label = "File Name", placeholder= "--Enter Name Here--", value = "")
+        ui.update_select("profile", selected = DEFAULT_PROFILE)
+        ui.update_select("policy", selected = DEFAULT_POLICY)
         ui.update_navs("setup_run_navigator", selected="info")
 
         #reset switch sends user to main "Home" tab.
@@ -0,0 +1,233 @@
+"""
+Columnar binary copy ("sidecar") of the data rows of an output file.
+
+Next to `run.tsv`, the directory `run.cols` holds one file per column of the data rows,
+each a flat array of little-endian numbers that only ever grows at the end:
+- time.f8: Time (min), float64
+- temp.f4: Temperature, float32
+- 0.f4, 1.f4, ...: Voltage of each port, float32, in the order of the header's "#Ports:" line
+- source.json: Identity of the tsv the sidecar was written for, see tsv_identity()
+
+Readers map only the columns they need (numpy.memmap) instead of parsing the whole tsv.
+The tsv stays the complete record: comment lines (events, exceptions, start times) are
+only in the tsv, and a missing sidecar is rebuilt from it (see SidecarWriter).
+A sidecar can outlive its tsv, e.g. when the user deletes the tsv and starts a run of the same
+name. Readers ignore, and writers rebuild, a sidecar whose identity doesn't match the tsv.
+
+Usage:
+    data = read_sidecar(path, ports = [0, 3], start = 60) #ports 0 and 3, from 1 hour on
+
+Modules imported:
+- numpy: Provides the column arrays and memory mapping.
+- pandas: The reader returns DataFrames, like pandas.read_csv on the tsv.
+- Path from pathlib: A class for working with filesystem paths.
+- shutil, os, json, zlib, logging: Standard library helpers.
+"""
+
+from pathlib import Path
+import numpy as np
+import pandas
+import shutil
+import json
+import zlib
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+TIME = "time.f8"
+TEMPERATURE = "temp.f4"
+IDENTITY = "source.json"
+IDENTITY_BYTES = 4096 #header, start time and first rows, which differ between runs of the same name
+DTYPES = {"f8": np.dtype("<f8"), "f4": np.dtype("<f4")}
+
+def get_sidecar_path(path):
+    """
+    Returns the sidecar directory of an output file.
+    """
+    path = Path(path)
+    return path.with_name(path.stem + ".cols")
+
+def column_files(n_ports):
+    """
+    Returns the file names of the columns of a data row: time, temperature and n_ports voltages.
+    """
+    return [TIME, TEMPERATURE] + [f"{i}.f4" for i in range(n_ports)]
+
+def tsv_identity(path, size = IDENTITY_BYTES):
+    """
+    Returns the identity of an output file: its inode and the checksum of its first `size` bytes.
+
+    Returns:
+        dict: inode, size (bytes checked, at most `size`) and crc, or None if the file is missing or empty.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(size)
+            inode = os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return None
+    if not head:
+        return None
+    return {"inode": inode, "size": len(head), "crc": zlib.crc32(head)}
+
+def sidecar_matches(path):
+    """
+    Returns True if the sidecar of an output file was written for that file, and not for
+    an earlier file of the same name.
+    """
+    try:
+        identity = json.loads((get_sidecar_path(path) / IDENTITY).read_text())
+        return tsv_identity(path, identity["size"]) == identity
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+def read_tsv_rows(path):
+    """
+    Returns the data rows of an output file as a 2D float array (rows, columns).
+    """
+    data = pandas.read_csv(path, delimiter = "\t", comment = "#", header = None)
+    return data.to_numpy(dtype = float)
+
+
+class SidecarWriter:
+    """
+    Appends data rows to the sidecar of one output file. Used by output_writer.OutputWriter.
+
+    The column files are opened on the first flush and stay open until close().
+    If the sidecar can't be written, it is deleted, so readers fall back to the tsv.
+
+    Attributes:
+        path (Path): The path to the output file (tsv).
+        folder (Path): The sidecar directory.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.folder = get_sidecar_path(path)
+        self._files = None
+        self._rows = []
+        self.failed = False
+
+    def append(self, row:list):
+        """
+        Buffers one data row. Nothing is written until flush().
+        """
+        if not self.failed:
+            self._rows.append(row)
+
+    def discard(self):
+        """
+        Drops the buffered rows.
+        """
+        self._rows = []
+
+    def flush(self):
+        """
+        Writes the buffered rows, one column at a time.
+        """
+        if not self._rows:
+            return
+        try:
+            rows = np.asarray(self._rows, dtype = float)
+            self._rows = []
+            if self._files is None:
+                self._open(rows)
+            for column, f in zip(rows.T, self._files):
+                column.astype(DTYPES[Path(f.name).suffix[1:]]).tofile(f)
+                f.flush()
+        except Exception as e:
+            logger.warning("Could not write %s, deleting it: %s", self.folder, e)
+            self._rows = []
+            self.failed = True
+            self.close()
+            shutil.rmtree(self.folder, ignore_errors = True)
+
+    def _open(self, rows):
+        """
+        Opens the column files, first rebuilding the sidecar from the tsv if it is missing
+        (a file written before sidecars existed, or a sidecar deleted after an error) or was
+        written for another tsv (see sidecar_matches()).
+
+        Args:
+            rows (numpy.ndarray): The rows being flushed, already written to the end of the tsv.
+        """
+        names = column_files(rows.shape[1] - 2)
+        if self.folder.is_dir() and not sidecar_matches(self.path):
+            logger.info("%s was written for another %s, rebuilding it", self.folder, self.path.name)
+            shutil.rmtree(self.folder)
+        if not self.folder.is_dir():
+            self.folder.mkdir()
+            existing = read_tsv_rows(self.path)[:-len(rows)]
+            for name, column in zip(names, existing.T):
+                column.astype(DTYPES[name.split(".")[1]]).tofile(self.folder / name)
+            (self.folder / IDENTITY).write_text(json.dumps(tsv_identity(self.path)))
+        else:
+            #drop a row only partly written before a crash, so the columns stay aligned
+            sizes = [(self.folder / name).stat().st_size if (self.folder / name).is_file() else 0 for name in names]
+            n_rows = min(size // DTYPES[name.split(".")[1]].itemsize for size, name in zip(sizes, names))
+            for name, size in zip(names, sizes):
+                if size:
+                    os.truncate(self.folder / name, n_rows * DTYPES[name.split(".")[1]].itemsize)
+        self._files = [open(self.folder / name, "ab") for name in names]
+
+    def close(self):
+        """
+        Writes the buffered rows and closes the column files. The next flush() reopens them.
+        """
+        self.flush()
+        for f in self._files or []:
+            f.close()
+        self._files = None
+
+
+def has_sidecar(path):
+    """
+    Returns True if the output file has a sidecar written for it.
+    """
+    return (get_sidecar_path(path) / TIME).is_file() and sidecar_matches(path)
+
+def read_sidecar(path, ports = None, start = None, end = None, first_row = 0):
+    """
+    Reads data rows of an output file from its sidecar.
+
+    Only the requested columns are read. Rows are selected with the time column, so
+    files holding several runs of the service (time starting at 0 again) work too.
+
+    Args:
+        path: The path to the output file (tsv).
+        ports (list): Indexes (from 0) of the ports to read, in the order of the "#Ports:" line. Default: all.
+        start, end (float): Only rows with start <= Time (min) <= end. Default: all.
+        first_row (int): Skip the rows before this one, e.g. the ones read before. See tail_reader.py
+
+    Returns:
+        pandas.DataFrame: Columns 0 (Time), 1 (Temperature) and 2 + index of each port,
+                          like pandas.read_csv(path, comment = "#", header = None).
+    """
+    folder = get_sidecar_path(path)
+    if ports is None:
+        ports = sorted(int(f.stem) for f in folder.glob("*.f4") if f.stem.isdigit())
+    names = [TIME, TEMPERATURE] + [f"{i}.f4" for i in ports]
+    columns = [memmap(folder / name) for name in names]
+
+    #a row is complete when every column holds it
+    n_rows = min(len(column) for column in columns)
+    first_row = min(first_row, n_rows)
+    times = columns[0][first_row:n_rows]
+    rows = np.ones(n_rows - first_row, dtype = bool)
+    if start is not None:
+        rows &= times >= start
+    if end is not None:
+        rows &= times <= end
+
+    labels = [0, 1] + [2 + i for i in ports]
+    return pandas.DataFrame({label: np.asarray(column[first_row:n_rows][rows], dtype = float)
+                             for label, column in zip(labels, columns)})
+
+def memmap(file):
+    """
+    Maps a column file, ignoring a partly written last value.
+    """
+    dtype = DTYPES[Path(file).suffix[1:]]
+    n = Path(file).stat().st_size // dtype.itemsize
+    if n == 0:
+        return np.empty(0, dtype = dtype)
+    return np.memmap(file, dtype = dtype, mode = "r", shape = (n,))
@@ -0,0 +1,257 @@
+"""
+A simulated stand-in for LabJackPython's `u3` module.
+
+Implements the part of the u3 interface used by this app (U3, openAllU3, listAll, deviceCount, AIN, DAC8, LED)
+for Multi-Tube-OD-Readers that don't exist. Select it with MTOD_BACKEND=simulated (see backend.py).
+
+Each simulated port holds a culture following a logistic growth curve. A port reads
+    blank_voltage * 10**(-OD) + noise
+while DAC0 powers the LEDs and sensors, and about 0 V otherwise.
+
+Settings (see SETTINGS for defaults) come from a JSON file named by the MTOD_SIMULATION
+environment variable, or from configure():
+- devices: {serial number: name} of connected devices. Overrides n_devices.
+- n_devices: number of connected devices, when `devices` is not given.
+- od_start, od_max, rate: logistic growth per port. Rates (per hour) vary between ports by rate_spread.
+- time_scale: simulated seconds per real second, to watch a day of growth in minutes.
+- start: time.time() at which all cultures are inoculated. Defaults to import time.
+- usb_round_trip, conversion_time, quick_conversion_time, long_settling_time: seconds of latency
+  per feedback packet and per AIN command.
+- noise_bits, quick_noise_bits: standard deviation of a reading (in bits) without/with QuickSample.
+- busy_probability: chance that opening a device fails as if another process held it.
+- usb_error_probability: chance that a feedback packet fails.
+- temperature, temperature_drift, drift_period: device temperature (C) oscillating by
+  temperature_drift over drift_period seconds.
+- seed: seed for the growth rates, noise and failures.
+
+Modules imported:
+- numpy: Provides the random number generator.
+- time, os, json, threading: Standard library helpers.
+"""
+
+import numpy as np
+import threading
+import json
+import time
+import os
+
+SETTINGS = {
+    "devices": None,
+    "n_devices": 2,
+    "od_start": 0.05,
+    "od_max": 1.5,
+    "rate": 0.4,
+    "rate_spread": 0.1,
+    "blank_voltage": 2.0,
+    "time_scale": 1.0,
+    "start": time.time(),
+    "usb_round_trip": 0.001,
+    "conversion_time": 0.0007,
+    "quick_conversion_time": 0.0003,
+    "long_settling_time": 0.004,
+    "noise_bits": 4,
+    "quick_noise_bits": 16,
+    "busy_probability": 0.0,
+    "usb_error_probability": 0.0,
+    "temperature": 30.0,
+    "temperature_drift": 0.5,
+    "drift_period": 3600,
+    "seed": 0,
+}
+
+SLOPE = 0.000037231 #volts per bit, uncalibrated U3-LV single ended
+FIRST_SERIAL = 320000001
+
+_names = {} #device names, shared by all connections in this process
+_rng = np.random.default_rng(SETTINGS["seed"])
+_rng_lock = threading.Lock()
+
+class LabJackException(Exception):
+    """
+    Raised like LabJackPython.LabJackException when a simulated device fails.
+    """
+
+def configure(**settings):
+    """
+    Updates SETTINGS and forgets device names set by earlier settings.
+    """
+    global _rng
+    SETTINGS.update(settings)
+    _names.clear()
+    _rng = np.random.default_rng(SETTINGS["seed"])
+
+def devices():
+    """
+    Returns {serial number: name} of the simulated devices.
+    """
+    if SETTINGS["devices"]:
+        connected = {str(sn): name for sn, name in SETTINGS["devices"].items()}
+    else:
+        connected = {str(FIRST_SERIAL + i): f"Simulated {i + 1}" for i in range(SETTINGS["n_devices"])}
+    for sn in connected:
+        _names.setdefault(sn, connected[sn])
+    return {sn: _names[sn] for sn in connected}
+
+def _chance(probability):
+    with _rng_lock:
+        return probability > 0 and _rng.random() < probability
+
+def _noise(std, size):
+    with _rng_lock:
+        return _rng.normal(0, std, size)
+
+def growth_rate(serialNumber, position):
+    """
+    Returns the growth rate (per hour) of the culture in one port. Constant for a given seed.
+    """
+    rng = np.random.default_rng([SETTINGS["seed"], int(serialNumber), position])
+    return SETTINGS["rate"] * (1 + SETTINGS["rate_spread"] * rng.standard_normal())
+
+def optical_density(serialNumber, position, now = None):
+    """
+    Returns the OD of the culture in one port at time.time() `now`.
+    """
+    now = time.time() if now is None else now
+    hours = (now - SETTINGS["start"]) * SETTINGS["time_scale"] / 3600
+    od_start, od_max = SETTINGS["od_start"], SETTINGS["od_max"]
+    return od_max / (1 + (od_max/od_start - 1) * np.exp(-growth_rate(serialNumber, position) * hours))
+
+
+class AIN:
+    """
+    Analog input feedback command. See u3.AIN.
+    """
+    def __init__(self, PositiveChannel, NegativeChannel = 31, LongSettling = False, QuickSample = False):
+        self.positiveChannel = PositiveChannel
+        self.negativeChannel = NegativeChannel
+        self.longSettling = LongSettling
+        self.quickSample = QuickSample
+
+class DAC8:
+    """
+    8 bit DAC feedback command. See u3.DAC8.
+    """
+    def __init__(self, Dac, Value):
+        self.dac = Dac
+        self.value = Value % 256
+
+class LED:
+    """
+    Status LED feedback command. See u3.LED.
+    """
+    def __init__(self, State):
+        self.state = State
+
+
+class U3:
+    """
+    A connection to one simulated device. See u3.U3.
+    """
+    def __init__(self, firstFound = True, serial = None, **kwargs):
+        connected = devices()
+        if serial is None:
+            serial = next(iter(connected), None)
+        if str(serial) not in connected:
+            raise LabJackException(f"Couldn't open device with serial number {serial}")
+        if _chance(SETTINGS["busy_probability"]):
+            raise LabJackException(f"Device {serial} is busy")
+        self.serialNumber = int(serial)
+        self.calData = None
+        self.dacs = [0, 0]
+        self.analog = set()
+
+    def _sn(self):
+        return str(self.serialNumber)
+
+    def close(self):
+        pass
+
+    def getName(self):
+        return _names[self._sn()]
+
+    def setName(self, name = "My U3"):
+        _names[self._sn()] = name
+
+    def configIO(self, FIOAnalog = None, EIOAnalog = None, **kwargs):
+        fio = FIOAnalog or 0
+        eio = EIOAnalog or 0
+        self.analog = {x for x in range(8) if fio & 2**x} | {x + 8 for x in range(8) if eio & 2**x}
+
+    def setDOState(self, ioNum, state = 1):
+        pass
+
+    def voltageToDACBits(self, volts, dacNumber = 0, is16Bits = False):
+        return int(max(min(volts * 51.2, 0xFF), 0))
+
+    def getCalibratedSlopeOffset(self, isLowVoltage = True, isSingleEnded = True, isSpecialSetting = False, channelNumber = 0):
+        return SLOPE, 0
+
+    def binaryListToCalibratedAnalogVoltages(self, bitsList, isLowVoltage = True, isSingleEnded = True, isSpecialSetting = False, channelNumber = 0):
+        return [value * SLOPE for value in bitsList]
+
+    def getTemperature(self):
+        phase = 2 * np.pi * (time.time() - SETTINGS["start"]) / SETTINGS["drift_period"]
+        return float(SETTINGS["temperature"] + SETTINGS["temperature_drift"] * np.sin(phase) + 273.15)
+
+    def getFeedback(self, *commandlist):
+        if len(commandlist) == 1 and isinstance(commandlist[0], list):
+            commandlist = commandlist[0]
+
+        delay = SETTINGS["usb_round_trip"]
+        #commands are recognized by their attributes, so u3's own commands work too
+        for c in commandlist:
+            if hasattr(c, "positiveChannel"):
+                delay += SETTINGS["quick_conversion_time"] if c.quickSample else SETTINGS["conversion_time"]
+                delay += SETTINGS["long_settling_time"] * bool(c.longSettling)
+        time.sleep(delay)
+
+        if _chance(SETTINGS["usb_error_probability"]):
+            raise LabJackException(f"Simulated USB error on device {self.serialNumber}")
+
+        now = time.time()
+        results = []
+        for c in commandlist:
+            if hasattr(c, "dac"):
+                self.dacs[c.dac] = c.value
+                results.append(None)
+            elif hasattr(c, "positiveChannel"):
+                results.append(self._read_bits(c, now))
+            else:
+                results.append(None)
+        return results
+
+    def _read_bits(self, command, now):
+        """
+        Returns the binary reading of one analog input.
+        """
+        volts = 0.01
+        if self.dacs[0] and command.positiveChannel in self.analog:
+            od = optical_density(self._sn(), command.positiveChannel + 1, now)
+            volts = SETTINGS["blank_voltage"] * 10**(-od)
+        std = SETTINGS["quick_noise_bits"] if command.quickSample else SETTINGS["noise_bits"]
+        return float(volts / SLOPE + _noise(std, None))
+
+
+def deviceCount(devType = None):
+    """
+    Returns the number of simulated devices, without opening them. See LabJackPython.deviceCount.
+    """
+    return len(devices())
+
+def listAll(deviceType = 3, connectionType = 1):
+    """
+    Lists the simulated devices by serial number, without opening them. See LabJackPython.listAll.
+    """
+    return {int(sn): {"serialNumber": int(sn), "devType": deviceType} for sn in devices()}
+
+def openAllU3():
+    """
+    Opens every simulated device. See u3.openAllU3.
+    """
+    return {sn: U3(firstFound = False, serial = sn) for sn in devices()}
+
+
+#settings file, so the app and the acquisition service simulate the same devices
+if os.environ.get("MTOD_SIMULATION"):
+    with open(os.environ["MTOD_SIMULATION"]) as f:
+        configure(**json.load(f))
@@ -0,0 +1,164 @@
+"""
+Defines the `TailReader` class for reading only the data rows added to an output file.
+
+The live plot (see shiny_modules/display_runs.py) used to reread and reprocess the whole
+output file whenever it grew by one row. A TailReader remembers how far it has read:
+- from the columnar sidecar (see sidecar.py), by number of rows
+- otherwise from the archive of an ended run (see archive.read_output_file), by number of rows
+- otherwise from the tsv, by byte offset, parsing only the complete lines after it. Rows
+  are returned once the whole block announced by their check line (see integrity.py) was written.
+
+Usage:
+    reader = TailReader(path)
+    new_rows, restarted = reader.read_new()
+
+    #advance only once the rows were processed, so rows that fail are read again
+    new_rows, restarted = reader.read_new(commit = False)
+    process(new_rows)
+    reader.commit()
+
+Modules imported:
+- sidecar: Reads rows from the columnar copy of the output file.
+- archive: Reads the archive of an ended run.
+- integrity.RowChecker: Checks the checksums of rows read from the tsv.
+- pandas: Rows are returned as DataFrames, like pandas.read_csv(path, comment = "#", header = None).
+- Path from pathlib: A class for working with filesystem paths.
+"""
+
+from sidecar import has_sidecar, read_sidecar, get_sidecar_path, TIME, DTYPES
+from archive import is_archived, read_output_file
+from integrity import RowChecker
+from pathlib import Path
+import pandas
+
+class TailReader:
+    """
+    Incremental reader of the data rows of one output file.
+
+    Attributes:
+        path (Path): The path to the output file (tsv).
+        source (str): "sidecar", "archive" or "tsv", chosen on every read, None before.
+        n_rows (int): Number of data rows read so far.
+        offset (int): Bytes of the tsv read so far.
+        bad_rows (int): Number of damaged rows skipped in the tsv (see integrity.py).
+        checked (bool): The tsv has check lines before the offset, see integrity.RowChecker.
+        sequence (int): Last sequence number before the offset, None before.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.source = None
+        self.n_rows = 0
+        self.offset = 0
+        self.bad_rows = 0
+        self.checked = False
+        self.sequence = None
+        self._pending = None
+
+    def reset(self):
+        """
+        Starts over, so the next read returns every row.
+        """
+        self.source = None
+        self.n_rows = 0
+        self.offset = 0
+        self.bad_rows = 0
+        self.checked = False
+        self.sequence = None
+        self._pending = None
+
+    def commit(self):
+        """
+        Advances past the rows returned by the last read_new(commit = False).
+        """
+        if self._pending is not None:
+            self._restore(self._pending)
+            self._pending = None
+
+    def read_new(self, commit = True):
+        """
+        Reads the data rows added since the last call.
+
+        Args:
+            commit (bool): Advance past the rows read. If False, the next call returns them again,
+                           unless commit() is called in between.
+
+        Returns a tuple:
+            First element: pandas.DataFrame of the new rows (columns 0, 1, 2...), possibly empty.
+            Second element: True if reading started over, because the file or sidecar was
+                            replaced, shrank or disappeared. Discard rows read before.
+        """
+        state = self._state()
+        restarted = False
+        if has_sidecar(self.path):
+            source = "sidecar"
+        elif is_archived(self.path):
+            source = "archive"
+        else:
+            source = "tsv"
+        if source != self.source or self._shrank(source):
+            restarted = self.source is not None
+            self.source = source
+            self.n_rows = 0
+            self.offset = 0
+            self.bad_rows = 0
+            self.checked = False
+            self.sequence = None
+
+        if source == "sidecar":
+            new_rows = read_sidecar(self.path, first_row = self.n_rows)
+        elif source == "archive":
+            #up to date, so it only has new rows the first time
+            new_rows = read_output_file(self.path, comment = "#", header = None).iloc[self.n_rows:]
+        else:
+            new_rows = self._read_tsv()
+        self.n_rows += len(new_rows)
+
+        self._pending = self._state()
+        if commit:
+            self.commit()
+        else:
+            self._restore(state)
+        return new_rows, restarted
+
+    def _state(self):
+        return (self.source, self.n_rows, self.offset, self.bad_rows, self.checked, self.sequence)
+
+    def _restore(self, state):
+        self.source, self.n_rows, self.offset, self.bad_rows, self.checked, self.sequence = state
+
+    def _shrank(self, source):
+        if source == "sidecar":
+            size = (get_sidecar_path(self.path) / TIME).stat().st_size
+            return size // DTYPES["f8"].itemsize < self.n_rows
+        if source == "archive":
+            return False
+        return self.path.stat().st_size < self.offset
+
+    def _read_tsv(self):
+        """
+        Parses the complete lines after the offset. A partly written last line, and the rows of a block
+        that isn't complete yet, are left for the next call. Damaged rows are skipped.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            new = f.read()
+        end = new.rfind(b"\n") + 1
+
+        checker = RowChecker(self.checked, self.sequence)
+        rows = []
+        position = 0
+        done = 0 #bytes read up to the end of the last complete block
+        for line in new[:end].split(b"\n")[:-1]:
+            position += len(line) + 1
+            for number, row, ok in checker.feed(None, line.decode(errors = "replace").rstrip("\r")):
+                try:
+                    if not ok:
+                        raise ValueError(row)
+                    rows.append([float(x) for x in row.split("\t")])
+                except ValueError:
+                    self.bad_rows += 1
+            if checker.block is None:
+                done = position
+        self.offset += done
+        self.checked, self.sequence = checker.checked, checker.previous
+        return pandas.DataFrame(rows)
@@ -1,28 +1,59 @@
-from unittest.mock import MagicMock
-from device import Device
-from experiment import Experiment
-from port import Port
-from timecourse import CONFIG_PATH, resource_path, measure_temp, measure_voltage, per_iteration
-from timecourse import get_measurement_row, append_list_to_tsv, kill_switch, lists_to_dictlist
-import timecourse
-import random
+import os
+os.environ["MTOD_BACKEND"] = "simulated" #must be set before importing backend.py
+
+from classes.device import Device
+from classes.experiment import Experiment
+from classes.port import Port
+from connections import ConnectionPool
+from timecourse import measure_voltage, get_measurement_row, lists_to_dictlist, collect_header, collect_profile
+from timecourse import collect_policy, kill_switch, write_status, read_status
+from timecourse import ACQUISITION_PROFILES
+from scheduler import Schedule, event_row
+from output_writer import OutputWriter, OutputFileRemoved
+from acquisition import AcquisitionService, ScheduledRun, write_pid_file, read_pid_file
+from sidecar import read_sidecar, get_sidecar_path, has_sidecar
+from tail_reader import TailReader
+from binary_log import tsv_to_log, log_to_tsv, open_log, read_timepoint
+from metadata import read_header, comment_index
+from archive import archive_run, read_archive, read_output_file, is_archived
+from export import export_frame
+from catalog import Catalog
+from integrity import scan, read_verified, last_sequence, checksum, check_line
+from events import EventLog, read_events, failure_rates
+from device_watcher import DeviceWatcher, watcher
+import pandas
+import gzip
+import dill as pickle
+from concurrent.futures import ThreadPoolExecutor
+import config_store
+import simulated_u3
+import pytest
 import time
-import sys
 
 """
 The goal is to be able to do everything that the app does but without shiny
 Then pull in the functions into the shiny app
 Shiny is mostly a navigation and display system, not a data handler system
-"""
 
+Hardware is replaced by simulated_u3 (see backend.py).
+"""
 
-def test_device_and_port_init():
+@pytest.fixture(autouse = True)
+def reset():
     """
-    if the devices is created outside of this function, it is duplicated
-    this leaves 2 devices in Device.alls and 32 ports in Port.all
-    watch out for this. It may be just this script or in the app too.
+    Starts every test with two simulated devices and no known Devices, Ports or Experiments.
     """
-    d = Device("Jason", 1323401)
+    simulated_u3.configure(n_devices = 2, devices = None, usb_error_probability = 0, busy_probability = 0)
+    Device.all = []
+    Device.registry = {}
+    Port.index([])
+    Experiment.all = []
+    Experiment.registry = {}
+    watcher.forget()
+    yield
+
+def test_device_and_port_init():
+    d = Device("Jason", "1323401")
     d.ports[11].usage = 1
     d.ports[11].users.append("test")
     n = 8
@@ -30,8 +61,6 @@ def test_device_and_port_init():
     assert type(d.ports[0]) == Port
     assert d.ports[6].device is d
     assert d.ports[6].device.ports[2].device is d #that's cool!
-    assert type(Port.all) is list
-    assert d.ports[n] in Port.all
     assert d.ports[1].usage == 0
     assert d.ports[9].users == []
     assert d.ports[11].usage == 1
@@ -39,95 +68,612 @@ def test_device_and_port_init():
     assert d.ports[1].position == 2
     assert type(d.ports[1].position) == int
     assert Device.all[0] is d
-    assert len(Port.all) == 16
     assert len(Device.all) == 1
-    assert [p for p in Port.all if p.usage == 1] == [d.ports[11]]
-    #NEED TO MAKE TEMP FOLDER FOR tests assert load_pickle()=={"Devices":[],"Experiments":[],"Experiment_names":[]}
-    
-def test_pickle_methods():
-    d = Device.all[0] 
-    d2 = Device("gamble", 320218)
-    assert d.__class__.__name__ == "Device"
-    Experiment.add_to_pickle(device = d) 
-    devices = Experiment.load_pickle()["Devices"]
-    Experiment.reconcile_pickle()
-    devices = Experiment.load_pickle()["Devices"]
-    assert len(devices) == 2
-    
+    assert [p for p in d.ports if p.usage == 1] == [d.ports[11]]
+
 def test_port_methods():
-    """
-    Don't make new d, call it from the class variable. 
-    It passes from one method to another, saved in the Class itself
-    """
-    d = Device.all[0] 
-    n = 3
-    assert len(Device.all) == 2
-    assert d.ports[n].position == n+1
-    assert len(Port.all) == 32
-    assert len(Device.all) == 2
+    d = Device("Jason", "1323401")
+    Port.index([d])
+    d.ports[11].usage = 1
+    d.ports[11].users.append("test")
     assert Port.report_available_ports() == [p for p in Port.all if p.usage == 0]
-    assert [p.position for p in Port.report_available_ports()] == [1,2,3,4,5,6,7,8,9,10,11,13,14,15,16] + list(range(1,17))
-    assert Port.count_available_ports() == 31
-    assert Port.report_ref_ports() == []
+    assert [p.position for p in Port.report_available_ports()] == [1,2,3,4,5,6,7,8,9,10,11,13,14,15,16]
+    assert Port.count_available_ports() == 15
     Port.remove_user("test")
-    assert Port.count_available_ports() == 32
-    
-def test_device_methods():
-    """
-    these are labJack-specific and require one or more Labjacks to be connrected
-    """
-    pass
-
-def test_experiment():
-    d = Device.all[0]
-    test_ports = d.ports[1:17]
-    ref_port = d.ports[0]
-    t = Experiment("test_experiment", 10, ref_port, test_ports)
-    assert t.name == "test_experiment"
-    assert len(t.test_ports) == 15
-    assert len(t.test_blanks) == 15
-    assert Experiment.all == [t]
-    assert t.blanks_needed() == test_ports + [ref_port]
-    t.start_experiemnt()
-
-
-def test_timecourse_without_device(mocker):
-    def voltages(sn, ports:list):
-        return [random.uniform(0.1, 2.3) for x in ports]
-    def temperature(sn):
-        return random.uniform(220, 400)
-    def output_row(input):
-        return input
-
-    #test utility methods
+    assert Port.count_available_ports() == 16
+
+def test_port_index():
+    rack = [Device(f"reader {i}", str(320000100 + i)) for i in range(20)]
+    Port.index(rack)
+    assert Port.count_available_ports() == 320
+    t = Experiment("test_experiment", 10, Port.free_ports(rack[3].sn, 5), "test_experiment.tsv")
+    t.record_usage()
+    assert [p.position for p in t.all_ports] == [1, 2, 3, 4, 5]
+    assert Port.count_available_ports() == 315
+    assert Port.count_free_ports(rack[3].sn) == 11
+    assert [p.position for p in Port.free_ports(rack[3].sn, 2)] == [6, 7]
+    assert Port.report_available_ports() == [p for p in Port.all if p.usage == 0]
+    Port.remove_user("test_experiment")
+    assert Port.count_available_ports() == 320 and Port.used_by == {}
+
+    old = Port.__new__(Port) #pickled before ports had an index
+    old.__setstate__({"users": [], "usage": 1, "device": rack[0], "position": 1})
+    assert old.usage == 1
+    old.usage = 0 #not in the index, doesn't change the counts
+    assert Port.count_available_ports() == 320
+
+def test_lists_to_dictlist():
     keys = ["a","b","c","d", "d", "d"]
     values = [1,2,3,4,5,6]
     assert lists_to_dictlist(keys, values) == {"a":[1], "b":[2], "c":[3], "d":[4,5,6]}
-    
-    #
-    measure_temp = MagicMock(side_effect = temperature)
-    measure_voltage = MagicMock(side_effect = voltages)
-    save_row = MagicMock(side_effect = output_row)
-    sys.exit = MagicMock(side_effect = None)
+
+def test_discovery():
+    simulated_u3.configure(n_devices = 3)
+    Device.discovery()
+    assert [d.name for d in Device.all] == ["Simulated 1", "Simulated 2", "Simulated 3"]
+    Device.all[0].rename("left")
+    assert simulated_u3.devices()[Device.all[0].sn] == "left"
+
+def test_measure_voltage():
+    sn = next(iter(simulated_u3.devices()))
+    pool = ConnectionPool(opener = lambda serialNumber: simulated_u3.U3(serial = serialNumber))
+    voltages = measure_voltage(sn, ports = [1, 2, 16], pool = pool, **ACQUISITION_PROFILES["Fast"])
+    assert len(voltages) == 3
+    assert all(0 < v <= 2.0 for v in voltages)
+    measure_voltage(sn, ports = [1], pool = pool, **ACQUISITION_PROFILES["Fast"])
+    assert pool.stats[sn]["opened"] == 1
+    assert pool.stats[sn]["reused"] == 1
+
+def test_pool_reopens_after_usb_error():
+    sn = next(iter(simulated_u3.devices()))
+    pool = ConnectionPool(opener = lambda serialNumber: simulated_u3.U3(serial = serialNumber))
+    simulated_u3.configure(usb_error_probability = 1)
+    with pytest.raises(simulated_u3.LabJackException):
+        with pool.connection(sn) as d:
+            d.getFeedback([simulated_u3.AIN(0)])
+    assert not pool.is_open(sn)
+    simulated_u3.configure(usb_error_probability = 0)
+    with pool.connection(sn) as d:
+        d.getFeedback([simulated_u3.AIN(0)])
+    assert pool.stats[sn] == {"opened": 2, "reused": 0, "reopened": 1, "errors": 1}
+
+def test_get_measurement_row():
+    sns = list(simulated_u3.devices())
+    test = lists_to_dictlist(sns + sns, ["1", "2", "3", "4"])
     starttime = time.monotonic()
-    d = Device.all[0]
-    test = lists_to_dictlist([d.sn for x in range(1,6)], list(range(1,6)))
-    assert test == {d.sn:list(range(1,6))}
-    spy = mocker.spy(timecourse, "get_measurement_row")
-    per_iteration("test_experiment", starttime, d.sn, 0, test, 2.3, [1,1,1,1,1]) #per_iteration has changed since
-    assert spy.call_count == 1
-    measure_voltage.assert_any_call(d.sn, ports = [0])
-    measure_voltage.assert_called_with(d.sn, ports = list(range(1,6)))
-    measure_temp.assert_called_with(d.sn)
-    sys.exit.assert_not_called()
-    t = Experiment.all[0]
-    t.stop_experiment()
-    per_iteration("test_experiment", starttime, d.sn, 0, test, 2.3, [1,1,1,1,1])
-    sys.exit.assert_called_once()
-    save_row.assert_called_with(["#Self terminating because run was removed from the pickle file."])
+    row = get_measurement_row(test, starttime, ACQUISITION_PROFILES["Fast"])
+    assert len(row) == 2 + 4 #time, temperature, voltages
+    assert 29 < row[1] < 31
+
+def test_schedule_skip(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    s = Schedule(starttime = 100, interval = 10, policy = "skip")
+    now[0] = 135 #reading overran 3 deadlines
+    events = s.taken_at(100.5)
+    assert [e["tick"] for e in events] == [1, 2, 3]
+    assert s.next_time == 140 #phase kept
+    assert s.missed == 3
+    events = s.taken_at(142.5)
+    assert events == [{"event": "late", "tick": 4, "delay": 2.5}]
+    assert event_row(events[0]) == ["#Event:", "late", "tick=4", "delay=2.5"]
+    assert s.achieved_period() == 42
+
+def test_schedule_catch_up_and_retry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    s = Schedule(starttime = 100, interval = 10, policy = "catch up")
+    now[0] = 125
+    assert s.taken_at(100) == []
+    assert s.next_time == 110 #due right away
+    #no time to retry before the next deadline, which is already due
+    assert s.failed_at(125, 2.3) == [{"event": "missed", "tick": 1, "reason": "failed"}]
+    assert s.next_time == 120
+    now[0] = 126
+    assert s.taken_at(125) == [{"event": "late", "tick": 2, "delay": 5}]
+    assert s.failed_at(126, 2.3) == []
+    assert s.next_time == 128.3
+
+def test_kill_switch_reads_status_file(tmp_path):
+    output_file = tmp_path / "run.tsv"
+    output_file.write_text("")
+    pickle_path = tmp_path / "config.pkl"
+    pickle_path.write_bytes(b"not a pickle") #never loaded while the status file exists
+    write_status(["run"], pickle_path)
+    assert read_status(pickle_path) == {"run"}
+    kill_switch(pickle_path, output_file)
+    write_status(["other run"], pickle_path)
+    with pytest.raises(SystemExit):
+        kill_switch(pickle_path, output_file)
+    assert "not found in status.json" in output_file.read_text()
+
+def test_config_store_keeps_concurrent_changes(tmp_path):
+    path = tmp_path / "config.pkl"
+    def add(name):
+        with config_store.locked(path):
+            config = config_store.load(path)
+            time.sleep(0.001) #give other writers a chance to interleave
+            config["Experiment_names"].append(name)
+            config_store.dump(config, path)
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        list(executor.map(add, [f"run {i}" for i in range(16)]))
+    assert sorted(config_store.load(path)["Experiment_names"]) == sorted(f"run {i}" for i in range(16))
+    assert [p.name for p in tmp_path.iterdir()] == ["config.pkl"] #no lock or temporary files left
+
+def test_config_store_lock(tmp_path):
+    path = tmp_path / "config.pkl"
+    (tmp_path / "config.pkl.lock").write_text("12345") #left over by a crashed writer, not locked
+    with config_store.locked(path):
+        with pytest.raises(TimeoutError):
+            with config_store.locked(path, timeout = 0.05):
+                pass
+    with config_store.locked(path, timeout = 0.05):
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+def test_output_writer(tmp_path):
+    path = tmp_path / "run.tsv"
+    writer = OutputWriter(path, fsync_interval = 0)
+    writer.write_row([0.5, 30.0, 1.2])
+    writer.write_row(["#Event:", "late", "tick=1"])
+    assert not path.exists() #buffered until flush
+    writer.flush()
+    assert path.read_text() == "0.5\t30.0\t1.2\n#Event:\tlate\ttick=1\n"
+    writer.idle(5)
+    assert writer.is_open
+    writer.idle(writer.hold_time + 1)
+    assert not writer.is_open
+    writer.write_row([1.5, 30.0, 1.3])
+    writer.flush()
+    path.unlink() #the user stops the run
+    writer.write_row([2.5, 30.0, 1.4])
+    with pytest.raises(FileNotFoundError):
+        writer.flush()
+    assert not path.exists()
+
+    #deleted while closed by idle(): not recreated either
+    writer = OutputWriter(path, fsync_interval = 0)
+    writer.write_data([0.5, 30.0, 1.0])
+    writer.idle(600)
+    path.unlink()
+    writer.write_data([1.5, 30.0, 1.0])
+    with pytest.raises(OutputFileRemoved):
+        writer.flush()
+    assert not path.exists()
+
+def test_sidecar(tmp_path):
+    path = tmp_path / "run.tsv"
+    path.write_text("#Info:\trun\n0.0\t30.0\t1.0\t2.0\t3.0\n") #written before sidecars existed
+    writer = OutputWriter(path, sidecar = True)
+    for minute in range(1, 5):
+        writer.write_data([minute, 30.0, 1.0 + minute, 2.0, 3.0])
+        writer.write_row(["#Event:", "late"])
+        writer.flush()
+    writer.close()
+    assert sorted(f.name for f in get_sidecar_path(path).iterdir()) == ["0.f4", "1.f4", "2.f4", "source.json", "temp.f4", "time.f8"]
+    data = read_sidecar(path)
+    assert list(data.columns) == [0, 1, 2, 3, 4]
+    assert list(data[0]) == [0, 1, 2, 3, 4]
+    data = read_sidecar(path, ports = [0], start = 1.5, end = 3)
+    assert list(data.columns) == [0, 1, 2]
+    assert list(data[2]) == [3.0, 4.0]
+
+    #a new run of the same name doesn't inherit the rows of the deleted one
+    path.unlink()
+    assert not has_sidecar(path)
+    path.write_text("#Info:\trun\n#Start Time:\tlater\n")
+    writer = OutputWriter(path, sidecar = True)
+    writer.write_data([0.0, 31.0, 5.0, 6.0, 7.0])
+    writer.close()
+    assert has_sidecar(path)
+    assert read_sidecar(path).values.tolist() == [[0.0, 31.0, 5.0, 6.0, 7.0]]
+
+def test_tail_reader(tmp_path):
+    path = tmp_path / "run.tsv"
+    path.write_text("#Info:\trun\n0.0\t30.0\t1.0\n1.0\t30.0\t1.1\n2.0\t30")
+    reader = TailReader(path)
+    new_rows, restarted = reader.read_new()
+    assert list(new_rows[0]) == [0.0, 1.0] #partial last line left for later
+    assert not restarted
+    with open(path, "a") as f:
+        f.write(".0\t1.2\n#Event:\tlate\n")
+    assert list(reader.read_new(commit = False)[0][0]) == [2.0]
+    assert list(reader.read_new()[0][0]) == [2.0] #not committed, read again
+    assert reader.read_new()[0].empty
+    with open(path, "a") as f: #a block of two rows, written in two parts
+        f.write(check_line(["2.5\t30.0\t1.25", "2.7\t30.0\t1.27"], 1) + "\n2.5\t30.0\t1.25\n")
+    assert reader.read_new()[0].empty
+    with open(path, "a") as f:
+        f.write("2.7\t30.0\t1.27\n")
+    assert list(reader.read_new()[0][0]) == [2.5, 2.7]
+
+    #a sidecar appears, reading starts over from it
+    with OutputWriter(path, sidecar = True) as writer:
+        writer.write_data([3.0, 30.0, 1.3])
+    new_rows, restarted = reader.read_new()
+    assert restarted and reader.source == "sidecar"
+    assert list(new_rows[0]) == [0.0, 1.0, 2.0, 2.5, 2.7, 3.0]
+    with OutputWriter(path, sidecar = True) as writer:
+        writer.write_data([4.0, 30.0, 1.4])
+    assert list(reader.read_new()[0][0]) == [4.0]
+
+def test_binary_log_round_trip(tmp_path):
+    d = Device("Jason", "1323401")
+    t = Experiment("test_experiment", 10, d.ports[0:2], tmp_path / "run.tsv")
+    t.write_outfile_header()
+    with OutputWriter(t.path) as writer: #one timepoint per flush, as the acquisition service writes them
+        writer.write_row(["#Start Time:", "Sat Oct 17 12:00:00 2026"])
+        writer.write_data([0.0004, 30.01, 1.7821297465906054, 1.1])
+        writer.write_row(["#Event:", "late", "tick=1", "delay=2.5"])
+        writer.flush()
+        writer.write_data([10.0, 30.02, 1.79, 1.2])
+    original = t.path.read_text()
+    log = tsv_to_log(t.path)
+    meta, records = open_log(log)
+    assert records.shape == (2, 4)
+    assert read_timepoint(log, 1) == [10.0, 30.02, 1.79, 1.2]
+    assert meta["comments"][1] == [1, ["#Event:", "late", "tick=1", "delay=2.5"]]
+    t.path.unlink()
+    assert list(read_output_file(t.path, comment = "#", header = None)[0]) == [0.0004, 10.0] #read from the binary log
+    assert log_to_tsv(log).read_text() == original
+
+def test_metadata(tmp_path):
+    d = Device("Jason", "1323401")
+    t = Experiment("test_experiment", 10, d.ports[0:2], tmp_path / "run.tsv")
+    t.write_outfile_header()
+    assert read_header(t.path)[3] == ["#Ports:", "1", "2"]
+    with OutputWriter(t.path) as writer:
+        writer.write_row(["#Start Time:", "Sat Oct 17 12:00:00 2026"])
+        writer.write_data([0.0, 30.0, 1.1, 1.2]) #its check line isn't listed
+        writer.write_rows([["#Event:", "missed", "tick=1"], ["#could not read device"]])
+    assert [e["kind"] for e in comment_index(t.path)] == ["start", "event", "exception"]
+    with OutputWriter(t.path) as writer:
+        writer.write_rows([["#Stopping timecourse due to failures"]])
+    entries = comment_index(t.path)
+    assert entries[-1]["kind"] == "stopped"
+    assert entries[-1]["line"] == 10
+    with open(t.path, "rb") as f:
+        f.seek(entries[-1]["offset"])
+        assert f.readline().startswith(b"#Stopping")
+
+def test_archive(tmp_path):
+    path = tmp_path / "run.tsv"
+    with OutputWriter(path) as writer:
+        writer.write_rows([["#header line"]] * 5 + [["#Start Time:", "now"]])
+        for minute in range(25):
+            writer.write_data([minute, 30.0, 1.0 + minute])
+        writer.write_row(["#Schedule:", "taken=25"])
+    archive = archive_run(path, block_rows = 10)
+    assert is_archived(path)
+    assert gzip.decompress(archive.read_bytes()) == path.read_bytes()
+    assert list(read_archive(archive, start = 12, end = 14.5)[0]) == [12, 13, 14]
+    assert len(read_output_file(path, comment = "#", header = None)) == 25
+    reader = TailReader(path)
+    assert len(reader.read_new()[0]) == 25 and reader.source == "archive"
+    assert reader.read_new()[0].empty
+    with OutputWriter(path) as writer:
+        writer.write_row(["#appended after archiving"])
+    assert not is_archived(path)
+    path.unlink() #the archive is read instead
+    assert list(read_output_file(path, comment = "#", header = None)[0])[-1] == 24
+
+def test_export(tmp_path):
+    frame = pandas.DataFrame({"Time (min)": [0.0, 1.0, 2.0], "temp": [30.0, 30.1, 30.2], "1": [0.1, 0.2, float("nan")]})
+    progress = {}
+    export_frame(frame, tmp_path / "run.csv", progress = progress, chunk_rows = 2)
+    assert (tmp_path / "run.csv").read_text() == frame.to_csv()
+    assert progress == {"rows": 3, "total": 3}
+    calibration = pandas.DataFrame({"slope": [1.5]})
+    export_frame(frame, tmp_path / "run.xlsx", sheet_name = "Calibrated ODs", extra_sheets = {"Calibration Data": calibration})
+    sheets = pandas.read_excel(tmp_path / "run.xlsx", sheet_name = None, index_col = 0)
+    assert list(sheets) == ["Calibrated ODs", "Calibration Data"]
+    pandas.testing.assert_frame_equal(sheets["Calibrated ODs"], frame, check_dtype = False)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["run.csv", "run.xlsx"]
+
+def test_catalog(tmp_path):
+    d = Device("Jason", "1323401")
+    for name, end in [("strain A 1", ["#Stopping timecourse due to failures", "#Schedule:"]),
+                      ("strain A 2", ["#Schedule:"]), ("strain B", [])]:
+        t = Experiment(name, 10, d.ports[0:3], tmp_path / f"{name}.tsv")
+        t.write_outfile_header()
+        with OutputWriter(t.path, sidecar = name == "strain A 2") as writer:
+            writer.write_row(["#Start Time:", "Sat Oct 17 12:00:00 2026"])
+            for minute in range(3):
+                writer.write_data([minute, 30.0, 1.0, 2.0, 3.0 + minute])
+            writer.write_rows([[line] for line in end])
+    catalog = Catalog(tmp_path / "catalog.sqlite", tmp_path)
+    assert catalog.update() == 3
+    assert catalog.update() == 0
+    runs = catalog.runs(name = "strain A%", port = "3")
+    assert list(runs["end_state"]) == ["failed", "completed"]
+    assert list(runs["rows"]) == [3, 3]
+    assert catalog.runs(end_state = "running")["name"].tolist() == ["strain B"]
+    data = catalog.load_series(runs["path"], port = "3", start = 1)
+    assert list(data["voltage"]) == [4.0, 5.0, 4.0, 5.0]
+    (tmp_path / "strain B.tsv").unlink()
+    catalog.update()
+    assert len(catalog.runs()) == 2
+    catalog.close()
+
+def test_integrity(tmp_path):
+    path = tmp_path / "run.tsv"
+    with OutputWriter(path) as writer:
+        writer.write_row(["#Time (min)", "Temp", "1"])
+        for minute in range(4):
+            writer.write_data([minute, 30.0, 1.0 + minute])
+            writer.flush()
+    lines = path.read_text().splitlines()
+    assert lines[3:5] == ["#Check:\t2\t2\t" + lines[3].split("\t")[-1], "1\t30.0\t2.0"]
+    lines[4] = "1\t30.0\t9.0" #damaged row
+    lines.insert(7, "7\t30.0\t7.0") #row without a check line
+    path.write_text("\n".join(lines) + "\n#Check:\t5\t5\t00000000\n4\t30.0\t5.")  #torn last line
+    assert scan(path) == {"rows": 3, "bad": [4, 7], "gaps": [[1, 3]], "torn": True}
+    assert list(read_verified(path, delimiter = "\t", comment = "#", header = None)[2]) == [1.0, 3.0, 4.0]
+    assert last_sequence(path) == 5
+
+    with OutputWriter(path) as writer: #reopening cuts off the torn line and continues the numbering
+        writer.write_data([4, 30.0, 5.0])
+        writer.write_data([5, 30.0, 6.0])
+    assert path.read_text().splitlines()[-3:] == ["#Check:\t6\t7\t" + checksum(["4\t30.0\t5.0", "5\t30.0\t6.0"]),
+                                                  "4\t30.0\t5.0", "5\t30.0\t6.0"]
+    assert scan(path) == {"rows": 5, "bad": [4, 7], "gaps": [[1, 3], [4, 6]], "torn": False}
+
+def test_events(tmp_path):
+    for name, failing in [("run 1", ["320000001"]), ("run 2", [])]:
+        events = EventLog(tmp_path / f"{name}.tsv")
+        for timepoint in range(4):
+            events.attempted(["320000001", "320000002"])
+        for serial in failing:
+            error = ConnectionError("USB timeout")
+            events.record_failure(error, {serial: error, "320000002": (0, 30.0, {})}, retry = 1, latency = 0.25)
+        events.record_failure(PermissionError("file locked"), {"320000001": (0, 30.0, {})}, retry = 2, latency = 0.5)
+        events.close()
+    errors = read_events(folder = tmp_path, kind = "error", serial = "320000001")
+    assert list(errors["error"]) == ["ConnectionError"]
+    assert errors["latency"][0] == 0.25
+    assert read_events(paths = [tmp_path / "run 2.tsv"], kind = "error")["serial"].isna().all()
+    rates = failure_rates(read_events(folder = tmp_path)).set_index("serial")
+    assert list(rates["attempts"]) == [8, 8]
+    assert list(rates["errors"]) == [1, 0]
+    assert rates["failure rate"]["320000001"] == 1/8
+    assert failure_rates(read_events(folder = tmp_path / "missing")).empty
+
+def test_reconcile_pickle(tmp_path, monkeypatch):
+    monkeypatch.setattr("classes.experiment.get_config_path", lambda: tmp_path / "config.pkl")
+    Experiment.reconcile_pickle(discover = True)
+    first, second = Device.all
+    assert len(Port.all) == 32
+    assert Port.registry[(second.sn, 3)] is second.ports[2]
+
+    def no_usb(*args, **kwargs):
+        raise AssertionError("reconcile_pickle touched the hardware")
+    monkeypatch.setattr(simulated_u3, "listAll", no_usb)
+    t = Experiment("test_experiment", 10, first.ports[0:2], tmp_path / "test_experiment.tsv")
+    t.PID = 123
+    Experiment.add_to_pickle(t)
+    adopted = Experiment.registry[("test_experiment", 123)] #the copy read from the config file
+    assert Experiment.all == [adopted] == [t]
+    assert adopted.all_ports[0].device is first and first.ports[0] is adopted.all_ports[0]
+    Experiment.reconcile_pickle()
+    assert Experiment.all[0] is adopted
+    assert Device.all == [first, second]
+
+    monkeypatch.undo()
+    monkeypatch.setattr("classes.experiment.get_config_path", lambda: tmp_path / "config.pkl")
+    simulated_u3.configure(n_devices = 0) #both unplugged, the first is used by the experiment
+    Experiment.reconcile_pickle(discover = True)
+    assert Device.all == [first] and Device.all[0] is first
+    Experiment.remove_from_pickle(t)
+    assert Experiment.all == []
+
+def test_device_watcher(monkeypatch):
+    listed = []
+    list_all = simulated_u3.listAll
+    monkeypatch.setattr(simulated_u3, "listAll", lambda *args: listed.append(1) or list_all(*args))
+    opened = []
+    U3 = simulated_u3.U3
+    monkeypatch.setattr(simulated_u3, "U3", lambda serial = None, **kwargs: opened.append(str(serial)) or U3(serial = serial, **kwargs))
+    w = DeviceWatcher(period = 0.01)
+    assert w.poll()
+    assert list(w.connected.values()) == ["Simulated 1", "Simulated 2"]
+    assert not w.poll() #same number of devices, nothing listed or opened
+    assert len(listed) == 1 and len(opened) == 2
+
+    simulated_u3.configure(n_devices = 3)
+    assert w.poll()
+    assert len(w.connected) == 3 and len(listed) == 2 and len(opened) == 3 #only the new device was opened
+
+    #devices of running experiments are never opened
+    first = next(iter(w.connected))
+    w.in_use = lambda: {first: "Running"}
+    w.forget()
+    opened.clear()
+    assert w.poll() and w.connected[first] == "Running"
+    assert len(opened) == 2 and first not in opened
+
+    def unplugged(*args):
+        raise simulated_u3.LabJackException("device was unplugged")
+    monkeypatch.setattr(simulated_u3, "listAll", unplugged)
+    simulated_u3.configure(n_devices = 2)
+    version = w.version
+    assert not w.poll() #keeps the last result
+    assert w.version == version and len(w.connected) == 3
+    w.in_use = dict
+
+    monkeypatch.setattr(simulated_u3, "listAll", list_all)
+    w.start()
+    time.sleep(0.1)
+    assert len(w.snapshot()) == 2 and w.version == version + 1
+    w.stop()
+    assert not w.is_running()
+
+def test_flat_config(tmp_path, monkeypatch):
+    monkeypatch.setattr("classes.experiment.get_config_path", lambda: tmp_path / "config.pkl")
+    d = Device("Jason", "1323401")
+    Port.index([d])
+    t = Experiment("test_experiment", 10, d.ports[0:2], tmp_path / "test_experiment.tsv")
+    t.record_usage()
+    data = pickle.dumps(t)
+    assert b"classes.device" not in data and b"classes.port" not in data
+    assert pickle.loads(data).all_ports[1] is d.ports[1]
+
+    #config file of an earlier version, holding the Device and Port objects
+    old_device = Device.__new__(Device)
+    old_device.__setstate__({"name": "Jason", "sn": "1323402", "ports": []})
+    old_port = Port.__new__(Port)
+    old_port.__setstate__({"users": ["old"], "usage": 1, "device": old_device, "position": 3})
+    old = Experiment.__new__(Experiment)
+    old.__setstate__({"name": "old", "interval": 10, "PID": None, "path": "old.tsv", "all_ports": [old_port]})
+    assert old.all_ports[0] is Device.registry["1323402"].ports[2]
+
+    #restart: Ports of experiments in the config file are marked as used again
+    Experiment.add_to_pickle(t)
+    Device.all, Device.registry, Experiment.all, Experiment.registry = [], {}, [], {}
+    Port.index([])
+    Experiment.reconcile_pickle()
+    assert [p.usage for p in Experiment.all[0].all_ports] == [1, 1]
+    assert Port.count_available_ports() == 14
+
+def test_shared_reference_port(tmp_path):
+    d = Device("Jason", "1323401")
+    Port.index([d])
+    a = Experiment("a", 10, d.ports[0:2], tmp_path / "a.tsv", reference_ports = [d.ports[15]])
+    a.record_usage()
+    assert Port.reference_ports(d.sn) == [d.ports[15]]
+    b = Experiment("b", 10, Port.free_ports(d.sn, 1), tmp_path / "b.tsv", reference_ports = Port.reference_ports(d.sn))
+    b.record_usage()
+    assert d.ports[15].users == ["a", "b"] and Port.count_free_ports(d.sn) == 12
+    Port.remove_user("a")
+    assert d.ports[15].usage == Port.REFERENCE #still used by b
+
+    requests = []
+    def read_devices(requested, profile = None):
+        requests.append(requested)
+        return {sn: (time.monotonic(), 30.0, {p: float(p) for p in ports}) for sn, ports in requested.items()}
+    service = AcquisitionService(tmp_path / "config.pkl")
+    service.read_devices = read_devices
+    for t in [a, b]:
+        t.write_outfile_header()
+        service.runs[t.name] = ScheduledRun.from_header(t.path, time.monotonic())
+    assert read_header(a.path)[4][1:] == ["1", "1", "2"]
+    service.run_due()
+    for run in service.runs.values():
+        run.writer.close()
+    assert requests == [{"1323401": {"1", "2", "3", "16"}}] #the shared port is read once
+    assert pandas.read_csv(a.path, delimiter = "\t", comment = "#", header = None).iloc[0, 2:].tolist() == [1.0, 2.0, 16.0]
+    assert pandas.read_csv(b.path, delimiter = "\t", comment = "#", header = None).iloc[0, 2:].tolist() == [3.0, 16.0]
+
+def test_shared_reference_port_staggered(tmp_path):
+    d = Device("Jason", "1323401")
+    requests = []
+    def read_devices(requested, profile = None):
+        requests.append(requested)
+        return {sn: (time.monotonic(), 30.0, {p: float(p) + len(requests) for p in ports}) for sn, ports in requested.items()}
+    service = AcquisitionService(tmp_path / "config.pkl")
+    service.read_devices = read_devices
+    for t in [Experiment("a", 10, d.ports[0:2], tmp_path / "a.tsv", reference_ports = [d.ports[15]]),
+              Experiment("b", 10, d.ports[2:3], tmp_path / "b.tsv", reference_ports = [d.ports[15]])]:
+        t.write_outfile_header()
+        service.runs[t.name] = ScheduledRun.from_header(t.path, time.monotonic())
+    a, b = service.runs["a"], service.runs["b"]
+
+    b.schedule.next_time = time.monotonic() + 60 #started later than a
+    service.run_due()
+    b.schedule.next_time = 0
+    service.run_due()
+    assert requests == [{"1323401": {"1", "2", "16"}}, {"1323401": {"3"}}] #b gets a's reading of the shared port
+    a.schedule.next_time = 0
+    service.run_due()
+    assert requests[2] == {"1323401": {"1", "2", "16"}} #read again in a's next tick
+    for run in service.runs.values():
+        run.writer.close()
+    assert pandas.read_csv(b.path, delimiter = "\t", comment = "#", header = None).iloc[0, 2:].tolist() == [5.0, 17.0]
+
+def test_read_times(tmp_path):
+    first, second = Device("Jason", "1323401"), Device("Freddy", "1323402")
+    t = Experiment("t", 10, first.ports[0:1] + second.ports[0:1], tmp_path / "t.tsv")
+    t.write_outfile_header()
+    service = AcquisitionService(tmp_path / "config.pkl")
+    run = service.runs["t"] = ScheduledRun.from_header(t.path, time.monotonic())
+    #the second device was read 6 seconds after the first
+    service.read_devices = lambda requested, profile = None: {"1323401": (run.starttime + 60, 30.0, {"1": 1.0}),
+                                                              "1323402": (run.starttime + 66, 31.0, {"1": 2.0})}
+    service.run_due()
+    run.writer.close()
+    lines = t.path.read_text().splitlines()
+    assert lines[-1] == "#Read Times:\t1323401\t1.0\t1323402\t1.1"
+    assert lines[-2] == "1.05\t30.5\t1.0\t2.0" #average time and temperature
+
+def test_service_stops_run_without_output_file(tmp_path):
+    d = Device("Jason", "1323401")
+    t = Experiment("t", 10, d.ports[0:2], tmp_path / "t.tsv")
+    t.write_outfile_header()
+    service = AcquisitionService(tmp_path / "config.pkl")
+    service.read_devices = lambda requested, profile = None: {"1323401": (time.monotonic(), 30.0, {"1": 1.0, "2": 2.0})}
+    service.runs["t"] = ScheduledRun.from_header(t.path, time.monotonic())
+    t.path.unlink()
+    service.run_due()
+    assert service.runs == {} and service.finished == {"t"}
+    assert not t.path.exists()
+
+def test_service_isolates_run_errors(tmp_path):
+    d = Device("Jason", "1323401")
+    service = AcquisitionService(tmp_path / "config.pkl")
+    service.read_devices = lambda requested, profile = None: {"1323401": (time.monotonic(), 30.0, {"1": 1.0, "2": 2.0, "3": 3.0, "4": 4.0})}
+    for name, ports in (("locked", d.ports[0:2]), ("fine", d.ports[2:4])):
+        e = Experiment(name, 10, ports, tmp_path / f"{name}.tsv")
+        e.write_outfile_header()
+        service.runs[name] = ScheduledRun.from_header(e.path, time.monotonic())
+
+    def flush():
+        raise PermissionError("locked by another program")
+    locked = service.runs["locked"]
+    locked.writer.flush = flush
+    for i in range(5):
+        for run in service.runs.values():
+            run.schedule.next_time = 0
+        service.run_due()
+    #the locked run failed 4 timepoints and stopped, the other kept recording
+    assert locked.failures == 4 and list(service.runs) == ["fine"] and service.finished == {"locked"}
+    service.runs["fine"].writer.close()
+    rows = read_output_file(tmp_path / "fine.tsv", comment = "#", header = None)
+    assert len(rows) == 5
+
+def test_service_token(tmp_path):
+    d = Device("Jason", "1323401")
+    pickle_path = tmp_path / "config.pkl"
+    service = AcquisitionService(pickle_path, token = "abc")
+    write_pid_file(os.getpid(), service.token, pickle_path)
+    assert service.retire() and read_pid_file(pickle_path) == (None, None)
+
+    write_pid_file(12345, service.token, pickle_path) #PID of a launcher, not of the service
+    t = Experiment("t", 10, d.ports[0:2], tmp_path / "t.tsv")
+    t.write_outfile_header()
+    t.PID, t.service = 12345, service.token
+    other = Experiment("other", 10, d.ports[2:4], tmp_path / "other.tsv")
+    other.write_outfile_header()
+    other.PID, other.service = os.getpid(), "another service"
+    config_store.dump({"Experiments": [t, other], "Experiment_names": ["t", "other"]}, pickle_path)
+    assert not service.retire() #handed an experiment before it could exit
+    assert list(service.runs) == ["t"] and read_pid_file(pickle_path) == (12345, "abc")
+
+    for run in service.runs.values():
+        run.writer.close()
+
+def test_outfile_header(tmp_path):
+    d = Device("Jason", "1323401")
+    t = Experiment("test_experiment", 10, d.ports[0:3], tmp_path / "test_experiment.tsv",
+                   profile = ACQUISITION_PROFILES["Low noise"])
+    t.write_outfile_header()
+    name, interval, device_ids, ports, usages = collect_header(t.path)
+    assert name == "test_experiment"
+    assert interval == 600
+    assert device_ids == ["1323401"] * 3
+    assert ports == ["1", "2", "3"]
+    assert collect_profile(t.path) == ACQUISITION_PROFILES["Low noise"]
+    assert collect_policy(t.path) == "skip"
 
 
 if __name__ == "__main__":
-    import pytest 
+    import pytest
     pytest.main()
-    
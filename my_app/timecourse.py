@@ -1,12 +1,21 @@
-from LabJackPython import Close
+from connections import pool as connection_pool
+from scheduler import Schedule, event_row, DEFAULT_POLICY
+from output_writer import OutputWriter
+from metadata import read_header
+from events import EventLog
 import time
 import dill as pickle
 import sys
+import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import statistics
-import u3
+import json
+import numpy as np
+from backend import u3
 
 config_file = "config.pkl"
+status_file = "status.json" #names of running experiments, see write_status()
 
 """
 U3-LV has 2 digital-to-analog converters (DAC0 and DAC1)
@@ -15,6 +24,37 @@ U3-LV has 2 digital-to-analog converters (DAC0 and DAC1)
 """
 DAC_0_1_voltages = [5, 2.6]
 
+#a U3 feedback packet holds at most 64 bytes: a 7 byte header plus 3 bytes per AIN command
+AIN_PER_PACKET = 19
+
+def trimmed_mean(data, proportion = 0.2):
+    """
+    Averages each column after dropping the lowest and highest `proportion` of its values.
+    """
+    cut = int(len(data) * proportion)
+    return np.sort(data, axis = 0)[cut:len(data) - cut].mean(axis = 0)
+
+#combine n_reps readings (rows) into one voltage per port (columns)
+AGGREGATORS = {
+    "mean": lambda data: data.mean(axis = 0),
+    "median": lambda data: np.median(data, axis = 0),
+    "trimmed mean": trimmed_mean,
+}
+
+"""
+Acquisition profiles trade noise for speed. Keys are arguments of measure_voltage.
+    n_reps -> readings per port, combined by the aggregator
+    long_settling -> U3 waits longer before each conversion (less noise, slower)
+    quick_sample -> U3 converts at lower resolution (more noise, faster)
+    spread -> seconds over which the readings are taken
+"""
+ACQUISITION_PROFILES = {
+    "Standard": {"n_reps": 9, "long_settling": True, "quick_sample": False, "spread": 1, "aggregator": "mean"},
+    "Fast": {"n_reps": 3, "long_settling": False, "quick_sample": True, "spread": 0, "aggregator": "median"},
+    "Low noise": {"n_reps": 25, "long_settling": True, "quick_sample": False, "spread": 2, "aggregator": "trimmed mean"},
+}
+DEFAULT_PROFILE = "Standard"
+
 def resource_path(relative_path):
     """ Get path to resource, works for dev and for PyInstaller """
     try:
@@ -32,6 +72,55 @@ def get_config_path():
         application_path = Path(__file__).parent
     return (application_path / config_file).resolve()
 
+def get_output_path():
+    """
+    Returns the "Output Data" folder, where the app saves output files.
+    """
+    if getattr(sys, 'frozen', False):
+        # when running as .exe: .exe and .tsv will be in sibling folders
+        application_path = Path(sys.executable).parents[1]
+    else:
+        application_path = Path(__file__).parents[1]
+    return application_path / "Output Data"
+
+def get_status_path(pickle_path):
+    """
+    Returns the path of the status file, which sits next to the config file.
+    """
+    return Path(pickle_path).with_name(status_file)
+
+def write_status(experiment_names:list, pickle_path):
+    """
+    Writes the names of running experiments to the status file.
+
+    The file is written to a temporary file and then renamed, so readers never see half of it.
+    """
+    path = get_status_path(pickle_path)
+    temp = path.with_name(path.name + ".tmp")
+    temp.write_text(json.dumps({"Experiment_names": list(experiment_names)}))
+    os.replace(temp, path)
+
+#{status file path: (mtime, size, names)}, so read_status() only parses changed files
+_status_cache = {}
+
+def read_status(pickle_path):
+    """
+    Returns the set of running experiment names from the status file, or None if there is no status file.
+
+    Costs one os.stat() unless the file changed since the last call.
+    """
+    path = get_status_path(pickle_path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    cached = _status_cache.get(path)
+    if cached and cached[0:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    names = set(json.loads(path.read_text())["Experiment_names"])
+    _status_cache[path] = (stat.st_mtime_ns, stat.st_size, names)
+    return names
+
 def retry(max_retries, wait_time):
     """
     Decorator to retry a function if it throws an exception
@@ -53,69 +142,155 @@ def retry(max_retries, wait_time):
         return wrapper
     return decorator
 
+def read_voltages(d, positions:list, n_reps = 9, spread = 1, long_settling = True, quick_sample = False):
+    """
+    Reads analog inputs n_reps times, packing as many AIN commands as fit into each feedback packet.
+
+    Packets are spread evenly over `spread` seconds. With spread = 0 all packets are sent back to back.
+
+    Args:
+        d (u3.U3): An open connection, with `positions` configured as analog inputs.
+        positions (list): Analog input channels (port position - 1).
+        n_reps (int): Number of readings per channel.
+        spread (float): Seconds over which the readings are taken.
+        long_settling, quick_sample (bool): Passed to u3.AIN.
+
+    Returns:
+        numpy.ndarray: Calibrated voltages with shape (n_reps, len(positions)).
+    """
+    #all reps of all channels in order, so the results reshape into rows of reps
+    commands = [u3.AIN(PositiveChannel=n, NegativeChannel=31, LongSettling=long_settling, QuickSample=quick_sample)
+                for x in range(n_reps) for n in positions]
+    packets = [commands[i:i + AIN_PER_PACKET] for i in range(0, len(commands), AIN_PER_PACKET)]
+
+    bits = []
+    for packet in packets:
+        time.sleep(spread/len(packets))
+        bits.extend(d.getFeedback(packet))
+
+    #same conversion as d.binaryListToCalibratedAnalogVoltages(), for all readings at once
+    slope, offset = d.getCalibratedSlopeOffset(isLowVoltage = True, isSingleEnded = True, isSpecialSetting = False)
+    return np.array(bits, dtype = float).reshape(n_reps, len(positions)) * slope + offset
+
 #LabJack U3-LV throws exception if connection is busy or not closed
 #retry all LabJack U3 interactions in case LabJack is busy taking a reading for a parallel experiment
 @retry(max_retries = 4, wait_time = 1)
-def measure_voltage(serialNumber, ports:list, n_reps = 9, DAC_voltages = DAC_0_1_voltages):
+def measure_voltage(serialNumber, ports:list, n_reps = 9, DAC_voltages = DAC_0_1_voltages, pool = connection_pool,
+                    spread = 1, long_settling = True, quick_sample = False, aggregator = "mean"):
     """
     Interface with hardware to measure voltages.
     LabJack U3-LV has 16 analog inputs (FIO and EIO called by a sum of powers of 2)
+
+    The connection is borrowed from `pool` (see connections.py) and stays open afterwards.
+    Each port is read n_reps times over `spread` seconds (see read_voltages) and combined
+    by one of the AGGREGATORS. See ACQUISITION_PROFILES for sets of these arguments.
     """
-    d = u3.U3(firstFound = False, serial = serialNumber)
-    positions = [int(p)-1 for p in ports]
-    fio = sum([2**(x) for x in positions if x <= 7])
-    eio = sum([2**(x-8) for x in positions if x >= 8])
-    d.configIO(FIOAnalog = fio, EIOAnalog= eio)
-    
-    #set DAC voltages to turn on power/set sensor voltage
-    if DAC_voltages:
-        for x,v in enumerate(DAC_voltages):
-            d.getFeedback(u3.DAC8(Dac = x, Value = d.voltageToDACBits(v, x )))
-    
-    #repeat measurment n_reps times over y seconds for n_reps and y in the if time.sleep(y/n_reps) statement
-    data = []
-    for x in range(n_reps):
-        if time.sleep(1/n_reps) is None:   
-            data.append(d.binaryListToCalibratedAnalogVoltages(d.getFeedback([u3.AIN(PositiveChannel=n, NegativeChannel=31, LongSettling=True, QuickSample=False) for n in positions]), isLowVoltage= True, isSingleEnded= True, isSpecialSetting= False ))
-    
-    #turn off LEDs/sensors by setting DAC voltages to 0
-    for x,v in enumerate([0,0]):
-            d.getFeedback(u3.DAC8(Dac = x, Value = d.voltageToDACBits(v, x )))
-    Close() #all LabJack U3 devices
-    
-    #return an average voltage 
-    voltages = []
-    for i,not_used in enumerate(data[0]):
-        #flatten list of lists into list of average voltages
-        voltages.append(statistics.mean(row[i] for row in data))
+    with pool.connection(serialNumber) as d:
+        positions = [int(p)-1 for p in ports]
+        fio = sum([2**(x) for x in positions if x <= 7])
+        eio = sum([2**(x-8) for x in positions if x >= 8])
+        d.configIO(FIOAnalog = fio, EIOAnalog= eio)
+        
+        #set DAC voltages to turn on power/set sensor voltage
+        if DAC_voltages:
+            for x,v in enumerate(DAC_voltages):
+                d.getFeedback(u3.DAC8(Dac = x, Value = d.voltageToDACBits(v, x )))
+        
+        data = read_voltages(d, positions, n_reps = n_reps, spread = spread,
+                             long_settling = long_settling, quick_sample = quick_sample)
+        
+        #turn off LEDs/sensors by setting DAC voltages to 0
+        for x,v in enumerate([0,0]):
+                d.getFeedback(u3.DAC8(Dac = x, Value = d.voltageToDACBits(v, x )))
     
-    return voltages
+    #return an average voltage per port
+    return AGGREGATORS[aggregator](data).tolist()
 
 #LabJack U3-LV throws exception if connection is not closed
 #retry all LabJack U3 interactions in case LabJack is busy taking a reading for a parallel experiment
 @retry(max_retries = 4, wait_time = 1)
-def measure_temp(serialNumber):
-   d = u3.U3(firstFound = False, serial = serialNumber)
-   temp = kelvin_to_celcius(d.getTemperature())
-   Close()
-   del d
-   return temp
+def measure_temp(serialNumber, pool = connection_pool):
+   with pool.connection(serialNumber) as d:
+       return kelvin_to_celcius(d.getTemperature())
 
 def kelvin_to_celcius(k):
     return k-273.15
 
-def get_measurement_row(test:dict, starttime):
+def read_device(serialNumber, ports:list, pool = connection_pool, profile = None):
+    """
+    Reads the voltages and temperature of one device.
+
+    Args:
+        profile (dict): Arguments for measure_voltage. See ACQUISITION_PROFILES.
+
+    Returns:
+        tuple: (time.monotonic() when the voltages were read, temperature, list of voltages)
+    """
+    voltages = measure_voltage(serialNumber, ports = ports, pool = pool, **(profile or {}))
+    timepoint = time.monotonic()
+    temp = measure_temp(serialNumber, pool = pool)
+    return timepoint, temp, voltages
+
+def read_devices(test:dict, pool = connection_pool, profile = None):
+    """
+    Reads several devices at the same time, one thread per device.
+
+    Args:
+        test (dict): Ports to read, as {device serial number: [port positions]}.
+        profile (dict): Arguments for measure_voltage. See ACQUISITION_PROFILES.
+
+    Returns:
+        dict: {device serial number: see read_device}.
+              The value is the exception instead if the device could not be read.
+    """
+    with ThreadPoolExecutor(max_workers = max(len(test), 1)) as executor:
+        futures = {serialNumber: executor.submit(read_device, serialNumber, ports, pool, profile)
+                   for serialNumber, ports in test.items()}
+
+    readings = {}
+    for serialNumber, future in futures.items():
+        try:
+            readings[serialNumber] = future.result()
+        except Exception as e:
+            readings[serialNumber] = e
+    return readings
+
+def get_measurement_row(test:dict, starttime, profile = None, readings = None):
+    #readings (see read_devices) are taken now unless given
+    #the time column is the average time at which the devices were read, see read_times_row()
+    if readings is None:
+        readings = read_devices(test, profile = profile)
+    timepoints = []
     temperatures = []
     measurements_row = []
-    for device, ports in test.items():
-        measurements_row = measurements_row + measure_voltage(device, ports=ports)
-        temperatures.append(measure_temp(device))
+    for device in test:
+        if isinstance(readings[device], Exception):
+            raise readings[device]
+        timepoint, temp, voltages = readings[device]
+        timepoints.append(timepoint)
+        temperatures.append(temp)
+        measurements_row = measurements_row + voltages
     temp = statistics.mean(temperatures)
-    timepoint = time.monotonic()
+    timepoint = statistics.mean(timepoints)
     measurements_row.insert(0, temp)
     measurements_row.insert(0, (timepoint - starttime)/60)
     return measurements_row
 
+def read_times_row(test:dict, readings, starttime):
+    """
+    Returns a comment line with the time at which each device of a timepoint was read.
+
+    The time column of the data row averages these times. Devices are read in parallel, but a
+    busy or retried device can be read seconds after the others.
+
+    Returns:
+        list: e.g. ["#Read Times:", "320000001", 10.01, "320000002", 10.05], minutes since starttime.
+    """
+    row = ["#Read Times:"]
+    for device in test:
+        row += [device, (readings[device][0] - starttime)/60]
+    return row
+
 def lists_to_dictlist(keys, values):
     dict = {}
     for key, value in zip(keys, values):
@@ -126,6 +301,7 @@ def lists_to_dictlist(keys, values):
     return dict
 
 def append_list_to_tsv(input:list, file):
+    #one-off lines. Runs keep their file open with an OutputWriter
     input = (str(x) for x in input)
     with open(file, "a+") as f: # "a+" will append or write file
         f.write("\t".join(input))
@@ -143,69 +319,158 @@ def voltage_to_OD(v_ref_zero, time_zero_voltages, measurements):
     return [math.log10((v_test_zero/v_test_now)/(v_ref_zero/v_ref_now)) for v_test_now, v_test_zero in zip(measurements,time_zero_voltages)]
 
 """
-def kill_switch(pickle_path, output_file):
+def kill_switch(pickle_path, output_file, events = None):
     #controls to shut down otherise-infinite loops 
     #terminate if output file has been renamed/moved/deleted.
     if not Path(output_file).exists():
         sys.exit()
 
+    def terminate(lines):
+        #explain in the output file and in the event log (see events.py), then exit
+        append_list_to_tsv(lines, output_file)
+        if events is not None:
+            events.record("terminated", message = " ".join(line.lstrip("#") for line in lines))
+            events.close()
+        sys.exit()
+
     #terminate if pickle not found
     path_obj = Path(pickle_path)
     if not path_obj.exists():
-        append_list_to_tsv([f"#Self terminating. {config_file} does not exist at {path_obj}.",
-                            f"#You must have deleted {config_file}."], output_file)   
-        sys.exit()
+        terminate([f"#Self terminating. {config_file} does not exist at {path_obj}.",
+                   f"#You must have deleted {config_file}."])
+
+    #check the small status file, written by Experiment.dump_config() with the pickle
+    #fall back to loading the pickle if there is no (readable) status file
+    try:
+        running = read_status(path_obj)
+    except Exception:
+        running = None
+    if running is not None:
+        if Path(output_file).stem not in running:
+            terminate([f"#Self terminating because run was not found in {status_file}."])
+        return
 
     #terminate if pickle not loadable
     try:
         with path_obj.open('rb') as f:  # Use Path's open() method
             loaded_data = pickle.load(f)["Experiment_names"]
     except Exception as e:
-        append_list_to_tsv([f"#self terminating. Could not load {path_obj}"], output_file)
-        append_list_to_tsv([f"#{e}"], output_file)        
-        sys.exit()
+        terminate([f"#self terminating. Could not load {path_obj}", f"#{e}"])
 
     #terminate if run not found in pickle
     if Path(output_file).stem not in loaded_data:
-        append_list_to_tsv(["#Self terminating because run was not found in the pickle file."], output_file)
-        sys.exit()
+        terminate(["#Self terminating because run was not found in the pickle file."])
+
+def per_iteration(writer, pickle_path, test, schedule, failures, profile = None, events = None):
+    """
+    Takes one timepoint and waits until the next one is due. See scheduler.Schedule.
 
-def per_iteration(file, pickle_path, test, starttime, interval, failures):
+    Args:
+        writer (OutputWriter): Writer of the output file, held for the whole run.
+        events (EventLog): Log of the errors of the run (see events.py). Optional.
+
+    Returns:
+        int: The number of consecutive failed timepoints.
+    """
+    readings = {}
+    started = time.monotonic()
     try:
         #check kill switch
-        #append_list_to_tsv creates missing file
+        #the writer creates missing file
         #must check kill switch first if file deletion/rename/move is a kill switch
-        kill_switch(pickle_path = pickle_path, output_file = file)
+        kill_switch(pickle_path = pickle_path, output_file = writer.path, events = events)
+
+        started = time.monotonic()
+        if events is not None:
+            events.attempted(test)
+        readings = read_devices(test, profile = profile)
+        new_volts= get_measurement_row(test, schedule.starttime, profile, readings)
 
-        new_volts= get_measurement_row(test, starttime)
+        #free the hardware for parallel experiments until the next timepoint
+        connection_pool.close_all()
         #new_OD = voltage_to_OD(ref_voltage_t_zero, t_zero_voltages, new_row)
-        append_list_to_tsv(new_volts, file)
+        writer.write_data(new_volts)
+        if len(test) > 1:
+            writer.write_row(read_times_row(test, readings, schedule.starttime))
+
+        #record late/missed timepoints as commented out lines
+        writer.write_rows([event_row(event) for event in schedule.taken_at(started)])
+        writer.flush()
         
         #reset
         failures = 0
-        
-        #wait remainder of interval until next read
-        time.sleep(interval - (time.monotonic()-starttime) % interval)
 
     except Exception as e:
         failures += 1
+        connection_pool.close_all()
+
+        #output file renamed/moved/deleted while measuring, don't recreate it
+        if not writer.path.exists():
+            if events is not None:
+                events.close()
+            sys.exit()
         
-        append_list_to_tsv([f"#{e}"], file) #save exception as commented out line in file
+        writer.write_row([f"#{e}"]) #save exception as commented out line in file
+        if events is not None:
+            events.record_failure(e, readings, retry = failures, latency = time.monotonic() - started)
         
         if failures >= 4:
-            append_list_to_tsv(["#Stopping timecourse due to failures"], file)
+            writer.write_row(["#Stopping timecourse due to failures"])
+            writer.write_row(schedule.summary_row())
+            writer.close()
+            if events is not None:
+                events.record("stopped", message = "Stopping timecourse due to failures", retry = failures)
+                events.close()
             sys.exit()
         
-        time.sleep(2.3)
+        #retry without shifting the deadlines of later timepoints
+        writer.write_rows([event_row(event) for event in schedule.failed_at(time.monotonic(), 2.3)])
+        writer.flush()
+
+    #let the user rename/delete the file while waiting long. See OutputWriter.idle()
+    writer.idle(schedule.next_time - time.monotonic())
+
+    #wait until the next deadline (or retry)
+    schedule.wait()
+    return failures
 
 def collect_header(path):
-    with open(path, "r") as f:
-        lines = f.readlines()[0:5]
-    info, device_names, device_ids, ports, usages= [line.rstrip("\n").split("\t")[1:] for line in lines]
+    #reads only the header, and only once per change of the file. See metadata.py
+    info, device_names, device_ids, ports, usages= [line[1:] for line in read_header(path)]
     name, interval = info[0:2]
     interval = float(interval)*60
     return [name, interval, device_ids, ports, usages]
 
+def collect_info(path):
+    """
+    Returns the fields of the "#Info:" line: name, interval (min), acquisition profile, schedule policy.
+
+    Files written before profiles or policies existed have fewer fields.
+    """
+    return read_header(path)[0][1:]
+
+def collect_profile(path):
+    """
+    Returns the acquisition profile stored after the name and interval in the "#Info:" line.
+
+    Files written before profiles existed get the default profile.
+    """
+    info = collect_info(path)
+    if len(info) > 2:
+        return json.loads(info[2])
+    return ACQUISITION_PROFILES[DEFAULT_PROFILE]
+
+def collect_policy(path):
+    """
+    Returns the schedule policy (see scheduler.py) stored after the profile in the "#Info:" line.
+
+    Files written before policies existed get the default policy.
+    """
+    info = collect_info(path)
+    if len(info) > 3:
+        return info[3]
+    return DEFAULT_POLICY
+
 ################################# MAIN ######################################################
 if __name__ == "__main__":
     #path to ouput data file
@@ -213,12 +478,18 @@ if __name__ == "__main__":
     pickle_path = sys.argv[2]
     starttime = time.monotonic()
     name, interval, device_ids, ports, usages= collect_header(file)
+    profile = collect_profile(file)
+    schedule = Schedule(starttime, interval, policy = collect_policy(file))
     test = lists_to_dictlist(device_ids, ports)
 
+    writer = OutputWriter(file, sidecar = True)
+    events = EventLog(file)
+
     #print start time to header
-    append_list_to_tsv([f"#Start Time:\t{time.asctime()}"], file)
+    writer.write_row([f"#Start Time:\t{time.asctime()}"])
+    writer.flush()
 
     failures = 0 #track consecutive failed iterations
     while True:
-        per_iteration(file = file, test = test, pickle_path = pickle_path,
-                      starttime = starttime, interval = interval, failures = failures)
\ No newline at end of file
+        failures = per_iteration(writer = writer, test = test, pickle_path = pickle_path,
+                                 schedule = schedule, failures = failures, profile = profile, events = events)
\ No newline at end of file